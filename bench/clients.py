@@ -0,0 +1,88 @@
+"""Per-request client overhead: clients built for every request versus the pooled ones.
+
+    python bench/clients.py --requests 500 --latency-ms 5 --out results/clients.json
+
+Before pooling, each request built its own Weaviate and Supabase clients; now
+they're built once per worker in the lifespan. Both ways run here against the
+fake backends, started in-process, with the same search-like request: one
+GraphQL query and one saved_uris select. The report has the latency per
+request and the backend calls each request made, so the setup round trips a
+fresh client costs show up next to the time.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fake_backends import serve  # noqa: E402
+
+# settings the app requires but these clients never use
+_REQUIRED_SETTINGS = ("WEAVIATE_API_KEY", "OPENAI_API_KEY", "SUPABASE_SECRET", "HUGGINGFACE_API_URL",
+                      "HUGGINGFACE_API_KEY", "COHERE_API_KEY", "SENTRY_DSN", "LOOPS_API_KEY", "MIXPANEL_TOKEN",
+                      "JOBS_QUEUE", "LEMON_SQUEEZY_SECRET")
+
+
+def _request(weaviate_client, supabase_client):
+    weaviate_client.query.get("ContentId_bench", ["source_content"]).with_limit(10).do()
+    supabase_client.table("saved_uris").select("id").eq("user_id", "bench").limit(10).execute()
+
+
+def _timed(requests: int, fn, backends):
+    before = sum(backends.counts.values())
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "backend_calls_per_request": round((sum(backends.counts.values()) - before) / requests, 2),
+    }
+
+
+def run(requests: int, latency_ms: float, port: int):
+    server = serve(port, latency_ms=latency_ms, jitter_ms=0)
+    url = f"http://127.0.0.1:{port}"
+    os.environ["WEAVIATE_URL"] = os.environ["SUPABASE_URL"] = url
+    # supabase-py only checks the key's shape
+    os.environ["SUPABASE_SERVICE_KEY"] = "bench.bench.bench"
+    for name in _REQUIRED_SETTINGS:
+        os.environ.setdefault(name, "bench")
+    from client import _build_supabase_client, _build_weaviate_client
+
+    try:
+        results = {"per_request": _timed(requests, lambda: _request(_build_weaviate_client(),
+                                                                    _build_supabase_client()), server.backends)}
+        weaviate_client, supabase_client = _build_weaviate_client(), _build_supabase_client()
+        results["pooled"] = _timed(requests, lambda: _request(weaviate_client, supabase_client), server.backends)
+    finally:
+        server.shutdown()
+    results["overhead_ms"] = round(results["per_request"]["mean_ms"] - results["pooled"]["mean_ms"], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=5, help="latency of every faked backend call")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    results = {"requests": args.requests, "latency_ms": args.latency_ms, **run(args.requests, args.latency_ms, args.port)}
+    print(json.dumps(results, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Local stand-ins for Weaviate, Supabase REST, OpenAI, Cohere, Mixpanel and Loops.
+
+Each backend answers with realistic response shapes after a configurable
+latency, and fails a configurable share of requests with a 503. Run it and
+point the app's settings at it (see bench/README.md):
+
+    python bench/fake_backends.py --port 8900 --latency-ms 20 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+class Backends:
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, hits: int):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.hits = hits
+        self.saved_uris = []
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def delay(self):
+        time.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def _hit(source_class: str, i: int):
+    source_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_class}/{i % 7}"))
+    return {
+        "source_content": f"chunk {i} " * 40,
+        # both shapes, so the app can run with or without denormalized chunks
+        "source_id": source_id,
+        "uri": f"https://example.com/{i % 7}",
+        "title": f"Page {i % 7}",
+        "hasCategory": [{"uri": f"https://example.com/{i % 7}", "title": f"Page {i % 7}", "_additional": {"id": source_id}}],
+        "_additional": {"id": str(uuid.uuid4()), "distance": 0.1 + i / 100, "rerank": [{"score": max(0.0, 0.95 - i * 0.05)}]},
+    }
+
+
+def graphql_response(query: str, hits: int):
+    match = re.search(r"Get\s*\{\s*(\w+)", query)
+    class_name = match.group(1) if match else "Unknown"
+    source_class = class_name.replace("ContentId_", "KnowledgeSourceId_")
+
+    if "group {" in query:
+        objects = [{"_additional": {"group": {"id": i, "count": 1, "minDistance": 0.1, "hits": [_hit(source_class, i)]}}}
+                   for i in range(hits)]
+    elif "chunk_refs" in query:
+        objects = [{
+            "uri": "https://example.com/0",
+            "title": "Page 0",
+            "chunk_refs": [{"source_content": f"chunk {i} " * 40, "_additional": {"id": str(uuid.uuid4())}} for i in range(hits)],
+            "_additional": {"id": str(uuid.uuid4())},
+        }]
+    elif class_name.startswith("KnowledgeSource") and "ContainsAny" in query:
+        # sources looked up by id before a delete, every one of them exists
+        ids = re.findall(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", query)
+        objects = [{"uri": f"https://example.com/{i}", "_additional": {"id": source_id}} for i, source_id in enumerate(ids)]
+    else:
+        objects = [_hit(source_class, i) for i in range(hits)]
+    return {"data": {"Get": {class_name: objects}}}
+
+
+def _postgrest_filter(rows: list, params: dict):
+    for column, values in params.items():
+        if column in ("select", "order", "limit", "offset", "or"):
+            continue
+        op, _, value = values[0].partition(".")
+        if op == "eq":
+            rows = [row for row in rows if str(row.get(column)) == value]
+        elif op == "in":
+            allowed = {v.strip('"') for v in value.strip("()").split(",")}
+            rows = [row for row in rows if str(row.get(column)) in allowed]
+    return rows
+
+
+def make_handler(backends: Backends):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw) if raw else None
+            except ValueError:
+                return None
+
+        def _send(self, status: int, payload=None):
+            body = b"" if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, method: str):
+            url = urlparse(self.path)
+            path, params = url.path, parse_qs(url.query)
+            body = self._body()
+            backends.count(f"{method} {re.sub(r'/[0-9a-f-]{36}', '/{id}', path)}")
+
+            # readiness probes are never slowed down or failed
+            if path in ("/v1/.well-known/ready", "/v1/.well-known/live"):
+                return self._send(200)
+            if path == "/v1/.well-known/openid-configuration":
+                return self._send(404)
+            if path == "/v1/meta":
+                return self._send(200, {"version": "1.23.0", "modules": {}})
+
+            backends.delay()
+            if backends.should_fail():
+                return self._send(503, {"error": "injected failure"})
+
+            # Weaviate
+            if path == "/v1/graphql":
+                return self._send(200, graphql_response((body or {}).get("query", ""), backends.hits))
+            if path == "/v1/batch/objects" and method == "POST":
+                return self._send(200, [{"id": o.get("id"), "class": o.get("class"), "result": {}} for o in body["objects"]])
+            if path == "/v1/batch/objects" and method == "DELETE":
+                return self._send(200, {"results": {"matches": 1, "limit": 10000, "successful": 1, "failed": 0}})
+            if path == "/v1/batch/references":
+                return self._send(200, [{"result": {}} for _ in body or []])
+            if path.startswith("/v1/schema"):
+                return self._send(200, {"classes": []} if method == "GET" else None)
+            if path.startswith("/v1/objects"):
+                return self._send(204 if method in ("DELETE", "PATCH") else 200, None if method in ("DELETE", "PATCH") else {})
+
+            # Supabase REST
+            if path.startswith("/rest/v1/"):
+                table = path[len("/rest/v1/"):]
+                if table != "saved_uris":
+                    return self._send(200, [])
+                with backends.lock:
+                    if method == "GET":
+                        rows = _postgrest_filter(backends.saved_uris, params)
+                        limit = int(params.get("limit", [len(rows)])[0])
+                        return self._send(200, rows[:limit])
+                    if method == "POST":
+                        rows = body if isinstance(body, list) else [body]
+                        for row in rows:
+                            row.setdefault("created_at", time.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+                        backends.saved_uris.extend(rows)
+                        return self._send(201, rows)
+                    if method == "DELETE":
+                        gone = _postgrest_filter(backends.saved_uris, params)
+                        backends.saved_uris = [row for row in backends.saved_uris if row not in gone]
+                        return self._send(200, gone)
+                    return self._send(200, [])
+
+            # OpenAI embeddings
+            if path == "/v1/embeddings":
+                inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                data = [{"index": i, "embedding": [random.random() for _ in range(EMBEDDING_DIMENSIONS)]}
+                        for i in range(len(inputs))]
+                return self._send(200, {"data": data, "model": body.get("model")})
+
+            # Cohere rerank
+            if path == "/v1/rerank":
+                documents = body.get("documents", [])
+                results = [{"index": i, "relevance_score": max(0.0, 0.95 - i * 0.05)} for i in range(len(documents))]
+                return self._send(200, {"results": results})
+
+            # Mixpanel and Loops
+            if path in ("/track", "/engage", "/import"):
+                return self._send(200, {"status": 1, "error": None})
+            if path == "/api/v1/contacts/create":
+                return self._send(200, {"success": True, "id": str(uuid.uuid4())})
+
+            return self._send(404, {"error": f"no fake for {method} {unquote(path)}"})
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PUT(self):
+            self._handle("PUT")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+    return Handler
+
+
+def serve(port: int, latency_ms: float = 20, jitter_ms: float = 5, error_rate: float = 0.0, hits: int = 10):
+    """Start the fakes on a background thread and return the server."""
+    backends = Backends(latency_ms, jitter_ms, error_rate, hits)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(backends))
+    server.backends = backends
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--hits", type=int, default=10, help="chunk hits per search")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.hits)
+    print(f"fake backends on http://127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(json.dumps(server.backends.counts, indent=2))
+
+
+if __name__ == "__main__":
+    main()
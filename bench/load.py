@@ -0,0 +1,291 @@
+"""Replay logged searches, mixed with synthetic saves, deletes and all_saved calls, against the app.
+
+Searches come from the app's own search logs (search_logs*.json and rotated
+*.json.gz). Users are taken from the log too, and each gets a token signed
+with SUPABASE_SECRET, so the app must run with the same secret:
+
+    python bench/load.py --url http://127.0.0.1:8000 --logs src/search_logs \\
+        --duration 60 --concurrency 32 --mix search=70,save=10,all_saved=15,delete=5 \\
+        --out results/baseline.json
+
+With --rate the driver is open loop: requests start on a fixed schedule and
+latency counts from the scheduled start, so a stalled server shows up in the
+tail rather than slowing the driver down. Pass --compare to print the change
+against an earlier results file.
+"""
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import os
+import random
+import subprocess
+import time
+import uuid
+
+import httpx
+from jose import jwt
+
+OPERATIONS = ("search", "save", "save_batch", "all_saved", "delete")
+
+
+def load_searches(log_dir: str, limit: int = None):
+    """(user_id, query) pairs from current and rotated search logs, oldest first."""
+    paths = sorted(glob.glob(os.path.join(log_dir, "search_logs*.json*")), key=os.path.getmtime)
+    searches = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("user_id") and entry.get("query"):
+                    searches.append((entry["user_id"], entry["query"]))
+                if limit and len(searches) >= limit:
+                    return searches
+    return searches
+
+
+def make_token(secret: str, user_id: str):
+    now = int(time.time())
+    # the logs hold the underscore form, tokens carry the Supabase uuid
+    claims = {"aud": "authenticated", "exp": now + 24 * 3600, "iat": now, "iss": "bench",
+              "sub": user_id.replace("_", "-"), "role": "authenticated"}
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+def synthetic_page(n: int, paragraphs: int):
+    text = "\n\n".join(
+        " ".join(random.choice(("latency", "queue", "vector", "cache", "index", "chunk", "search", "token"))
+                 for _ in range(random.randint(40, 120)))
+        for _ in range(paragraphs)
+    )
+    return {"pageData": {"url": f"https://bench.example.com/{uuid.uuid4().hex}/{n}", "title": f"Bench page {n}",
+                         "content": {"rawText": text, "readable": False}}}
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.statuses = {op: {} for op in OPERATIONS}
+
+    def record(self, op: str, status, latency_ms: float):
+        self.latencies[op].append(latency_ms)
+        self.statuses[op][str(status)] = self.statuses[op].get(str(status), 0) + 1
+
+    def summary(self, elapsed: float):
+        endpoints = {}
+        for op in OPERATIONS:
+            latencies = self.latencies[op]
+            if not latencies:
+                continue
+            errors = sum(count for status, count in self.statuses[op].items() if not status.startswith("2"))
+            endpoints[op] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "error_rate": round(errors / len(latencies), 4),
+                "rps": round(len(latencies) / elapsed, 2),
+                "p50_ms": round(percentile(latencies, 50), 2),
+                "p95_ms": round(percentile(latencies, 95), 2),
+                "p99_ms": round(percentile(latencies, 99), 2),
+                "mean_ms": round(sum(latencies) / len(latencies), 2),
+                "max_ms": round(max(latencies), 2),
+                "statuses": self.statuses[op],
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {"total_requests": total, "total_rps": round(total / elapsed, 2), "endpoints": endpoints}
+
+
+class Driver:
+    def __init__(self, args, searches: list):
+        self.args = args
+        self.searches = searches
+        self.users = sorted({user_id for user_id, _ in searches}) or [str(uuid.uuid4()).replace("-", "_")]
+        self.tokens = {user_id: make_token(args.secret, user_id) for user_id in self.users}
+        self.mix = parse_mix(args.mix)
+        self.recorder = Recorder()
+        # per user, so each delete is made by the user who owns the id
+        self.saved_ids = {}
+        self.cursors = {}
+        self.next_search = 0
+        self.pages = 0
+
+    def _headers(self, user_id: str):
+        return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+    def _request(self, op: str):
+        if op == "search":
+            user_id, text = self.searches[self.next_search % len(self.searches)] if self.searches else (self.users[0], "bench")
+            self.next_search += 1
+            params = {"query": text}
+            if self.args.grouped:
+                params["group"] = "true"
+            return user_id, "GET", "/api/search", {"params": params}
+        user_id = random.choice(self.users)
+        if op == "save":
+            self.pages += 1
+            return user_id, "POST", "/api/save", {"json": synthetic_page(self.pages, self.args.paragraphs)}
+        if op == "save_batch":
+            # an extension coming back online with a queue of pages
+            pages = []
+            for _ in range(self.args.batch_pages):
+                self.pages += 1
+                pages.append(synthetic_page(self.pages, self.args.paragraphs)["pageData"])
+            return user_id, "POST", "/api/save_batch", {"json": {"pages": pages}}
+        if op == "all_saved":
+            cursor = self.cursors.pop(user_id, None)
+            return user_id, "GET", "/api/all_saved", {"params": {"cursor": cursor} if cursor else {}}
+        # deletes hit ids all_saved returned to their owner, or a fresh id when no one has any yet
+        owners = [user for user, ids in self.saved_ids.items() if ids]
+        if not owners:
+            return user_id, "DELETE", f"/api/delete/{uuid.uuid4()}", {}
+        user_id = user_id if user_id in owners else random.choice(owners)
+        return user_id, "DELETE", f"/api/delete/{self.saved_ids[user_id].pop()}", {}
+
+    async def _one(self, client: httpx.AsyncClient, op: str, scheduled: float):
+        user_id, method, path, kwargs = self._request(op)
+        try:
+            response = await client.request(method, path, headers=self._headers(user_id), **kwargs)
+            status = response.status_code
+            if op == "all_saved" and status == 200:
+                if response.headers.get("X-Next-Cursor"):
+                    self.cursors[user_id] = response.headers["X-Next-Cursor"]
+                self.saved_ids.setdefault(user_id, []).extend(
+                    item["id"] for item in response.json()[:5] if item.get("id"))
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.recorder.record(op, status, (time.perf_counter() - scheduled) * 1000)
+
+    def _pick(self):
+        return random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        timeout = httpx.Timeout(self.args.timeout)
+        async with httpx.AsyncClient(base_url=self.args.url, limits=limits, timeout=timeout) as client:
+            started = time.perf_counter()
+            deadline = started + self.args.duration
+            if self.args.rate:
+                await self._open_loop(client, started, deadline)
+            else:
+                await asyncio.gather(*(self._closed_loop(client, deadline) for _ in range(self.args.concurrency)))
+            return time.perf_counter() - started
+
+    async def _closed_loop(self, client: httpx.AsyncClient, deadline: float):
+        while time.perf_counter() < deadline:
+            await self._one(client, self._pick(), time.perf_counter())
+
+    async def _open_loop(self, client: httpx.AsyncClient, started: float, deadline: float):
+        interval = 1 / self.args.rate
+        in_flight = set()
+        n = 0
+        while True:
+            scheduled = started + n * interval
+            if scheduled >= deadline:
+                break
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            task = asyncio.create_task(self._one(client, self._pick(), scheduled))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            n += 1
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op.strip() not in OPERATIONS:
+            raise SystemExit(f"unknown operation {op!r}, expected one of {', '.join(OPERATIONS)}")
+        weights[op.strip()] = float(weight or 1)
+    return {op: weight for op, weight in weights.items() if weight > 0}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current: dict, baseline: dict):
+    print(f"{'endpoint':<12}{'metric':<10}{'baseline':>12}{'current':>12}{'change':>10}")
+    for op, stats in current["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(op)
+        if not before:
+            continue
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+            old, new = before.get(metric), stats.get(metric)
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{op:<12}{metric:<10}{old:>12}{new:>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--logs", default="search_logs", help="directory with search_logs*.json[.gz]")
+    parser.add_argument("--max-searches", type=int, default=None)
+    parser.add_argument("--secret", default=os.environ.get("SUPABASE_SECRET"), help="defaults to $SUPABASE_SECRET")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=None, help="requests per second, open loop")
+    parser.add_argument("--mix", default="search=70,save=10,all_saved=15,delete=5")
+    parser.add_argument("--grouped", action="store_true", help="replay searches in grouped mode")
+    parser.add_argument("--paragraphs", type=int, default=8, help="paragraphs per synthetic saved page")
+    parser.add_argument("--batch-pages", type=int, default=20, help="pages per save_batch request")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write results JSON here")
+    parser.add_argument("--compare", default=None, help="results JSON to compare against")
+    args = parser.parse_args()
+    if not args.secret:
+        raise SystemExit("--secret or $SUPABASE_SECRET is required to sign tokens")
+    random.seed(args.seed)
+
+    searches = load_searches(args.logs, args.max_searches)
+    print(f"replaying {len(searches)} logged searches against {args.url}")
+    driver = Driver(args, searches)
+    elapsed = asyncio.run(driver.run())
+
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "elapsed_seconds": round(elapsed, 2),
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "mix": driver.mix,
+            "grouped": args.grouped,
+            "logged_searches": len(searches),
+            "users": len(driver.users),
+        },
+        **driver.recorder.summary(elapsed),
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
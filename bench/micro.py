@@ -0,0 +1,131 @@
+"""In-process micro-benchmarks for the hot paths that need no backends: chunking and auth.
+
+    python bench/micro.py --chunk-mb 4 --requests 20000 --users 200 --out results/micro.json
+
+Chunking is compared with LangChain's RecursiveCharacterTextSplitter, which it
+replaced, when langchain is installed (pip install langchain-text-splitters).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from chunker import TextChunker  # noqa: E402
+
+
+def _words(n: int):
+    vocabulary = ("latency", "queue", "vector", "cache", "index", "chunk", "search", "token", "a", "the")
+    return " ".join(random.choice(vocabulary) for _ in range(n))
+
+
+def synthetic_text(megabytes: float):
+    parts, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        paragraph = "\n".join(_words(random.randint(5, 40)) for _ in range(random.randint(1, 6)))
+        parts.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(parts)
+
+
+def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"seconds": round(elapsed, 4), "peak_mb": round(peak / 1024 / 1024, 2)}
+
+
+def _langchain_splitter(chunker: TextChunker):
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    except ImportError:
+        try:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+        except ImportError:
+            return None
+    return RecursiveCharacterTextSplitter(chunk_size=chunker.chunk_size, chunk_overlap=chunker.chunk_overlap)
+
+
+def bench_chunker(megabytes: float):
+    text = synthetic_text(megabytes)
+    chunker = TextChunker()
+    results = {}
+    chunks, results["split_text"] = measure(lambda: chunker.split_text(text))
+    _, results["iter_chunks"] = measure(lambda: sum(1 for _ in chunker.iter_chunks(text)))
+    splitter = _langchain_splitter(chunker)
+    if splitter is None:
+        results["langchain"] = "not installed"
+    else:
+        langchain_chunks, results["langchain"] = measure(lambda: splitter.split_text(text))
+        results["langchain"]["same_chunks"] = langchain_chunks == chunks
+    results["chunks"] = len(chunks)
+    results["input_mb"] = round(len(text) / 1024 / 1024, 2)
+    return results
+
+
+# settings the app requires but auth never touches
+_REQUIRED_SETTINGS = ("WEAVIATE_URL", "WEAVIATE_API_KEY", "OPENAI_API_KEY", "SUPABASE_URL", "SUPABASE_SERVICE_KEY",
+                      "HUGGINGFACE_API_URL", "HUGGINGFACE_API_KEY", "COHERE_API_KEY", "SENTRY_DSN", "LOOPS_API_KEY",
+                      "MIXPANEL_TOKEN", "JOBS_QUEUE", "LEMON_SQUEEZY_SECRET")
+
+
+def bench_auth(requests: int, users: int):
+    """Auth cost per request, with every request verifying its token versus get_current_user's cache."""
+    os.environ.setdefault("SUPABASE_SECRET", "bench-secret")
+    for name in _REQUIRED_SETTINGS:
+        os.environ.setdefault(name, "bench")
+    from jose import jwt
+    from schemas import TokenData
+    from utils import auth_cache_stats, get_current_user
+
+    secret = os.environ["SUPABASE_SECRET"]
+    now = int(time.time())
+    # each user keeps sending the same token, as a signed-in client does
+    tokens = [jwt.encode({"aud": "authenticated", "exp": now + 3600, "iat": now, "iss": "bench",
+                          "sub": f"user-{i}"}, secret, algorithm="HS256") for i in range(users)]
+    stream = [random.choice(tokens) for _ in range(requests)]
+
+    def verify_every_time():
+        for token in stream:
+            TokenData(**jwt.decode(token, secret, algorithms=["HS256"], audience="authenticated"))
+
+    def cached():
+        for token in stream:
+            get_current_user(token)
+
+    results = {}
+    _, results["uncached"] = measure(verify_every_time)
+    _, results["cached"] = measure(cached)
+    for stats in (results["uncached"], results["cached"]):
+        stats["per_request_us"] = round(stats["seconds"] / requests * 1e6, 2)
+    results["cache"] = auth_cache_stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-mb", type=float, default=4)
+    parser.add_argument("--requests", type=int, default=20000, help="authenticated requests to simulate")
+    parser.add_argument("--users", type=int, default=200, help="distinct tokens among them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    results = {"chunker": bench_chunker(args.chunk_mb), "auth": bench_auth(args.requests, args.users)}
+    print(json.dumps(results, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
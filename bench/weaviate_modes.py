@@ -0,0 +1,132 @@
+"""Reference-based chunks versus denormalized chunks, against a real Weaviate.
+
+    python bench/weaviate_modes.py --url http://127.0.0.1:8080 --docs 500 --queries 200 --out results/modes.json
+
+Creates throwaway classes in each layout, indexes the same synthetic documents
+with random vectors (so no embedding calls), then times nearVector searches that
+return the source's uri and title. The classes are dropped afterwards.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+DIMENSIONS = 1536
+CHUNKS_PER_DOC = 20
+# settings the app requires but the schema never touches
+_REQUIRED_SETTINGS = ("WEAVIATE_URL", "WEAVIATE_API_KEY", "OPENAI_API_KEY", "SUPABASE_SECRET", "SUPABASE_URL",
+                      "SUPABASE_SERVICE_KEY", "HUGGINGFACE_API_URL", "HUGGINGFACE_API_KEY", "COHERE_API_KEY",
+                      "SENTRY_DSN", "LOOPS_API_KEY", "MIXPANEL_TOKEN", "JOBS_QUEUE", "LEMON_SQUEEZY_SECRET")
+
+
+def _vector():
+    return [random.uniform(-1, 1) for _ in range(DIMENSIONS)]
+
+
+def _schemas(prefix: str, denormalized: bool):
+    # the app's own schema, so the benchmark follows it
+    for name in _REQUIRED_SETTINGS:
+        os.environ.setdefault(name, "bench")
+    from config import settings
+    from utils import _class_schemas
+    settings.DENORMALIZED_CHUNKS = denormalized
+    schemas = _class_schemas(f"{prefix}Source", f"{prefix}Content")
+    for schema in schemas:
+        # vectors come from the benchmark, not from OpenAI
+        schema["vectorizer"] = "none"
+        schema.pop("moduleConfig", None)
+        for prop in schema["properties"]:
+            prop.pop("moduleConfig", None)
+    return schemas
+
+
+def index(client, prefix: str, denormalized: bool, docs: int):
+    source_class, content_class = f"{prefix}Source", f"{prefix}Content"
+    client.batch.configure(batch_size=100, dynamic=True, num_workers=2)
+    started = time.perf_counter()
+    with client.batch as batch:
+        for d in range(docs):
+            source_id = str(uuid.uuid4())
+            uri, title = f"https://example.com/{d}", f"Page {d}"
+            batch.add_data_object({"uri": uri, "title": title}, source_class, uuid=source_id)
+            for c in range(CHUNKS_PER_DOC):
+                properties = {"source_content": f"chunk {c} of page {d}"}
+                if denormalized:
+                    properties.update(source_id=source_id, uri=uri, title=title)
+                chunk_id = batch.add_data_object(properties, content_class, vector=_vector())
+                if not denormalized:
+                    batch.add_reference(chunk_id, content_class, "hasCategory", source_id, source_class)
+                    batch.add_reference(source_id, source_class, "chunk_refs", chunk_id, content_class)
+    elapsed = time.perf_counter() - started
+    chunks = docs * CHUNKS_PER_DOC
+    return {"seconds": round(elapsed, 2), "chunks_per_second": round(chunks / elapsed, 1)}
+
+
+def query(client, prefix: str, denormalized: bool, queries: int, limit: int):
+    source_class, content_class = f"{prefix}Source", f"{prefix}Content"
+    if denormalized:
+        fields = ["source_id", "uri", "title"]
+    else:
+        fields = [f"hasCategory {{ ... on {source_class} {{ uri title _additional {{ id }}}}}}"]
+    latencies = []
+    for _ in range(queries):
+        started = time.perf_counter()
+        client.query.get(content_class, fields).with_near_vector({"vector": _vector()}).with_limit(limit).do()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+    }
+
+
+def run(client, docs: int, queries: int, limit: int):
+    results = {}
+    for mode, denormalized in (("references", False), ("denormalized", True)):
+        prefix = f"BenchModes{mode.capitalize()}{uuid.uuid4().hex[:6]}"
+        schemas = _schemas(prefix, denormalized)
+        try:
+            # created together, the two classes reference each other
+            client.schema.create({"classes": list(schemas)})
+            results[mode] = {
+                "index": index(client, prefix, denormalized, docs),
+                "query": query(client, prefix, denormalized, queries, limit),
+            }
+        finally:
+            for schema in reversed(schemas):
+                client.schema.delete_class(schema["class"])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--docs", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    import weaviate
+    auth = weaviate.AuthApiKey(api_key=args.api_key) if args.api_key else None
+    client = weaviate.Client(args.url, auth_client_secret=auth)
+    results = {"docs": args.docs, "chunks_per_doc": CHUNKS_PER_DOC, **run(client, args.docs, args.queries, args.limit)}
+    print(json.dumps(results, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
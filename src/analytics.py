@@ -0,0 +1,121 @@
+import json
+import queue
+import threading
+import time
+import uuid
+
+from mixpanel import Consumer, MixpanelException
+
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Mixpanel's /track takes at most 50 events per request
+MAX_BATCH_SIZE = 50
+
+_events = queue.Queue(maxsize=settings.ANALYTICS_QUEUE_SIZE)
+_stop = threading.Event()
+_worker = None
+_stats = {"queued": 0, "dropped": 0, "sent": 0, "failed": 0}
+_lock = threading.Lock()
+
+
+def _count(name: str, amount: int = 1):
+    with _lock:
+        _stats[name] += amount
+
+
+def track(distinct_id: str, event_name: str, properties: dict = None):
+    """Queue an event without blocking. Drops it if the queue is full."""
+    event = {
+        "event": event_name,
+        "properties": {
+            "token": settings.MIXPANEL_TOKEN,
+            "distinct_id": distinct_id,
+            "time": int(time.time() * 1000),
+            "$insert_id": uuid.uuid4().hex,
+            "mp_lib": "python",
+            **(properties or {}),
+        },
+    }
+    try:
+        _events.put_nowait(event)
+        _count("queued")
+    except queue.Full:
+        _count("dropped")
+
+
+def _consumer():
+    # retries are handled here, with backoff, instead of inside the consumer
+    return Consumer(
+        events_url=settings.MIXPANEL_EVENTS_URL,
+        api_host="api-eu.mixpanel.com",
+        request_timeout=settings.MIXPANEL_TIMEOUT,
+        retry_limit=0,
+    )
+
+
+def _send(consumer: Consumer, batch: list):
+    message = json.dumps(batch, separators=(",", ":"))
+    for attempt in range(settings.ANALYTICS_MAX_RETRIES + 1):
+        try:
+            consumer.send("events", message)
+            _count("sent", len(batch))
+            return
+        except MixpanelException as e:
+            if attempt == settings.ANALYTICS_MAX_RETRIES or _stop.is_set():
+                logger.error(f"Error {e} sending {len(batch)} analytics events, dropping them")
+                _count("failed", len(batch))
+                return
+            _stop.wait(settings.ANALYTICS_RETRY_BACKOFF * 2 ** attempt)
+
+
+def _drain(limit: int):
+    batch = []
+    while len(batch) < limit:
+        try:
+            batch.append(_events.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _run():
+    consumer = _consumer()
+    while not _stop.is_set():
+        try:
+            first = _events.get(timeout=settings.ANALYTICS_FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+        # give the batch a moment to fill up before sending
+        _stop.wait(settings.ANALYTICS_BATCH_WAIT)
+        _send(consumer, [first] + _drain(MAX_BATCH_SIZE - 1))
+
+    while True:
+        batch = _drain(MAX_BATCH_SIZE)
+        if not batch:
+            break
+        _send(consumer, batch)
+    consumer._session.close()
+
+
+def start_analytics():
+    global _worker
+    _stop.clear()
+    _worker = threading.Thread(target=_run, name="analytics", daemon=True)
+    _worker.start()
+
+
+def stop_analytics():
+    """Flush whatever is queued and stop the background sender."""
+    _stop.set()
+    if _worker is not None:
+        _worker.join(timeout=settings.ANALYTICS_SHUTDOWN_TIMEOUT)
+
+
+def analytics_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["queue_depth"] = _events.qsize()
+    return stats
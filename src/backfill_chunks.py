@@ -0,0 +1,158 @@
+"""Copy each source's uri and title onto its chunks, for DENORMALIZED_CHUNKS.
+
+    python backfill_chunks.py run [--user USER_ID ...] [--force]
+    python backfill_chunks.py status
+
+Chunks are written again under the same id with their vector and references,
+so nothing is embedded again and reference-based queries keep working.
+Progress is checkpointed in Redis after every page.
+
+To switch over: run, set DENORMALIZED_CHUNKS, then run --force to fill in
+chunks saved in between, and set CHUNKS_BACKFILLED once status shows no
+users remaining. With multi-tenancy on, users are the tenants of the
+shared content class.
+"""
+import argparse
+
+from weaviate import TenantActivityStatus
+
+from client import get_jobs_redis_connection, indexer_weaviate_client
+from config import settings
+from logger import get_logger
+from migrate_tenants import legacy_users
+from tenancy import activate_tenant, user_classes, user_tenant
+from utils import DENORMALIZED_PROPERTIES
+from weaviate_batch import BatchErrors, beacon_id, configure_batch, object_properties, pages, tenant_statuses
+
+logger = get_logger(__name__)
+
+BACKFILL_DONE_KEY = "backfill:chunks:done"
+BACKFILL_CURSOR_KEY = "backfill:chunks:{}"
+
+
+def ensure_properties(client, class_name: str):
+    """Add the denormalized properties to a content class that predates them."""
+    existing = {p["name"] for p in client.schema.get(class_name).get("properties") or []}
+    for prop in DENORMALIZED_PROPERTIES:
+        if prop["name"] not in existing:
+            client.schema.property.create(class_name, prop)
+
+
+def backfill_users(client):
+    if settings.WEAVIATE_MULTI_TENANCY:
+        return sorted(tenant_statuses(client))
+    return legacy_users(client)
+
+
+def _backfill_page(client, objects: list, source_class: str, content_class: str, tenant: str):
+    source_ids = {beacon_id(ref["beacon"]) for obj in objects
+                  for ref in (obj.get("properties") or {}).get("hasCategory") or []}
+    sources = object_properties(client, source_class, tenant, source_ids)
+    errors = BatchErrors()
+    configure_batch(client, errors)
+    updated = 0
+    with client.batch as batch:
+        for obj in objects:
+            properties = obj.get("properties") or {}
+            refs = properties.get("hasCategory") or []
+            if properties.get("source_id") or not refs:
+                continue
+            source_id = beacon_id(refs[0]["beacon"])
+            source = sources.get(source_id)
+            if source is None:
+                # orphaned chunk, left for the delete path to clean up
+                continue
+            # the batch replaces the whole object, so the references go back in with it
+            batch.add_data_object(
+                data_object={
+                    **properties,
+                    "hasCategory": [{"beacon": ref["beacon"]} for ref in refs],
+                    "source_id": source_id,
+                    "uri": source.get("uri"),
+                    "title": source.get("title"),
+                },
+                class_name=content_class,
+                uuid=obj["id"],
+                vector=obj.get("vector"),
+                tenant=tenant,
+            )
+            updated += 1
+    if errors.errors:
+        raise RuntimeError(f"{len(errors.errors)} chunks failed to update, first: {errors.errors[0]}")
+    return updated
+
+
+def backfill_user(client, redis_conn, user_id: str, force: bool = False, activate: bool = False):
+    cursor_key = BACKFILL_CURSOR_KEY.format(user_id)
+    if force:
+        redis_conn.delete(cursor_key)
+        redis_conn.srem(BACKFILL_DONE_KEY, user_id)
+    elif redis_conn.sismember(BACKFILL_DONE_KEY, user_id):
+        return False
+
+    source_class, content_class = user_classes(user_id)
+    tenant = user_tenant(user_id)
+    if tenant is None:
+        ensure_properties(client, content_class)
+    elif activate:
+        # an offloaded tenant can't be read or written
+        activate_tenant(client, tenant)
+    after = redis_conn.get(cursor_key)
+    updated = 0
+    for objects in pages(client, content_class, after.decode() if after else None, tenant=tenant):
+        updated += _backfill_page(client, objects, source_class, content_class, tenant)
+        redis_conn.set(cursor_key, objects[-1]["id"])
+    logger.info(f"Backfilled {updated} chunks of {user_id}")
+    redis_conn.sadd(BACKFILL_DONE_KEY, user_id)
+    redis_conn.delete(cursor_key)
+    return True
+
+
+def backfill(user_ids: list = None, force: bool = False):
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    inactive = set()
+    if settings.WEAVIATE_MULTI_TENANCY:
+        ensure_properties(client, settings.SHARED_CONTENT_CLASS)
+        tenants = tenant_statuses(client)
+        inactive = {name for name, activity in tenants.items() if activity != TenantActivityStatus.HOT}
+        user_ids = user_ids or sorted(tenants)
+    user_ids = user_ids or backfill_users(client)
+    done, failed = 0, []
+    for user_id in user_ids:
+        try:
+            if backfill_user(client, redis_conn, user_id, force=force, activate=user_id in inactive):
+                done += 1
+        except Exception as e:
+            # the checkpoint stays, the next run resumes this user
+            logger.error(f"Error {e} backfilling chunks of {user_id}")
+            failed.append(user_id)
+    logger.info(f"Backfilled {done} of {len(user_ids)} users, {len(failed)} failed")
+    return {"backfilled": done, "failed": failed}
+
+
+def status():
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    users = backfill_users(client)
+    done = {user.decode() for user in redis_conn.smembers(BACKFILL_DONE_KEY)}
+    return {"users": len(users), "backfilled": len(done), "remaining": len([u for u in users if u not in done])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run")
+    run.add_argument("--user", action="append", dest="users", help="only this user, repeatable")
+    run.add_argument("--force", action="store_true", help="go over users that were already backfilled")
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print(backfill(args.users, force=args.force))
+    else:
+        print(status())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from redis import RedisError
+
+from client import get_jobs_redis_connection, get_redis_connection
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# the generation is part of every per-user key, bumping it invalidates them all;
+# generations live on the jobs Redis, which the workers that write share with the API
+USER_GENERATION_KEY = "user:gen:{}"
+USER_CACHE_KEY = "{}:res:{}:{}:{}"
+
+_stats = {namespace: {"hits": 0, "misses": 0} for namespace in ("search", "all_saved")}
+_redis_errors = 0
+_lock = threading.Lock()
+_redis_down_until = 0.0
+_generations_down_until = 0.0
+
+
+class LRUCache:
+    """A small thread-safe LRU with per-entry expiry."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Used instead of Redis while it is unreachable.
+_local_values = LRUCache(settings.SEARCH_CACHE_MAX_ENTRIES)
+
+
+def _count(namespace: str, name: str):
+    with _lock:
+        _stats[namespace][name] += 1
+
+
+def cache_redis():
+    """Return the shared connection, or None while Redis is considered down."""
+    if time.time() < _redis_down_until:
+        return None
+    return get_redis_connection()
+
+
+def mark_redis_down(e: Exception):
+    global _redis_down_until, _redis_errors
+    with _lock:
+        _redis_errors += 1
+    _redis_down_until = time.time() + settings.CACHE_REDIS_RETRY_AFTER
+    logger.error(f"Redis unavailable for caching, using local cache: {e}")
+
+
+def normalize_query(query: str):
+    return " ".join(query.lower().split())
+
+
+def _params_digest(query: str, params: Optional[dict]):
+    raw = json.dumps({"q": normalize_query(query), "p": params or {}}, sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _mark_generations_down(e: Exception):
+    global _generations_down_until, _redis_errors
+    with _lock:
+        _redis_errors += 1
+    _generations_down_until = time.time() + settings.CACHE_REDIS_RETRY_AFTER
+    logger.error(f"Redis unavailable for cache generations, bypassing the cache: {e}")
+
+
+def user_generation(user_id: str):
+    """The user's generation, or None when it can't be known and the cache has to be bypassed.
+
+    Read it once before computing a value and pass it to both the lookup and
+    the store, so a value computed across a change is stored under the
+    generation it was computed for, which the change already made stale.
+    """
+    if time.time() < _generations_down_until:
+        return None
+    try:
+        return int(get_jobs_redis_connection().get(USER_GENERATION_KEY.format(user_id)) or 0)
+    except RedisError as e:
+        _mark_generations_down(e)
+        return None
+
+
+def _get_user_value(namespace: str, user_id: str, generation: Optional[int], name: str):
+    if generation is None:
+        _count(namespace, "misses")
+        return None
+    key = USER_CACHE_KEY.format(namespace, user_id, generation, name)
+    value = None
+    r = cache_redis()
+    if r is not None:
+        try:
+            cached = r.get(key)
+            if cached is not None:
+                value = json.loads(cached)
+        except RedisError as e:
+            mark_redis_down(e)
+            value = _local_values.get(key)
+    else:
+        value = _local_values.get(key)
+
+    _count(namespace, "hits" if value is not None else "misses")
+    return value
+
+
+def _set_user_value(namespace: str, user_id: str, generation: Optional[int], name: str, value, ttl: int):
+    if generation is None:
+        return
+    key = USER_CACHE_KEY.format(namespace, user_id, generation, name)
+    r = cache_redis()
+    if r is not None:
+        try:
+            r.set(key, json.dumps(value), ex=ttl)
+            return
+        except RedisError as e:
+            mark_redis_down(e)
+    _local_values.set(key, value, ttl=ttl)
+
+
+def get_cached_search(user_id: str, generation: Optional[int], query: str, params: Optional[dict] = None):
+    """Return cached results for this user's query, or None on a miss."""
+    return _get_user_value("search", user_id, generation, _params_digest(query, params))
+
+
+def set_cached_search(user_id: str, generation: Optional[int], query: str, results: list,
+                      params: Optional[dict] = None):
+    _set_user_value("search", user_id, generation, _params_digest(query, params), results, settings.SEARCH_CACHE_TTL)
+
+
+def get_cached_saved_page(user_id: str, generation: Optional[int], limit: int):
+    """Return the cached first page of the user's saved list, or None on a miss."""
+    return _get_user_value("all_saved", user_id, generation, str(limit))
+
+
+def set_cached_saved_page(user_id: str, generation: Optional[int], limit: int, page: dict):
+    _set_user_value("all_saved", user_id, generation, str(limit), page, settings.ALL_SAVED_CACHE_TTL)
+
+
+def invalidate_user_cache(user_id: str):
+    """Bump the user's generation so everything cached for them goes stale.
+
+    Raises if the bump can't be written, so the change that needed it fails
+    and is retried instead of hiding behind cached values until they expire.
+    """
+    try:
+        get_jobs_redis_connection().incr(USER_GENERATION_KEY.format(user_id))
+    except RedisError as e:
+        _mark_generations_down(e)
+        raise
+
+
+def cache_stats():
+    """Hit rates per cached namespace."""
+    with _lock:
+        stats = {namespace: dict(counts) for namespace, counts in _stats.items()}
+    for counts in stats.values():
+        lookups = counts["hits"] + counts["misses"]
+        counts["hit_rate"] = counts["hits"] / lookups if lookups else 0.0
+    stats["redis_errors"] = _redis_errors
+    stats["local_entries"] = len(_local_values)
+    return stats
@@ -0,0 +1,105 @@
+from collections import deque
+from typing import Callable, Iterator, List, Optional
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+def token_length(encoding_name: str = "cl100k_base") -> Callable[[str], int]:
+    """A length function counting tokens instead of characters. Needs tiktoken."""
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError("token based chunk sizes need tiktoken, install it with `pip install tiktoken`")
+    encoding = tiktoken.get_encoding(encoding_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _iter_splits(text: str, separator: str) -> Iterator[str]:
+    """Split on separator lazily, keeping the separator at the start of the following piece."""
+    if separator == "":
+        yield from text
+        return
+    start = 0
+    pos = text.find(separator)
+    while pos != -1:
+        if pos > start:
+            yield text[start:pos]
+        start = pos
+        pos = text.find(separator, pos + len(separator))
+    if start < len(text):
+        yield text[start:]
+
+
+class TextChunker:
+    """Recursive separator chunker, equivalent to LangChain's RecursiveCharacterTextSplitter.
+
+    Text is split on the first separator it contains and pieces are merged back
+    into chunks of at most chunk_size, with up to chunk_overlap carried over
+    between neighbours. Pieces that are still too large are split again on the
+    next separator. Chunks are yielded as soon as they are complete, so very
+    large texts never need an intermediate list of pieces.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 200,
+        separators: Optional[List[str]] = None,
+        length_function: Callable[[str], int] = len,
+    ):
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) is larger than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or DEFAULT_SEPARATORS
+        self.length_function = length_function
+
+    def split_text(self, text: str) -> List[str]:
+        return list(self.iter_chunks(text))
+
+    def iter_chunks(self, text: str) -> Iterator[str]:
+        yield from self._split(text, self.separators)
+
+    def _split(self, text: str, separators: List[str]) -> Iterator[str]:
+        separator, remaining = separators[-1], []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator, remaining = candidate, separators[i + 1:]
+                break
+
+        current = deque()
+        total = 0
+        for piece in _iter_splits(text, separator):
+            length = self.length_function(piece)
+            if length < self.chunk_size:
+                if current and total + length > self.chunk_size:
+                    chunk = self._join(current)
+                    if chunk:
+                        yield chunk
+                    while current and (total > self.chunk_overlap or total + length > self.chunk_size):
+                        total -= current.popleft()[1]
+                current.append((piece, length))
+                total += length
+                continue
+
+            # a piece that is too large ends the current run of small pieces
+            chunk = self._join(current)
+            if chunk:
+                yield chunk
+            current.clear()
+            total = 0
+            if remaining:
+                yield from self._split(piece, remaining)
+            else:
+                yield piece
+
+        chunk = self._join(current)
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _join(pieces) -> str:
+        return "".join(piece for piece, _ in pieces).strip()
@@ -1,39 +1,142 @@
+import threading
+
 import weaviate
 from config import settings
 import redis
 from mixpanel import Mixpanel, Consumer
-from supabase import create_client
+from supabase import ClientOptions, create_client
 
+from logger import get_logger
 
-def indexer_weaviate_client():
+logger = get_logger(__name__)
+
+# Process-wide clients, created once per worker in the FastAPI lifespan.
+# Anything that runs outside the app (RQ workers, scripts) falls back to
+# building a client on demand.
+_registry = {}
+# weaviate.Client.batch keeps per-client state, so indexing threads each get
+# their own client instead of sharing the query one.
+_indexer_local = threading.local()
+_indexer_clients = []
+_indexer_lock = threading.Lock()
+
+
+def _build_weaviate_client():
     return weaviate.Client(
         url=settings.WEAVIATE_URL,
         auth_client_secret=weaviate.AuthApiKey(api_key=settings.WEAVIATE_API_KEY),
+        timeout_config=(settings.WEAVIATE_CONNECT_TIMEOUT, settings.WEAVIATE_READ_TIMEOUT),
         additional_headers={
             "X-OpenAI-Api-Key": settings.OPENAI_API_KEY,
             "X-Huggingface-Api-Key": settings.HUGGINGFACE_API_KEY,
             "X-Cohere-Api-Key": settings.COHERE_API_KEY
-        }
+        },
+        additional_config=weaviate.Config(
+            connection_config=weaviate.ConnectionConfig(
+                session_pool_connections=settings.WEAVIATE_POOL_CONNECTIONS,
+                session_pool_maxsize=settings.WEAVIATE_POOL_MAXSIZE,
+            )
+        ),
     )
 
-# @lru_cache
-def query_weaviate_client():
-    return weaviate.Client(
-        url=settings.WEAVIATE_URL,
-        auth_client_secret=weaviate.AuthApiKey(api_key=settings.WEAVIATE_API_KEY),
-        additional_headers={
-            "X-OpenAI-Api-Key": settings.OPENAI_API_KEY,
-            "X-Huggingface-Api-Key": settings.HUGGINGFACE_API_KEY,
-            "X-Cohere-Api-Key": settings.COHERE_API_KEY
-        }
+
+def _build_redis_connection():
+    pool = redis.ConnectionPool(
+        host='localhost', port=6379, db=0,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
     )
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def _build_mixpanel_client():
+    consumer = Consumer(api_host="api-eu.mixpanel.com", request_timeout=settings.MIXPANEL_TIMEOUT)
+    return Mixpanel(settings.MIXPANEL_TOKEN, consumer=consumer)
+
+
+def _build_supabase_client():
+    options = ClientOptions(postgrest_client_timeout=settings.SUPABASE_TIMEOUT)
+    return create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY, options=options)
+
+
+def init_clients():
+    """Create the shared clients for this worker. Called from the lifespan."""
+    _registry["weaviate"] = _build_weaviate_client()
+    _registry["redis"] = _build_redis_connection()
+    _registry["jobs_redis"] = redis.Redis(host=settings.JOBS_QUEUE, port=6379, db=0)
+    _registry["supabase"] = _build_supabase_client()
+    logger.info("Initialised pooled clients")
+
+
+def close_clients():
+    """Close every pooled client. Called from the lifespan on shutdown."""
+    with _indexer_lock:
+        clients = _indexer_clients[:]
+        _indexer_clients.clear()
+    if "weaviate" in _registry:
+        clients.append(_registry["weaviate"])
+    for client in clients:
+        try:
+            client._connection.close()
+        except Exception as e:
+            logger.error(f"Error {e} closing weaviate client")
+
+    for name in ("redis", "jobs_redis"):
+        if name in _registry:
+            _registry[name].connection_pool.disconnect()
+    if "supabase" in _registry:
+        try:
+            _registry["supabase"].postgrest.aclose()
+        except Exception as e:
+            logger.error(f"Error {e} closing supabase client")
+
+    _registry.clear()
+    logger.info("Closed pooled clients")
+
+
+def indexer_weaviate_client():
+    if not _registry:
+        return _build_weaviate_client()
+    client = getattr(_indexer_local, "client", None)
+    # a client left over from before a restart of the registry is closed
+    if client is None or _indexer_local.registry is not _registry.get("weaviate"):
+        client = _build_weaviate_client()
+        _indexer_local.client = client
+        _indexer_local.registry = _registry.get("weaviate")
+        with _indexer_lock:
+            _indexer_clients.append(client)
+    return client
+
+
+def query_weaviate_client():
+    client = _registry.get("weaviate")
+    if client is None:
+        return _build_weaviate_client()
+    return client
 
 
 def get_redis_connection():
-    return redis.StrictRedis(host='localhost', port=6379, db=0)
+    connection = _registry.get("redis")
+    if connection is None:
+        return _build_redis_connection()
+    return connection
+
+
+def get_jobs_redis_connection():
+    """The Redis that RQ jobs and their progress live in."""
+    connection = _registry.get("jobs_redis")
+    if connection is None:
+        return redis.Redis(host=settings.JOBS_QUEUE, port=6379, db=0)
+    return connection
+
 
 def get_mixpanel_client():
-    return Mixpanel(settings.MIXPANEL_TOKEN, consumer=Consumer(api_host="api-eu.mixpanel.com"))
+    # events go through analytics.track, this is for one-off calls like people_set
+    return _build_mixpanel_client()
+
 
 def get_supabase_client():
-    return create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
\ No newline at end of file
+    supabase = _registry.get("supabase")
+    if supabase is None:
+        return _build_supabase_client()
+    return supabase
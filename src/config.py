@@ -1,4 +1,5 @@
 # from pydantic import BaseSettings
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -27,6 +28,109 @@ class Settings(BaseSettings):
     MIXPANEL_TOKEN: str
     JOBS_QUEUE: str
     LEMON_SQUEEZY_SECRET: str
+    WEAVIATE_POOL_CONNECTIONS: int = 20
+    WEAVIATE_POOL_MAXSIZE: int = 100
+    WEAVIATE_CONNECT_TIMEOUT: int = 5
+    WEAVIATE_READ_TIMEOUT: int = 60
+    SUPABASE_TIMEOUT: int = 10
+    MIXPANEL_TIMEOUT: int = 10
+    # point at a local stub to test analytics without Mixpanel
+    MIXPANEL_EVENTS_URL: Optional[str] = None
+    ANALYTICS_QUEUE_SIZE: int = 10000
+    ANALYTICS_FLUSH_INTERVAL: float = 1
+    ANALYTICS_BATCH_WAIT: float = 0.5
+    ANALYTICS_MAX_RETRIES: int = 3
+    ANALYTICS_RETRY_BACKOFF: float = 0.5
+    ANALYTICS_SHUTDOWN_TIMEOUT: float = 10
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_SOCKET_TIMEOUT: int = 5
+    SEARCH_MAX_WORKERS: int = 16
+    SEARCH_PAGE_SIZE: int = 10
+    SEARCH_MAX_PAGE_SIZE: int = 50
+    SEARCH_SNIPPET_CHARS: int = 300
+    COHERE_RERANK_URL: str = "https://api.cohere.ai/v1/rerank"
+    RERANK_MODEL: str = "rerank-english-v2.0"
+    RERANK_TIMEOUT: int = 10
+    CHUNK_SIZE: int = 1024
+    CHUNK_OVERLAP: int = 200
+    # a tiktoken encoding name switches chunk sizes from characters to tokens
+    CHUNK_TOKEN_ENCODING: Optional[str] = None
+    INDEX_BATCH_SIZE: int = 100
+    INDEX_NUM_WORKERS: int = 2
+    INDEX_DYNAMIC_BATCHING: bool = True
+    INTERACTIVE_QUEUE: str = "index-interactive"
+    BULK_QUEUE: str = "index-bulk"
+    INDEX_COALESCE_MAX: int = 50
+    # tries of a queued document that keeps failing before it's marked failed
+    INDEX_MAX_ATTEMPTS: int = 3
+    INDEX_JOB_TIMEOUT: int = 600
+    INDEX_STATUS_TTL: int = 60 * 60 * 24
+    SEARCH_CACHE_TTL: int = 600
+    SEARCH_CACHE_MAX_ENTRIES: int = 10000
+    CACHE_REDIS_RETRY_AFTER: int = 30
+    SINGLE_FLIGHT_REDIS: bool = False
+    SINGLE_FLIGHT_TTL: float = 30
+    SINGLE_FLIGHT_RESULT_TTL: float = 2
+    SINGLE_FLIGHT_POLL_INTERVAL: float = 0.02
+    SEARCH_LOG_DIR: str = "search_logs"
+    SEARCH_LOG_QUEUE_SIZE: int = 10000
+    SEARCH_LOG_BATCH_SIZE: int = 500
+    SEARCH_LOG_MAX_BYTES: int = 64 * 1024 * 1024
+    SEARCH_LOG_ROTATE_SECONDS: int = 60 * 60 * 24
+    ALL_SAVED_PAGE_SIZE: int = 100
+    ALL_SAVED_MAX_PAGE_SIZE: int = 1000
+    ALL_SAVED_CACHE_TTL: int = 600
+    OPENAI_EMBEDDING_URL: str = "https://api.openai.com/v1/embeddings"
+    EMBEDDING_MODEL: str = "text-embedding-ada-002"
+    EMBEDDING_TIMEOUT: int = 20
+    EMBEDDING_BATCH_SIZE: int = 256
+    EMBEDDING_CACHE_TTL: int = 60 * 60 * 24 * 30
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 2000
+    IMPORT_CONCURRENCY: int = 16
+    IMPORT_PER_HOST_CONCURRENCY: int = 2
+    IMPORT_PER_HOST_DELAY: float = 0.5
+    IMPORT_FETCH_TIMEOUT: int = 15
+    IMPORT_MAX_PAGE_BYTES: int = 2 * 1024 * 1024
+    IMPORT_BATCH_DOCUMENTS: int = 25
+    IMPORT_PROGRESS_TTL: int = 60 * 60 * 24 * 7
+    IMPORT_JOB_TIMEOUT: int = 60 * 60
+    SENTRY_TRACES_SAMPLE_RATE: float = 1.0
+    SENTRY_PROFILES_SAMPLE_RATE: float = 1.0
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_MAX_TTL: int = 300
+    SAVED_INDEX_TTL: int = 60 * 60 * 24 * 7
+    SAVED_INDEX_BLOOM: bool = False
+    SAVED_INDEX_BLOOM_TTL: int = 30
+    SAVED_INDEX_BLOOM_ERROR_RATE: float = 0.01
+    SAVED_INDEX_BLOOM_MAX_USERS: int = 10000
+    # "skip" or "merge" near-duplicate saves, merging also answers later saves of that url
+    NEAR_DUP_ACTION: str = "merge"
+    NEAR_DUP_MAX_DISTANCE: int = 3
+    NEAR_DUP_MIN_WORDS: int = 50
+    # shared classes with a tenant per user instead of two classes per user
+    WEAVIATE_MULTI_TENANCY: bool = False
+    SHARED_SOURCE_CLASS: str = "KnowledgeSource"
+    SHARED_CONTENT_CLASS: str = "Content"
+    TENANT_IDLE_SECONDS: int = 60 * 60 * 24 * 14
+    TENANT_OFFLOAD_STATUS: str = "COLD"
+    MIGRATION_BATCH_SIZE: int = 200
+    # source_id, uri and title on every chunk instead of hasCategory/chunk_refs references
+    DENORMALIZED_CHUNKS: bool = False
+    # set once backfill_chunks.py status shows every user backfilled, until then
+    # chunk deletes also match chunks by their hasCategory reference
+    CHUNKS_BACKFILLED: bool = False
+    MAX_CHUNKS_PER_SOURCE: int = 10000
+    # sources deleted per round of server-side batch deletes, and per request at most
+    DELETE_BATCH_SIZE: int = 100
+    DELETE_MAX_IDS: int = 10000
+    # saved_uris rows deleted per statement when purging a user
+    PURGE_BATCH_SIZE: int = 500
+    PURGE_JOB_TIMEOUT: int = 60 * 60
+    PURGE_STATUS_TTL: int = 60 * 60 * 24 * 7
+    # how long a purge waits for drains and imports already writing the user's data
+    PURGE_WRITERS_WAIT: int = 300
+    # pages per /api/save_batch call, no more than INDEX_COALESCE_MAX so one drain pass indexes them
+    SAVE_BATCH_MAX: int = 50
     model_config = SettingsConfigDict(env_file=".env")
 
 settings = Settings()
\ No newline at end of file
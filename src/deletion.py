@@ -0,0 +1,105 @@
+from cache import invalidate_user_cache
+from client import get_supabase_client
+from config import settings
+from logger import get_logger
+from metrics import timed
+from near_dup import remove_fingerprints
+from saved_index import remove_saved
+from tenancy import touch_tenant, user_classes, user_tenant, with_tenant
+from urls import canonical_url
+from utils import convert_user_id
+
+logger = get_logger(__name__)
+
+DELETED = "deleted"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+
+def chunks_filter(source_class: str, source_ids: list):
+    """Filter matching every chunk of the given sources, evaluated by Weaviate."""
+    by_reference = {"path": ["hasCategory", source_class, "id"], "operator": "ContainsAny",
+                    "valueTextArray": source_ids}
+    if not settings.DENORMALIZED_CHUNKS:
+        return by_reference
+    by_property = {"path": ["source_id"], "operator": "ContainsAny", "valueTextArray": source_ids}
+    if settings.CHUNKS_BACKFILLED:
+        return by_property
+    # chunks not backfilled yet have only the reference, chunks written since only the property
+    return {"operator": "Or", "operands": [by_property, by_reference]}
+
+
+def delete_where(client, class_name: str, where: dict, tenant: str = None):
+    """Batch-delete everything matching, in as many passes as the server's per-request limit needs."""
+    deleted = 0
+    while True:
+        response = client.batch.delete_objects(class_name, where=where, output="minimal", tenant=tenant)
+        results = response["results"]
+        if results["failed"]:
+            raise RuntimeError(f"{results['failed']} objects of {class_name} failed to delete")
+        deleted += results["successful"]
+        if not results["successful"] or results["successful"] < results["limit"]:
+            return deleted
+
+
+def _find_sources(client, user_id: str, source_class: str, source_ids: list):
+    response = (
+        with_tenant(client.query.get(source_class, ["uri"]), user_id)
+            .with_where({"path": ["id"], "operator": "ContainsAny", "valueTextArray": source_ids})
+            .with_additional(["id"])
+            .with_limit(len(source_ids))
+            .do()
+    )
+    return {source["_additional"]["id"]: source["uri"] for source in response["data"]["Get"][source_class]}
+
+
+def delete_sources(client, user_id: str, source_ids: list, delete_rows: bool = True):
+    """Delete sources, their chunks and their saved_uris rows, DELETE_BATCH_SIZE sources at a time.
+
+    Pass delete_rows=False when the rows are already gone. Returns the status
+    of each id: deleted, not_found or failed. Weaviate goes first and the rows
+    last, so a failed batch can simply be deleted again.
+    """
+    source_class, content_class = user_classes(user_id)
+    tenant = user_tenant(user_id)
+    touch_tenant(client, user_id)
+    statuses = {}
+    supabase = get_supabase_client() if delete_rows else None
+    source_ids = list(dict.fromkeys(source_ids))
+    for start in range(0, len(source_ids), settings.DELETE_BATCH_SIZE):
+        batch_ids = source_ids[start:start + settings.DELETE_BATCH_SIZE]
+        try:
+            with timed("delete", "lookup"):
+                found = _find_sources(client, user_id, source_class, batch_ids)
+            if found:
+                # chunks first, so a failure never leaves chunks without their source
+                with timed("delete", "chunks"):
+                    chunks = delete_where(client, content_class, chunks_filter(source_class, list(found)), tenant)
+                with timed("delete", "sources"):
+                    delete_where(client, source_class,
+                                 {"path": ["id"], "operator": "ContainsAny", "valueTextArray": list(found)}, tenant)
+                logger.info(f"Deleted {len(found)} sources and {chunks} chunks for {user_id}")
+            rows = []
+            if delete_rows:
+                with timed("delete", "saved_uris"):
+                    rows = (
+                        supabase.table("saved_uris")
+                            .delete()
+                            .eq("user_id", convert_user_id(user_id))
+                            .in_("id", batch_ids)
+                            .execute()
+                            .data
+                    )
+        except Exception as e:
+            logger.error(f"Error {e} deleting {len(batch_ids)} sources for {user_id}")
+            statuses.update((source_id, FAILED) for source_id in batch_ids)
+            continue
+        # a row can outlive its source, or exist without one if indexing failed
+        deleted = {**{row["id"]: row["url"] for row in rows}, **found}
+        statuses.update((source_id, DELETED if source_id in deleted else NOT_FOUND) for source_id in batch_ids)
+        remove_saved(user_id, list({canonical_url(url) for url in deleted.values()}))
+        remove_fingerprints(user_id, list(deleted))
+
+    # whatever was deleted, so a retry after a failed bump bumps again
+    invalidate_user_cache(user_id)
+    return statuses
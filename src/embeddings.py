@@ -0,0 +1,159 @@
+import hashlib
+import threading
+import time
+from array import array
+from typing import List, Optional
+
+import requests
+from redis import RedisError
+
+from cache import LRUCache, cache_redis, mark_redis_down
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+EMBEDDING_KEY = "emb:{}"
+
+_session = requests.Session()
+# Vectors are kept as packed float32 bytes, locally and in Redis.
+_local_vectors = LRUCache(settings.EMBEDDING_CACHE_MAX_ENTRIES)
+_stats = {
+    kind: {"hits": 0, "misses": 0, "embedding_calls": 0, "embedding_seconds": 0.0}
+    for kind in ("query", "chunk")
+}
+_lock = threading.Lock()
+
+
+def embedding_digest(text: str):
+    """Content address of a text's vector: the model and the exact text."""
+    return hashlib.sha256(f"{settings.EMBEDDING_MODEL}\n{text}".encode()).hexdigest()
+
+
+def _pack(vector: List[float]):
+    return array("f", vector).tobytes()
+
+
+def _unpack(raw: bytes):
+    vector = array("f")
+    vector.frombytes(raw)
+    return vector.tolist()
+
+
+def _openai_embed(texts: List[str]):
+    response = _session.post(
+        settings.OPENAI_EMBEDDING_URL,
+        json={"model": settings.EMBEDDING_MODEL, "input": texts},
+        headers={"Authorization": f"Bearer {settings.OPENAI_API_KEY}"},
+        timeout=settings.EMBEDDING_TIMEOUT,
+    )
+    response.raise_for_status()
+    data = sorted(response.json()["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in data]
+
+
+def _lookup(digests: List[str]):
+    vectors = {}
+    missing = []
+    for digest in digests:
+        raw = _local_vectors.get(digest)
+        if raw is not None:
+            vectors[digest] = _unpack(raw)
+        else:
+            missing.append(digest)
+
+    r = cache_redis()
+    if missing and r is not None:
+        try:
+            for digest, raw in zip(missing, r.mget([EMBEDDING_KEY.format(d) for d in missing])):
+                if raw is not None:
+                    vectors[digest] = _unpack(raw)
+                    _local_vectors.set(digest, raw)
+        except RedisError as e:
+            mark_redis_down(e)
+    return vectors
+
+
+def _store(new_vectors: dict):
+    packed = {digest: _pack(vector) for digest, vector in new_vectors.items()}
+    for digest, raw in packed.items():
+        _local_vectors.set(digest, raw)
+    r = cache_redis()
+    if r is None:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        for digest, raw in packed.items():
+            pipe.set(EMBEDDING_KEY.format(digest), raw, ex=settings.EMBEDDING_CACHE_TTL)
+        pipe.execute()
+    except RedisError as e:
+        mark_redis_down(e)
+
+
+def get_embeddings(texts: List[str], kind: str = "chunk"):
+    """Vectors for texts, embedding only the ones no worker has embedded before.
+
+    Identical texts, within the call or across the deployment, are embedded once.
+    """
+    digests = [embedding_digest(text) for text in texts]
+    vectors = _lookup(list(set(digests)))
+
+    to_embed = {}
+    for digest, text in zip(digests, texts):
+        if digest not in vectors:
+            to_embed.setdefault(digest, text)
+
+    with _lock:
+        _stats[kind]["hits"] += len(texts) - len(to_embed)
+        _stats[kind]["misses"] += len(to_embed)
+
+    new_vectors = {}
+    pending = list(to_embed.items())
+    for i in range(0, len(pending), settings.EMBEDDING_BATCH_SIZE):
+        batch = pending[i:i + settings.EMBEDDING_BATCH_SIZE]
+        start = time.perf_counter()
+        embedded = _openai_embed([text for _, text in batch])
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _stats[kind]["embedding_calls"] += 1
+            _stats[kind]["embedding_seconds"] += elapsed
+        for (digest, _), vector in zip(batch, embedded):
+            new_vectors[digest] = vector
+
+    if new_vectors:
+        _store(new_vectors)
+        vectors.update(new_vectors)
+    return [vectors[digest] for digest in digests]
+
+
+def embed_query(query: str) -> Optional[List[float]]:
+    """The query's vector, or None so the caller can let Weaviate vectorize it."""
+    try:
+        return get_embeddings([query], kind="query")[0]
+    except Exception as e:
+        logger.error(f"Error {e} embedding query, falling back to server-side vectorization")
+        return None
+
+
+def embed_chunks(chunks: List[str]):
+    """Vectors for a document's chunks, or None so Weaviate vectorizes them itself."""
+    try:
+        return get_embeddings(chunks, kind="chunk")
+    except Exception as e:
+        logger.error(f"Error {e} embedding {len(chunks)} chunks, falling back to server-side vectorization")
+        return None
+
+
+def embedding_cache_stats():
+    """Per kind ("query", "chunk") hit rates and the embedding work they saved."""
+    with _lock:
+        stats = {kind: dict(counts) for kind, counts in _stats.items()}
+    for counts in stats.values():
+        lookups = counts["hits"] + counts["misses"]
+        # for chunks, the share of texts that never needed embedding
+        counts["hit_rate"] = counts["hits"] / lookups if lookups else 0.0
+        texts_per_call = counts["misses"] / counts["embedding_calls"] if counts["embedding_calls"] else 0.0
+        seconds_per_text = counts["embedding_seconds"] / counts["misses"] if counts["misses"] else 0.0
+        counts["embedding_calls_saved"] = counts["hits"] / texts_per_call if texts_per_call else 0.0
+        counts["seconds_saved"] = counts["hits"] * seconds_per_text
+    return stats
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+import httpx
+
+from client import get_jobs_redis_connection
+from config import settings
+from indexer import index_many
+from logger import get_logger
+from purge import writing
+from saved_index import find_saved
+from urls import canonical_url
+from utils import convert_user_id
+
+logger = get_logger(__name__)
+
+IMPORT_PROGRESS_KEY = "import:{}"
+IMPORT_DONE_KEY = "import:{}:done"
+IMPORT_FAILED_KEY = "import:{}:failed"
+
+_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "head"}
+# PDFs, images and downloads aren't read, only pages and plain text
+_TEXT_TYPES = {"text/html", "text/plain"}
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.title = ""
+        self.parts = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        elif tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag in _SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth:
+            text = data.strip()
+            if text:
+                self.parts.append(text)
+
+
+def extract_text(html: str):
+    """Return (title, text) of an HTML page."""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.title.strip(), "\n".join(parser.parts)
+
+
+def iter_links(bookmarks: list):
+    """Yield every link with a url in the bookmark tree, depth first, without building a flat list."""
+    stack = [iter(bookmarks or [])]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            continue
+        if node.get("url"):
+            yield node
+        if node.get("links"):
+            stack.append(iter(node["links"]))
+
+
+class _HostLimiter:
+    """Caps in-flight requests per host and spaces them out."""
+
+    def __init__(self, per_host: int, delay: float):
+        self.per_host = per_host
+        self.delay = delay
+        self._semaphores = {}
+        self._next_slot = {}
+
+    async def __call__(self, host: str):
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.per_host))
+        await semaphore.acquire()
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(host, now))
+        self._next_slot[host] = slot + self.delay
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return semaphore
+
+
+async def _fetch(http: httpx.AsyncClient, limiter: _HostLimiter, link: dict):
+    """Fetch a bookmarked page. Raises with the reason if it can't be read as text."""
+    semaphore = await limiter(urlparse(link["url"]).netloc)
+    try:
+        body = bytearray()
+        async with http.stream("GET", link["url"]) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            if content_type not in _TEXT_TYPES:
+                # checked before the body is read, so a download isn't fetched just to be dropped
+                raise ValueError(f"unsupported content type {content_type or 'none'}")
+            async for part in response.aiter_bytes():
+                body.extend(part)
+                if len(body) >= settings.IMPORT_MAX_PAGE_BYTES:
+                    break
+            encoding = response.encoding or "utf-8"
+    finally:
+        semaphore.release()
+
+    body = body.decode(encoding, errors="replace")
+    if content_type == "text/plain":
+        title, text = "", body.strip()
+    else:
+        title, text = extract_text(body)
+    return {
+        "url": link["url"],
+        "title": link.get("name") or title or link["url"],
+        "content": text,
+    }
+
+
+class _Progress:
+    def __init__(self, record_id: str):
+        self.redis = get_jobs_redis_connection()
+        self.key = IMPORT_PROGRESS_KEY.format(record_id)
+        self.done_key = IMPORT_DONE_KEY.format(record_id)
+        self.failed_key = IMPORT_FAILED_KEY.format(record_id)
+
+    def is_done(self, link_id: str):
+        return self.redis.sismember(self.done_key, link_id)
+
+    def update(self, status: str = None, **counts):
+        pipe = self.redis.pipeline()
+        for field, amount in counts.items():
+            pipe.hincrby(self.key, field, amount)
+        if status:
+            pipe.hset(self.key, "status", status)
+        pipe.hset(self.key, "updated_at", int(time.time()))
+        for key in (self.key, self.done_key, self.failed_key):
+            pipe.expire(key, settings.IMPORT_PROGRESS_TTL)
+        pipe.execute()
+
+    def checkpoint(self, link_ids: list, **counts):
+        if link_ids:
+            self.redis.sadd(self.done_key, *link_ids)
+        self.update(**counts)
+
+    def fail(self, link: dict, error: str):
+        self.redis.hset(self.failed_key, link["id"], f"{link['url']}: {error}"[:500])
+        self.checkpoint([link["id"]], failed=1)
+
+
+def _index_batch(batch: list, user_id: str, progress: _Progress):
+    with writing(user_id, progress.redis) as allowed:
+        if not allowed:
+            # the account is being deleted, don't index anything more for it
+            progress.checkpoint([link_id for link_id, _ in batch], skipped=len(batch))
+            return
+        _index_allowed_batch(batch, user_id, progress)
+
+
+def _index_allowed_batch(batch: list, user_id: str, progress: _Progress):
+    link_ids = [link_id for link_id, _ in batch]
+    saved = find_saved(user_id, [doc["url"] for _, doc in batch])
+    pending = [(link_id, doc) for link_id, doc in batch if canonical_url(doc["url"]) not in saved and doc["content"]]
+    results = index_many([doc for _, doc in pending], user_id) if pending else []
+    failed = {}
+    for (link_id, doc), result in zip(pending, results):
+        if result["status"] == "failed":
+            failed[link_id] = f"{doc['url']}: {'; '.join(map(str, result['errors'])) or 'indexing failed'}"[:500]
+    if failed:
+        # recorded as failed rather than counted as indexed
+        progress.redis.hset(progress.failed_key, mapping=failed)
+    progress.checkpoint(link_ids, indexed=len(pending) - len(failed), failed=len(failed),
+                        skipped=len(batch) - len(pending))
+
+
+async def _import(payload: dict):
+    record = payload["record"]
+    user_id = convert_user_id(record["user_id"])
+    progress = _Progress(record["id"])
+    progress.redis.hset(progress.key, "seen", 0)
+    progress.update(status="running")
+
+    links = asyncio.Queue(maxsize=settings.IMPORT_CONCURRENCY * 2)
+    documents = asyncio.Queue(maxsize=settings.IMPORT_BATCH_DOCUMENTS)
+    limiter = _HostLimiter(settings.IMPORT_PER_HOST_CONCURRENCY, settings.IMPORT_PER_HOST_DELAY)
+
+    async def fetcher(http):
+        while True:
+            link = await links.get()
+            if link is None:
+                return
+            try:
+                document = await _fetch(http, limiter, link)
+                await documents.put((link["id"], document))
+            except Exception as e:
+                logger.info(f"Import {record['id']} failed to fetch {link['url']}: {e}")
+                progress.fail(link, str(e))
+
+    failed_batches = 0
+
+    async def batcher():
+        nonlocal failed_batches
+        batch = []
+        while True:
+            item = await documents.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= settings.IMPORT_BATCH_DOCUMENTS):
+                try:
+                    await asyncio.to_thread(_index_batch, batch, user_id, progress)
+                except Exception as e:
+                    # not checkpointed, so a retry of the job picks these links up again
+                    failed_batches += 1
+                    logger.error(f"Error {e} indexing an import batch of {len(batch)} for {user_id}")
+                batch = []
+            if item is None:
+                return
+
+    timeout = httpx.Timeout(settings.IMPORT_FETCH_TIMEOUT)
+    limits = httpx.Limits(max_connections=settings.IMPORT_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=True) as http:
+        fetchers = [asyncio.create_task(fetcher(http)) for _ in range(settings.IMPORT_CONCURRENCY)]
+        indexing = asyncio.create_task(batcher())
+
+        seen_urls = set()
+        for link in iter_links(record.get("bookmarks")):
+            # fetched as bookmarked, deduplicated by canonical url
+            url = link["url"].strip()
+            if not url.startswith(("http://", "https://")) or canonical_url(url) in seen_urls:
+                continue
+            seen_urls.add(canonical_url(url))
+            progress.update(seen=1)
+            if progress.is_done(link["id"]):
+                continue
+            await links.put({"id": link["id"], "url": url, "name": link.get("name")})
+
+        for _ in fetchers:
+            await links.put(None)
+        await asyncio.gather(*fetchers)
+        await documents.put(None)
+        await indexing
+
+    if failed_batches:
+        raise RuntimeError(f"{failed_batches} import batches failed for {user_id}")
+    progress.update(status="done")
+
+
+def importer(payload: dict):
+    """RQ job: import a user's bookmark tree. Safe to retry, finished links are skipped."""
+    logger.info(f"Importing bookmarks for record {payload['record']['id']}")
+    try:
+        asyncio.run(_import(payload))
+    except Exception:
+        _Progress(payload["record"]["id"]).update(status="failed")
+        raise
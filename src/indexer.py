@@ -1,76 +1,390 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from urllib.parse import urlparse
+import hashlib
+import threading
+import uuid
 
+from cache import invalidate_user_cache
+from chunker import TextChunker, token_length
 from logger import get_logger
 from config import settings
+from deletion import chunks_filter
+from embeddings import embed_chunks
+from metrics import timed
+from near_dup import Fingerprints, set_fingerprint, simhash
+from saved_index import add_saved
+from tenancy import ensure_tenant, touch_tenant, user_classes, user_tenant, with_tenant
 from client import get_supabase_client, indexer_weaviate_client
+from urls import canonical_url, strip_fragment, url_variants
 from utils import convert_user_id, get_failed_exception
+from weaviate_batch import configure_batch
 
 logger = get_logger(__name__)
 
 
+text_chunker = TextChunker(
+    chunk_size=settings.CHUNK_SIZE,
+    chunk_overlap=settings.CHUNK_OVERLAP,
+    length_function=token_length(settings.CHUNK_TOKEN_ENCODING) if settings.CHUNK_TOKEN_ENCODING else len,
+)
+
+
+@timed("index", "chunk")
 def preprocess(document: dict):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1024)
-    texts = text_splitter.split_text(document["content"])
-    return texts
+    return text_chunker.split_text(document["content"])
+
+
+def chunk_properties(chunk: str, source_id: str, uri: str, title: str):
+    properties = {'source_content': chunk}
+    if settings.DENORMALIZED_CHUNKS:
+        properties.update(source_id=source_id, uri=uri, title=title)
+    return properties
+
+
+def source_chunks(client, user_id: str, source_id: str, properties: list):
+    """The chunks of a source, found the way deletes find them, so chunks not backfilled yet are included."""
+    source_class, content_class = user_classes(user_id)
+    response = (
+        with_tenant(client.query.get(content_class, properties), user_id)
+            .with_where(chunks_filter(source_class, [source_id]))
+            .with_additional(["id"])
+            .with_limit(settings.MAX_CHUNKS_PER_SOURCE)
+            .do()
+    )
+    return response["data"]["Get"][content_class]
+
+
+def source_uuid(user_id: str, url: str):
+    """The id of a user's source for a url, the same every time it's indexed."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{user_id}/{canonical_url(url)}"))
+
+
+def add_document(batch, document: dict, source_class: str, content_class: str, tenant: str = None,
+                 source_id: str = None):
+    """Add a source, its chunks and, unless chunks carry their source, the references between them.
 
+    With a source_id the chunk ids derive from it, so adding the same
+    document again overwrites it instead of duplicating it. Returns the
+    source uuid and the chunk uuids.
+    """
+    parent_uuid = batch.add_data_object(
+        data_object={
+            'uri': document["url"],
+            'title': document["title"]
+        },
+        class_name=source_class,
+        uuid=source_id,
+        tenant=tenant,
+    )
+    # identical chunks are embedded once across the deployment
+    with timed("index", "embed"):
+        vectors = embed_chunks(document["chunked_content"])
+    chunk_uuids = []
+    for i, chunk in enumerate(document["chunked_content"]):
+        # TODO: better way to handle passage
+        # chunk = "passage: " + chunk
+        chunk_uuid = batch.add_data_object(
+            data_object=chunk_properties(chunk, parent_uuid, document["url"], document["title"]),
+            class_name=content_class,
+            uuid=str(uuid.uuid5(uuid.UUID(source_id), str(i))) if source_id else None,
+            vector=vectors[i] if vectors else None,
+            tenant=tenant,
+        )
+        chunk_uuids.append(chunk_uuid)
+        if settings.DENORMALIZED_CHUNKS:
+            continue
+        batch.add_reference(
+            from_object_uuid=chunk_uuid,
+            from_property_name="hasCategory",
+            to_object_uuid=parent_uuid,
+            from_object_class_name=content_class,
+            to_object_class_name=source_class,
+            tenant=tenant,
+        )
+        batch.add_reference(
+            from_object_uuid=parent_uuid,
+            from_property_name="chunk_refs",
+            to_object_uuid=chunk_uuid,
+            from_object_class_name=source_class,
+            to_object_class_name=content_class,
+            tenant=tenant,
+        )
+    return parent_uuid, chunk_uuids
 
-def indexer(document: dict, user_id: str):
+
+def indexer(document: dict, user_id: str, refresh: bool = False, source_id: str = None):
+    logger.info(f"{user_id} saving {canonical_url(document['url'])}")
+    if refresh:
+        if not refresh_document(document, user_id, source_id):
+            # indexing it afresh could duplicate the source, or find it a near-duplicate of itself
+            logger.error(f"{user_id} has no source {source_id} to refresh for {document['url']}")
+            raise get_failed_exception()
+        return True
+    result = index_many([document], user_id)[0]
+    if result["status"] == "failed":
+        raise get_failed_exception()
+    return True
+
+
+def chunk_hash(chunk: str):
+    return hashlib.sha256(chunk.encode()).hexdigest()
+
+
+def refresh_document(document: dict, user_id: str, source_id: str = None):
+    """Re-index an already saved source, embedding only chunks that changed.
+
+    The source is the one find_saved matched the page to, by id, so a url
+    that differs from the saved one in form still refreshes it. Unchanged
+    chunks are kept, vanished ones deleted and new ones added, then the
+    source's chunk_refs are rewritten in place, unless chunks carry their
+    source. Returns False if the source doesn't exist.
+    """
     client = indexer_weaviate_client()
+    source_class, content_class = user_classes(user_id)
+    tenant = user_tenant(user_id)
     title = document["title"]
-    
-    # Cleaning fragments
-    # https://example.com/#acevvsw vs https://example.com/ should be same
-    uri = document["url"]
-    parsed_uri = urlparse(uri)
-    uri = parsed_uri._replace(fragment="").geturl()
+    if source_id:
+        source_filter = {"path": ["id"], "operator": "Equal", "valueText": source_id}
+    else:
+        # queued before refreshes carried the source id
+        source_filter = {"operator": "Or", "operands": [
+            {"path": ["uri"], "operator": "Equal", "valueText": variant} for variant in url_variants(document["url"])
+        ]}
 
-    logger.info(f"{user_id} saving {uri}")
+    touch_tenant(client, user_id)
+    source_fields = ["uri", "title"]
+    if not settings.DENORMALIZED_CHUNKS:
+        source_fields.append(f"chunk_refs {{ ... on {content_class} {{ source_content _additional {{ id }} }} }}")
+    with timed("refresh", "lookup"):
+        response = (
+            with_tenant(client.query.get(source_class, source_fields), user_id)
+                .with_where(source_filter)
+                .with_additional(["id"])
+                .do()
+        )
+        sources = response["data"]["Get"][source_class]
+        if not sources:
+            return False
+        source = sources[0]
+        parent_uuid = source["_additional"]["id"]
+        # the source keeps the url it was saved with
+        uri = source["uri"]
+        if settings.DENORMALIZED_CHUNKS:
+            current_chunks = source_chunks(client, user_id, parent_uuid, ["source_content"])
+        else:
+            current_chunks = source["chunk_refs"] or []
 
-    document["chunked_content"] = [title]
-    document["chunked_content"].extend(preprocess(document))
+    existing = {}
+    for chunk in current_chunks:
+        existing.setdefault(chunk_hash(chunk["source_content"]), []).append(chunk["_additional"]["id"])
 
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
-    content_class = settings.CONTENT_CLASS.format(user_id)
+    chunks = [title]
+    chunks.extend(preprocess(document))
+    kept, new_chunks = [], []
+    for chunk in chunks:
+        ids = existing.get(chunk_hash(chunk))
+        if ids:
+            kept.append(ids.pop())
+        else:
+            new_chunks.append(chunk)
+    vanished = [chunk_id for ids in existing.values() for chunk_id in ids]
 
     try:
-        client.batch.configure(batch_size=50, num_workers=1, timeout_retries=3, connection_error_retries=3)
-        with client.batch as batch:
-                parent_uuid = batch.add_data_object(
-                    data_object={
-                        'uri': uri,
-                        'title': title
-                    },
-                    class_name=source_class
+        batch_errors = _BatchErrors()
+        configure_batch(client, batch_errors)
+        with timed("refresh", "embed"):
+            vectors = embed_chunks(new_chunks) if new_chunks else None
+        added = []
+        with timed("refresh", "batch_write"), client.batch as batch:
+            for i, chunk in enumerate(new_chunks):
+                chunk_uuid = batch.add_data_object(
+                    data_object=chunk_properties(chunk, parent_uuid, uri, title),
+                    class_name=content_class,
+                    vector=vectors[i] if vectors else None,
+                    tenant=tenant,
+                )
+                batch_errors.owners[chunk_uuid] = parent_uuid
+                added.append(chunk_uuid)
+                if settings.DENORMALIZED_CHUNKS:
+                    continue
+                batch.add_reference(
+                    from_object_uuid=chunk_uuid,
+                    from_property_name="hasCategory",
+                    to_object_uuid=parent_uuid,
+                    from_object_class_name=content_class,
+                    to_object_class_name=source_class,
+                    tenant=tenant,
+                )
+        if batch_errors.errors:
+            # the old chunks and references are untouched, so undoing the new chunks leaves the source as it was
+            if added:
+                client.batch.delete_objects(
+                    content_class,
+                    where={"path": ["id"], "operator": "ContainsAny", "valueTextArray": added},
+                    tenant=tenant,
                 )
-                for i, chunk in enumerate(document["chunked_content"]):
-                    # TODO: better way to handle passage
-                    # chunk = "passage: " + chunk
-                    chunk_uuid = batch.add_data_object(
-                        data_object={
-                            'source_content': chunk,
-                        },
-                        class_name=content_class,
-                    )
-                    batch.add_reference(
-                        from_object_uuid=chunk_uuid,
-                        from_property_name="hasCategory",
-                        to_object_uuid=parent_uuid,
-                        from_object_class_name=content_class,
-                        to_object_class_name=source_class
-                    )
-                    batch.add_reference(
-                        from_object_uuid=parent_uuid,
-                        from_property_name="chunk_refs",
-                        to_object_uuid=chunk_uuid,
-                        from_object_class_name=source_class,
-                        to_object_class_name=content_class
-                    )
+            raise RuntimeError(f"{batch_errors.errors.get(parent_uuid)}")
+
+        if not settings.DENORMALIZED_CHUNKS:
+            with timed("refresh", "references"):
+                client.data_object.reference.update(
+                    from_uuid=parent_uuid,
+                    from_property_name="chunk_refs",
+                    to_uuids=kept + added,
+                    from_class_name=source_class,
+                    to_class_names=content_class,
+                    tenant=tenant,
+                )
+        if vanished:
+            with timed("refresh", "delete_chunks"):
+                client.batch.delete_objects(
+                    content_class,
+                    where={"path": ["id"], "operator": "ContainsAny", "valueTextArray": vanished},
+                    tenant=tenant,
+                )
+        if title != source["title"]:
+            client.data_object.update({"title": title}, class_name=source_class, uuid=parent_uuid, tenant=tenant)
+            if settings.DENORMALIZED_CHUNKS:
+                for chunk_id in kept:
+                    client.data_object.update({"title": title}, class_name=content_class, uuid=chunk_id, tenant=tenant)
+            get_supabase_client().table("saved_uris").update({"title": title}).eq("id", parent_uuid).execute()
+    except Exception as e:
+        logger.error(f"Error {e} in refreshing {uri} for {user_id}")
+        raise get_failed_exception()
+
+    invalidate_user_cache(user_id)
+    if settings.NEAR_DUP_ACTION != "off":
+        set_fingerprint(user_id, parent_uuid, document["content"] or "")
+    logger.info(f"{user_id} refreshed {uri}: {len(kept)} kept, {len(added)} added, {len(vanished)} removed")
+    return True
+
+
+class _BatchErrors:
+    """Batch callback that collects per-object and per-reference errors by source uuid."""
+
+    def __init__(self):
+        self.owners = {}
+        self.errors = {}
+        self.failed_sources = set()
+        self._lock = threading.Lock()
+
+    def _record(self, object_uuid, error, is_object):
+        owner = self.owners.get(object_uuid)
+        if owner is None:
+            return
+        with self._lock:
+            self.errors.setdefault(owner, []).append(error)
+            if is_object and owner == object_uuid:
+                self.failed_sources.add(owner)
+
+    def __call__(self, results):
+        for result in results or []:
+            errors = (result.get("result") or {}).get("errors")
+            if not errors:
+                continue
+            message = "; ".join(e.get("message", "") for e in errors.get("error", []))
+            if "id" in result:
+                self._record(result["id"], message, is_object=True)
+            elif "from" in result:
+                # weaviate://localhost/<class>/<uuid>/<property>
+                self._record(result["from"].split("/")[-2], message, is_object=False)
+
+
+def index_many(documents: list, user_id: str):
+    """Index many documents across shared batches and write their saved_uris rows in one insert.
+
+    An object that fails to import, or a document without usable text, only
+    fails its own document. A document whose text is substantially the same as
+    a source the user already has is not indexed, see NEAR_DUP_ACTION. Source
+    ids derive from the user and url, so indexing a batch again after a partial
+    failure overwrites what was written instead of duplicating it. Returns one
+    result per document with its status ("indexed", "partial", "failed" or
+    "duplicate").
+    """
+    client = indexer_weaviate_client()
+    source_class, content_class = user_classes(user_id)
+    tenant = user_tenant(user_id)
+
+    batch_errors = _BatchErrors()
+    fingerprints = Fingerprints(user_id) if settings.NEAR_DUP_ACTION != "off" else None
+    results, aliases = [], []
+    try:
+        ensure_tenant(client, user_id)
+        touch_tenant(client, user_id)
+        configure_batch(client, batch_errors)
+        # includes the chunk and embed stages, which are also timed on their own
+        with timed("index", "batch_write"), client.batch as batch:
+            for document in documents:
+                # stored as saved, the canonical url only identifies it
+                document["url"] = strip_fragment(document["url"])
+                source_id = source_uuid(user_id, document["url"])
+                if not document["content"]:
+                    results.append({"id": source_id, "url": document["url"], "title": document["title"],
+                                    "status": "failed", "errors": ["no text to index"]})
+                    continue
+                fingerprint = None
+                if fingerprints is not None:
+                    with timed("index", "near_dup"):
+                        fingerprint = simhash(document["content"] or "")
+                        duplicate_of = fingerprints.find(fingerprint)
+                    if duplicate_of is not None:
+                        logger.info(f"{user_id} already has {document['url']} as {duplicate_of}, not indexing it")
+                        results.append({"id": duplicate_of, "url": document["url"], "title": document["title"],
+                                        "status": "duplicate", "errors": []})
+                        if settings.NEAR_DUP_ACTION == "merge":
+                            aliases.append((canonical_url(document["url"]), duplicate_of))
+                        continue
+                try:
+                    chunks = preprocess(document)
+                except Exception as e:
+                    # bad input fails only its own document
+                    logger.error(f"Error {e} in chunking {document['url']} for {user_id}")
+                    results.append({"id": source_id, "url": document["url"], "title": document["title"],
+                                    "status": "failed", "errors": [str(e)]})
+                    continue
+                document["chunked_content"] = [document["title"], *chunks]
+                parent_uuid, chunk_uuids = add_document(batch, document, source_class, content_class, tenant,
+                                                        source_id=source_id)
+                batch_errors.owners[parent_uuid] = parent_uuid
+                for chunk_uuid in chunk_uuids:
+                    batch_errors.owners[chunk_uuid] = parent_uuid
+                results.append({"id": parent_uuid, "url": document["url"], "title": document["title"]})
+                if fingerprints is not None:
+                    fingerprints.add(parent_uuid, fingerprint)
+                # chunks are in the batch now, no need to hold them
+                del document["chunked_content"]
     except Exception as e:
-        logger.error(f"Error {e} in indexing {uri} for {user_id}")
+        logger.error(f"Error {e} in indexing {len(documents)} documents for {user_id}")
         raise get_failed_exception()
 
-    supabase = get_supabase_client()
-    supabase.table("saved_uris").insert([{"id": parent_uuid, "user_id": convert_user_id(user_id), "url": uri, "title": title}]).execute()
+    rows = []
+    for result in results:
+        if "status" in result:
+            # duplicates and documents that never reached the batch
+            continue
+        errors = batch_errors.errors.get(result["id"], [])
+        if result["id"] in batch_errors.failed_sources:
+            result["status"] = "failed"
+        else:
+            result["status"] = "partial" if errors else "indexed"
+        result["errors"] = errors
+        if result["status"] != "failed":
+            rows.append({"id": result["id"], "user_id": convert_user_id(user_id),
+                         "url": result["url"], "title": result["title"]})
+        else:
+            logger.error(f"Error {errors} in indexing {result['url']} for {user_id}")
+            if fingerprints is not None:
+                fingerprints.discard(result["id"])
+
+    if rows:
+        supabase = get_supabase_client()
+        with timed("index", "supabase_insert"):
+            # an upsert, so a retry after a partial failure doesn't trip over rows it already wrote
+            supabase.table("saved_uris").upsert(rows).execute()
+        invalidate_user_cache(user_id)
+        add_saved(user_id, [(canonical_url(row["url"]), row["id"]) for row in rows])
+    if fingerprints is not None:
+        fingerprints.save()
+    # saving a merged url again is answered by the source it duplicates
+    add_saved(user_id, aliases)
+    logger.info(f"{user_id} indexed {len(rows)}/{len(documents)} documents")
 
-    return True
\ No newline at end of file
+    return results
@@ -0,0 +1,292 @@
+import json
+import time
+import uuid
+
+from rq import Queue, Retry
+
+from client import get_jobs_redis_connection
+from config import settings
+from indexer import index_many, indexer
+from logger import get_logger
+from purge import USER_PURGING_KEY, get_purge_status, set_purge_status, writing
+
+logger = get_logger(__name__)
+
+INDEX_PENDING_KEY = "index:pending:{}:{}"
+# the batch a drain is working on, and saves waiting for the drain job's retry
+INDEX_PROCESSING_KEY = "index:processing:{}:{}"
+INDEX_RETRY_KEY = "index:retry:{}:{}"
+INDEX_SCHEDULED_KEY = "index:scheduled:{}:{}"
+INDEX_DRAINING_KEY = "index:draining:{}:{}"
+# users with saves anywhere in the lists above, for finding drains that died
+INDEX_USERS_KEY = "index:users:{}"
+INDEX_REAPED_KEY = "index:reaped:{}"
+INDEX_STATUS_KEY = "index:status:{}"
+QUEUE_STATS_KEY = "queue:stats:{}"
+
+
+def get_queue(name: str, connection=None):
+    return Queue(name, connection=connection or get_jobs_redis_connection(), default_timeout=settings.INDEX_JOB_TIMEOUT)
+
+
+def _set_status(redis_conn, save_id: str, **fields):
+    key = INDEX_STATUS_KEY.format(save_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, mapping={k: v for k, v in fields.items() if v is not None})
+    pipe.expire(key, settings.INDEX_STATUS_TTL)
+    pipe.execute()
+
+
+def enqueue_save(document: dict, user_id: str, refresh_id: str = None, queue_name: str = None):
+    """Queue a document for indexing and return the id to poll its status with.
+
+    Documents wait in a per-user list for each queue; one drain job per user
+    and queue picks up everything waiting there and indexes it as a batch.
+    Interactive saves and bulk imports never share a drain, so saves don't wait
+    behind imports.
+    """
+    return enqueue_saves([document], user_id, refresh_ids=[refresh_id], queue_name=queue_name)[0]
+
+
+def enqueue_saves(documents: list, user_id: str, refresh_ids: list = None, queue_name: str = None):
+    """Queue several documents at once, so one drain indexes them together. Returns a save id for each.
+
+    refresh_ids has the id of the saved source each document refreshes, or
+    None for a document to index as a new source.
+    """
+    redis_conn = get_jobs_redis_connection()
+    queue_name = queue_name or settings.INTERACTIVE_QUEUE
+    save_ids = [str(uuid.uuid4()) for _ in documents]
+    enqueued_at = time.time()
+    for save_id, document in zip(save_ids, documents):
+        _set_status(redis_conn, save_id, status="queued", url=document["url"], user_id=user_id,
+                    queue=queue_name, enqueued_at=enqueued_at)
+    refresh_ids = refresh_ids or [None] * len(documents)
+    items = [{"save_id": save_id, "document": document, "refresh": bool(source_id), "source_id": source_id,
+              "queue": queue_name}
+             for save_id, document, source_id in zip(save_ids, documents, refresh_ids)]
+    pipe = redis_conn.pipeline()
+    pipe.rpush(INDEX_PENDING_KEY.format(queue_name, user_id), *[json.dumps(item) for item in items])
+    pipe.sadd(INDEX_USERS_KEY.format(queue_name), user_id)
+    pipe.execute()
+    _schedule_drain(redis_conn, user_id, queue_name)
+    return save_ids
+
+
+def _schedule_drain(redis_conn, user_id: str, queue_name: str):
+    # only schedule a drain if none is pending, it will pick everything queued up
+    if redis_conn.set(INDEX_SCHEDULED_KEY.format(queue_name, user_id), 1, nx=True, ex=settings.INDEX_JOB_TIMEOUT):
+        get_queue(queue_name, redis_conn).enqueue(
+            'jobs.drain_user', user_id, queue_name, retry=Retry(max=3, interval=[10, 30, 60])
+        )
+
+
+def _record_wait(redis_conn, item: dict, started_at: float):
+    enqueued_at = float(redis_conn.hget(INDEX_STATUS_KEY.format(item["save_id"]), "enqueued_at") or started_at)
+    pipe = redis_conn.pipeline()
+    key = QUEUE_STATS_KEY.format(item["queue"])
+    pipe.hincrby(key, "processed", 1)
+    pipe.hincrbyfloat(key, "total_wait_seconds", started_at - enqueued_at)
+    pipe.hset(key, "last_wait_seconds", started_at - enqueued_at)
+    pipe.execute()
+
+
+def _index_queued(redis_conn, user_id: str, batch: list):
+    """Index queued documents and record their statuses. Returns the items to try again later.
+
+    If the batch as a whole fails, each document is tried on its own so one
+    bad document can't hold back the others; a document that keeps failing is
+    marked failed after INDEX_MAX_ATTEMPTS.
+    """
+    try:
+        results = index_many([item["document"] for item in batch], user_id)
+    except Exception as e:
+        if len(batch) > 1:
+            return [retry for item in batch for retry in _index_queued(redis_conn, user_id, [item])]
+        item = batch[0]
+        item["attempts"] = item.get("attempts", 0) + 1
+        if item["attempts"] < settings.INDEX_MAX_ATTEMPTS:
+            _set_status(redis_conn, item["save_id"], status="queued")
+            return [item]
+        logger.error(f"Error {e} indexing {item['document']['url']} for {user_id}, giving up after {item['attempts']} attempts")
+        _set_status(redis_conn, item["save_id"], status="failed", errors=json.dumps([str(e)]), finished_at=time.time())
+        return []
+    for item, result in zip(batch, results):
+        _set_status(redis_conn, item["save_id"], status=result["status"], id=result["id"],
+                    errors=json.dumps(result["errors"]) if result["errors"] else None,
+                    finished_at=time.time())
+    return []
+
+
+def _take_batch(redis_conn, pending_key: str, processing_key: str):
+    """Move up to INDEX_COALESCE_MAX saves to the processing list, where they stay until they're done."""
+    pipe = redis_conn.pipeline(transaction=False)
+    for _ in range(settings.INDEX_COALESCE_MAX):
+        pipe.lmove(pending_key, processing_key, "LEFT", "RIGHT")
+    return [raw for raw in pipe.execute() if raw is not None]
+
+
+def _finish_batch(redis_conn, processing_key: str, retry_key: str, retries: list):
+    pipe = redis_conn.pipeline()
+    pipe.delete(processing_key)
+    if retries:
+        pipe.rpush(retry_key, *[json.dumps(item) for item in retries])
+    pipe.execute()
+
+
+def _requeue_unfinished(redis_conn, user_id: str, queue_name: str):
+    """Put saves a dead drain left behind, and saves waiting to be retried, back in front of the pending ones."""
+    pending_key = INDEX_PENDING_KEY.format(queue_name, user_id)
+    requeued = 0
+    # the processing list goes last so its saves, the oldest, end up first
+    for key in (INDEX_RETRY_KEY.format(queue_name, user_id), INDEX_PROCESSING_KEY.format(queue_name, user_id)):
+        while redis_conn.lmove(key, pending_key, "RIGHT", "LEFT") is not None:
+            requeued += 1
+    return requeued
+
+
+def drain_user(user_id: str, queue_name: str):
+    """RQ job: index everything queued for a user, coalescing documents into batched writes.
+
+    Saves stay in Redis until indexed: a batch sits in a processing list while
+    it's worked on, and failed saves in a retry list until the job's retry. A
+    drain that dies leaves them there for the next drain of the user, or for
+    requeue_stalled, to put back.
+    """
+    redis_conn = get_jobs_redis_connection()
+    # cleared before draining, so a save that lands after the drain schedules its own job
+    redis_conn.delete(INDEX_SCHEDULED_KEY.format(queue_name, user_id))
+    draining_key = INDEX_DRAINING_KEY.format(queue_name, user_id)
+    if not redis_conn.set(draining_key, 1, nx=True, ex=settings.INDEX_JOB_TIMEOUT):
+        # another drain of this user is running, it checks for new saves once it's done
+        return
+    try:
+        retrying = _drain(redis_conn, user_id, queue_name)
+    finally:
+        redis_conn.delete(draining_key)
+        if redis_conn.llen(INDEX_PENDING_KEY.format(queue_name, user_id)):
+            _schedule_drain(redis_conn, user_id, queue_name)
+    _reap(redis_conn, queue_name)
+    if retrying:
+        # the job retry picks them up after its backoff
+        raise RuntimeError(f"{retrying} queued saves failed for {user_id}, retrying")
+
+
+def _drain(redis_conn, user_id: str, queue_name: str):
+    pending_key = INDEX_PENDING_KEY.format(queue_name, user_id)
+    processing_key = INDEX_PROCESSING_KEY.format(queue_name, user_id)
+    retry_key = INDEX_RETRY_KEY.format(queue_name, user_id)
+    requeued = _requeue_unfinished(redis_conn, user_id, queue_name)
+    if requeued:
+        logger.info(f"Requeued {requeued} unfinished saves for {user_id}")
+
+    while True:
+        raw_items = _take_batch(redis_conn, pending_key, processing_key)
+        if not raw_items:
+            break
+        items = [json.loads(raw) for raw in raw_items]
+        retries = []
+        with writing(user_id, redis_conn) as allowed:
+            if not allowed:
+                # the user's data is being deleted, write nothing more of it
+                for item in items:
+                    _set_status(redis_conn, item["save_id"], status="cancelled", finished_at=time.time())
+                _finish_batch(redis_conn, processing_key, retry_key, [])
+                continue
+            started_at = time.time()
+            for item in items:
+                _record_wait(redis_conn, item, started_at)
+                _set_status(redis_conn, item["save_id"], status="indexing", started_at=started_at)
+
+            batch = [item for item in items if not item["refresh"]]
+            for item in items:
+                if item["refresh"]:
+                    try:
+                        indexer(item["document"], user_id, refresh=True, source_id=item.get("source_id"))
+                        _set_status(redis_conn, item["save_id"], status="indexed", finished_at=time.time())
+                    except Exception as e:
+                        logger.error(f"Error {e} refreshing {item['document']['url']} for {user_id}")
+                        _set_status(redis_conn, item["save_id"], status="failed", finished_at=time.time())
+
+            if batch:
+                retries = _index_queued(redis_conn, user_id, batch)
+        _finish_batch(redis_conn, processing_key, retry_key, retries)
+        logger.info(f"Drained {len(items)} queued saves for {user_id}")
+
+    retrying = redis_conn.llen(retry_key)
+    if not retrying:
+        redis_conn.srem(INDEX_USERS_KEY.format(queue_name), user_id)
+        # a save queued in between puts the user back
+        if redis_conn.llen(pending_key):
+            redis_conn.sadd(INDEX_USERS_KEY.format(queue_name), user_id)
+    return retrying
+
+
+def _reap(redis_conn, queue_name: str):
+    # at most once a minute per queue, whichever drain gets there first
+    if redis_conn.set(INDEX_REAPED_KEY.format(queue_name), 1, nx=True, ex=60):
+        requeue_stalled(queue_name)
+
+
+def requeue_stalled(queue_name: str = None):
+    """RQ job: schedule a drain for every user whose saves are left with no drain running or scheduled.
+
+    That's saves of a drain that was killed, timed out or redeployed, and
+    retries whose drain job ran out of retries.
+    """
+    redis_conn = get_jobs_redis_connection()
+    rescheduled = 0
+    for name in [queue_name] if queue_name else (settings.INTERACTIVE_QUEUE, settings.BULK_QUEUE):
+        for raw in redis_conn.smembers(INDEX_USERS_KEY.format(name)):
+            user_id = raw.decode()
+            if redis_conn.exists(INDEX_DRAINING_KEY.format(name, user_id), INDEX_SCHEDULED_KEY.format(name, user_id)):
+                continue
+            keys = (INDEX_PENDING_KEY, INDEX_PROCESSING_KEY, INDEX_RETRY_KEY)
+            if any(redis_conn.llen(key.format(name, user_id)) for key in keys):
+                _schedule_drain(redis_conn, user_id, name)
+                rescheduled += 1
+            else:
+                redis_conn.srem(INDEX_USERS_KEY.format(name), user_id)
+    if rescheduled:
+        logger.info(f"Rescheduled drains for {rescheduled} users with stalled saves")
+    return rescheduled
+
+
+def enqueue_purge(user_id: str):
+    """Queue deleting everything stored for a user. Returns False if a purge is already queued or running."""
+    redis_conn = get_jobs_redis_connection()
+    # marked first, so saves stop before the purge starts
+    if not redis_conn.sadd(USER_PURGING_KEY, user_id) and get_purge_status(user_id).get("status") in ("queued", "running"):
+        return False
+    set_purge_status(redis_conn, user_id, status="queued", step="", rows_deleted=0, enqueued_at=time.time())
+    get_queue(settings.BULK_QUEUE, redis_conn).enqueue(
+        'purge.purge_user', user_id, retry=Retry(max=3, interval=[30, 120, 300]), job_timeout=settings.PURGE_JOB_TIMEOUT
+    )
+    return True
+
+
+def get_save_status(save_id: str):
+    status = get_jobs_redis_connection().hgetall(INDEX_STATUS_KEY.format(save_id))
+    return {key.decode(): value.decode() for key, value in status.items()}
+
+
+def queue_stats():
+    """Depth and wait time of the indexing queues."""
+    redis_conn = get_jobs_redis_connection()
+    stats = {}
+    for name in (settings.INTERACTIVE_QUEUE, settings.BULK_QUEUE):
+        counters = {key.decode(): float(value) for key, value in redis_conn.hgetall(QUEUE_STATS_KEY.format(name)).items()}
+        processed = counters.get("processed", 0)
+        # documents wait in per-user lists, the queue itself only holds one drain job per user
+        pipe = redis_conn.pipeline(transaction=False)
+        for raw in redis_conn.smembers(INDEX_USERS_KEY.format(name)):
+            for key in (INDEX_PENDING_KEY, INDEX_PROCESSING_KEY, INDEX_RETRY_KEY):
+                pipe.llen(key.format(name, raw.decode()))
+        stats[name] = {
+            "depth": sum(pipe.execute()),
+            "jobs": get_queue(name, redis_conn).count,
+            "processed": int(processed),
+            "avg_wait_seconds": counters.get("total_wait_seconds", 0.0) / processed if processed else 0.0,
+            "last_wait_seconds": counters.get("last_wait_seconds", 0.0),
+        }
+    return stats
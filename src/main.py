@@ -1,56 +1,71 @@
-import asyncio
-import json
+import hashlib
+import time
 
 import sentry_sdk
-from aiofiles import open as aio_open
 from contextlib import asynccontextmanager
-from fastapi import (BackgroundTasks, Depends, FastAPI, Request)
+from typing import Optional
+from fastapi import (Depends, FastAPI, HTTPException, Request, Response)
 from fastapi.middleware.cors import CORSMiddleware
-from client import (get_redis_connection, indexer_weaviate_client,
-                    query_weaviate_client, get_mixpanel_client, get_supabase_client)
+from fastapi.responses import StreamingResponse
+import analytics
+from cache import cache_stats, normalize_query
+from client import query_weaviate_client, get_jobs_redis_connection, init_clients, close_clients
 from config import settings
-from indexer import indexer
+from deletion import DELETED, FAILED, NOT_FOUND, delete_sources
+from embeddings import embedding_cache_stats
+from importer import IMPORT_PROGRESS_KEY
+from jobs import enqueue_purge, enqueue_save, enqueue_saves, get_queue, get_save_status, queue_stats
 from logger import get_logger
-from schemas import  Payload, SaveRequest, TokenData, WebhookRequestSchema, DeleteSchema
-from searcher import searcher
-from utils import convert_user_id, get_current_user, get_weaviate_schemas, get_failed_exception, get_delete_failed_exception
+from metrics import metrics_response, observe_request, register_stats
+from schemas import  DeleteManyRequest, PageData, Payload, SaveBatchRequest, SaveRequest, TokenData, WebhookRequestSchema, DeleteSchema
+from saved import iter_saved_ndjson, list_saved
+from purge import get_purge_status, is_purging
+from saved_index import find_saved, remove_saved, saved_index_stats
+from search_log import compact_entry, search_log_stats, start_search_log, stop_search_log, write_to_log
+from searcher import async_grouped_searcher, async_searcher
+from singleflight import AsyncSingleFlight, SingleFlight, redis_single_flight
+from tenancy import ensure_shared_classes, ensure_tenant
+from urls import canonical_url
+from utils import auth_cache_stats, convert_user_id, get_current_user, get_weaviate_schemas, get_batch_too_large_exception, get_failed_exception, get_delete_failed_exception, get_user_deleting_exception
 from payment_routes import router as payment_router
 import requests
 
 
 sentry_sdk.init(
     dsn=settings.SENTRY_DSN,
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    # We recommend adjusting this value in production.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
+    # share of transactions traced, and of traced transactions profiled;
+    # turn these down in production, /metrics covers per-stage timings
+    traces_sample_rate=settings.SENTRY_TRACES_SAMPLE_RATE,
+    profiles_sample_rate=settings.SENTRY_PROFILES_SAMPLE_RATE,
 )
 
 logger = get_logger(__name__)
 
-queue = asyncio.Queue()
+search_flights = AsyncSingleFlight()
+save_flights = SingleFlight()
 
-async def writer_worker():
-    """Asynchronous worker to handle writes."""
-    while True:
-        data, filename = await queue.get()  # Wait for an item from the queue
-        async with aio_open(filename, 'a') as f:
-            await f.write(json.dumps(data) + '\n')
-        queue.task_done()
-
-
-async def write_to_log(data: dict, filename: str = 'search_logs.json'):
-    await queue.put((data, filename))  # Just put the data in the queue and return immediately
+register_stats("cache", cache_stats, label="namespace")
+register_stats("embedding_cache", embedding_cache_stats, label="kind")
+register_stats("analytics", analytics.analytics_stats)
+register_stats("search_log", search_log_stats)
+register_stats("auth_cache", auth_cache_stats)
+register_stats("saved_index", saved_index_stats)
+register_stats("index_queue", queue_stats, label="queue")
+register_stats("single_flight", lambda: {
+    "search": {"calls": search_flights.calls, "shared": search_flights.shared},
+    "save": {"calls": save_flights.calls, "shared": save_flights.shared},
+}, label="flight")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    asyncio.create_task(writer_worker())
+    init_clients()
+    analytics.start_analytics()
+    start_search_log()
     yield
+    await stop_search_log()
+    analytics.stop_analytics()
+    close_clients()
 
 origins = [
     "https://app.nous.fyi",
@@ -66,26 +81,46 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
 app.include_router(payment_router)
 
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # the route template, so /api/delete/{id} is one series rather than one per id
+    route = request.scope.get("route")
+    observe_request(request.method, route.path if route else "unmatched", response.status_code,
+                    time.perf_counter() - started)
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = metrics_response()
+    return Response(content=body, media_type=content_type)
+
 @app.post("/api/init_schema")
-async def init_schema(webhookData: WebhookRequestSchema):
+def init_schema(webhookData: WebhookRequestSchema, client = Depends(query_weaviate_client)):
     user_id = webhookData.record.id
     email = webhookData.record.email
 
-    client = indexer_weaviate_client()
-    mp = get_mixpanel_client()
-    knowledge_source, content = get_weaviate_schemas(convert_user_id(user_id))
-    client.schema.create({"classes": [knowledge_source, content]})
+    if settings.WEAVIATE_MULTI_TENANCY:
+        ensure_shared_classes(client)
+        ensure_tenant(client, convert_user_id(user_id))
+    else:
+        knowledge_source, content = get_weaviate_schemas(convert_user_id(user_id))
+        client.schema.create({"classes": [knowledge_source, content]})
     # mp.people_set(user_id, {
     #     '$email': email,
     # }, meta = {'$ignore_time' : False}
     # )
 
-    mp.track(user_id, 'Registered', {
+    analytics.track(user_id, 'Registered', {
         '$distinct_id': user_id,
         '$email': email,
     })
@@ -104,241 +139,230 @@ async def init_schema(webhookData: WebhookRequestSchema):
     return {"user_id": webhookData.record.id, "status": "schema_initialised"}
 
 
-
-# @app.post("/api/save")
-# async def save(saveRequest: SaveRequest, background_tasks: BackgroundTasks, current_user: TokenData = Depends(get_current_user)):
-#     mp = get_mixpanel_client()
-#     user_id = convert_user_id(current_user.sub)
-#     supabase = get_supabase_client()
-#     data = supabase.table("all_saved").select("url").eq("user_id", current_user.sub).eq("url", saveRequest.pageData.url).execute()
-#     if (len(data.data) > 0):
-#         logger.info(f"{user_id} already saved {saveRequest.pageData.url}")
-#         return {"status": "ok"}
-#     data = saveRequest.model_dump()
-#     background_tasks.add_task(indexer, data=data, user_id=user_id)
-#     logger.info(f"{user_id} is saving data")
-#     mp.track(current_user.sub, 'Saved', {
-#         'uri': saveRequest.pageData.url,
-#         'title': saveRequest.pageData.title
-#     })
-#     return {"status": "ok"}
+@app.post("/api/save")
+def save(saveRequest: SaveRequest, current_user: TokenData = Depends(get_current_user)):
+    user_id = convert_user_id(current_user.sub)
+    if is_purging(user_id):
+        raise get_user_deleting_exception()
+    # retries and double clicks share one dedupe check and one enqueued save
+    key = f"save:{user_id}:{hashlib.sha1(canonical_url(saveRequest.pageData.url).encode()).hexdigest()}"
+    run = lambda: _save(saveRequest, current_user)
+    if settings.SINGLE_FLIGHT_REDIS:
+        return save_flights.do(key, lambda: redis_single_flight(key, run))
+    return save_flights.do(key, run)
+
+
+def page_document(page: PageData):
+    readable = page.content.readabilityContent
+    return {
+        "url": page.url,
+        "title": page.title,
+        "content": page.content.rawText or (readable.textContent if readable else None),
+    }
 
 
-@app.post("/api/save")
-async def save(saveRequest: SaveRequest, background_tasks: BackgroundTasks, current_user: TokenData = Depends(get_current_user)):
-    mp = get_mixpanel_client()
+def _save(saveRequest: SaveRequest, current_user: TokenData):
     user_id = convert_user_id(current_user.sub)
-    supabase = get_supabase_client()
-    saved_uris = supabase.table("saved_uris").select("url").eq("user_id", current_user.sub).eq("url", saveRequest.pageData.url).execute()
-    if (len(saved_uris.data) > 0):
+    source_id = find_saved(user_id, [saveRequest.pageData.url]).get(canonical_url(saveRequest.pageData.url))
+    if source_id and not saveRequest.refresh:
         logger.info(f"{user_id} already saved {saveRequest.pageData.url}")
         return {"status": "ok"}
-    
-    # user_limit = supabase.table("user_profiles").select("user_limit").eq("id", current_user.sub).execute().data[0].get("user_limit")
-    # count = supabase.table("saved_uris").select("*", count='exact').eq("user_id", current_user.sub).execute().count
-
-    # if count >= user_limit:
-    #     logger.info(f"{user_id} has hit the limit. Current limit: {user_limit}")
-    #     return {"status": "limit_reached"}
-
-    if not saveRequest.pageData.content.readabilityContent.textContent:
-        textContent = saveRequest.pageData.content.readabilityContent.textContent
-    else:
-        textContent = saveRequest.pageData.content.rawText
 
-    raw_doc = {
-        "url": saveRequest.pageData.url,
-        "title": saveRequest.pageData.title,
-        "content": textContent,
-    }
+    document = page_document(saveRequest.pageData)
+    if not document["content"]:
+        # nothing to index, same answer as save_batch gives
+        logger.info(f"{user_id} saved {saveRequest.pageData.url} without any text")
+        return {"status": "empty"}
 
-    background_tasks.add_task(indexer, document=raw_doc, user_id=user_id)
+    save_id = enqueue_save(document, user_id, refresh_id=source_id)
     logger.info(f"{user_id} is saving data")
-    mp.track(current_user.sub, 'Saved', {
+    analytics.track(current_user.sub, 'Saved', {
         'uri': saveRequest.pageData.url,
         'title': saveRequest.pageData.title
     })
 
-    return {"status": "ok"}
+    return {"status": "ok", "save_id": save_id}
+
+
+@app.post("/api/save_batch")
+def save_batch(saveRequest: SaveBatchRequest, current_user: TokenData = Depends(get_current_user)):
+    user_id = convert_user_id(current_user.sub)
+    if is_purging(user_id):
+        raise get_user_deleting_exception()
+    if len(saveRequest.pages) > settings.SAVE_BATCH_MAX:
+        raise get_batch_too_large_exception()
+
+    results = [{"url": page.url} for page in saveRequest.pages]
+    first_seen = {}
+    for i, page in enumerate(saveRequest.pages):
+        url = canonical_url(page.url)
+        if url in first_seen:
+            results[i].update(status="duplicate", duplicate_of=first_seen[url])
+        else:
+            first_seen[url] = i
+    saved = find_saved(user_id, list(first_seen))
+
+    to_index = []
+    for url, i in first_seen.items():
+        document = page_document(saveRequest.pages[i])
+        if url in saved:
+            results[i].update(status="already_saved", id=saved[url])
+        elif not document["content"]:
+            results[i].update(status="empty")
+        else:
+            to_index.append((i, document))
+
+    if to_index:
+        save_ids = enqueue_saves([document for _, document in to_index], user_id)
+        for (i, document), save_id in zip(to_index, save_ids):
+            results[i].update(status="queued", save_id=save_id)
+            analytics.track(current_user.sub, 'Saved', {'uri': document["url"], 'title': document["title"]})
+    logger.info(f"{user_id} is saving {len(to_index)}/{len(results)} pages in a batch")
+
+    return {"status": "ok", "results": results}
+
+
+@app.get("/api/save/{save_id}")
+def save_status(save_id: str, current_user: TokenData = Depends(get_current_user)):
+    status = get_save_status(save_id)
+    if not status or status.get("user_id") != convert_user_id(current_user.sub):
+        raise HTTPException(status_code=404, detail="Save not found")
+    return status
 
 
 
 @app.get("/api/search")
-async def query(query: str, current_user: TokenData = Depends(get_current_user)):
+async def query(query: str, group: bool = False, limit: Optional[int] = None, offset: int = 0,
+                current_user: TokenData = Depends(get_current_user)):
     # response = searcher(query)
     user_id = convert_user_id(current_user.sub)
     logger.info(f"{user_id} queried: {query}")
-    user_id = convert_user_id(current_user.sub)
-    raw_response, results = searcher(query=query, user_id=user_id)
-
-    entry_dict = {
-        "user_id": user_id,
-        "query": query,
-        "response": raw_response
-    }
+    started = time.perf_counter()
+    next_offset = None
+    if group:
+        limit = min(limit or settings.SEARCH_PAGE_SIZE, settings.SEARCH_MAX_PAGE_SIZE)
+        offset = max(offset, 0)
+        key = (user_id, normalize_query(query), limit, offset)
+        raw_response, page = await search_flights.do(
+            key, lambda: async_grouped_searcher(query=query, user_id=user_id, limit=limit, offset=offset)
+        )
+        results, next_offset = page["results"], page["next_offset"]
+    else:
+        key = (user_id, normalize_query(query))
+        raw_response, results = await search_flights.do(key, lambda: async_searcher(query=query, user_id=user_id))
 
-    await write_to_log(entry_dict)
-    mp = get_mixpanel_client()
-    mp.track(current_user.sub, 'Search', {
+    took_ms = (time.perf_counter() - started) * 1000
+    write_to_log(compact_entry(user_id, query, raw_response, results, took_ms))
+    analytics.track(current_user.sub, 'Search', {
         'search_query': query,
-        'results': results
+        'results_count': len(results),
+        'result_ids': [result['id'] for result in results],
     })
+    if group:
+        return {'query': query, 'results': results, 'next_offset': next_offset}
     return {'query': query, 'results': results}
 
 
-# TODO: has to been shifted on to postgres supabase.
 @app.get("/api/all_saved")
-async def allSaved(current_user: TokenData = Depends(get_current_user)):
+def allSaved(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None,
+             current_user: TokenData = Depends(get_current_user)):
     logger.info(f"sending all saved to {current_user.sub}")
     user_id = convert_user_id(current_user.sub)
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
     try:
-        client = query_weaviate_client()
-        response = (
-            client.query.get(source_class, ["title", "uri"])
-            .with_additional(['creationTimeUnix','id'])
-            .do()
-        )
-        results = []
-        for i, source in enumerate(sorted(response['data']['Get'][source_class],
-                                          key=lambda x: x['_additional']['creationTimeUnix'], reverse=True)):
-            results.append({
-                    "index": i,
-                    "id": source['_additional']['id'],
-                    "uri": source['uri'],
-                    "title": source['title']
-                })
-        return results
+        page = list_saved(user_id, limit=limit, cursor=cursor)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting all saved for {user_id}: {e}")
         raise get_failed_exception()
 
+    # the body stays a plain list, the cursor for the next page goes in a header
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
+    return [{"index": i, **item} for i, item in enumerate(page["items"])]
+
+
+@app.get("/api/all_saved/stream")
+def allSavedStream(current_user: TokenData = Depends(get_current_user)):
+    logger.info(f"streaming all saved to {current_user.sub}")
+    user_id = convert_user_id(current_user.sub)
+    return StreamingResponse(iter_saved_ndjson(user_id), media_type="application/x-ndjson")
+
 
 @app.delete("/api/delete/{id}")
-async def delete_data(id: str, current_user: TokenData = Depends(get_current_user)):
+def delete_data(id: str, current_user: TokenData = Depends(get_current_user), client = Depends(query_weaviate_client)):
     logger.info(f"deleting data with id {id} for user {current_user.sub}")
     user_id = convert_user_id(current_user.sub)
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
-    content_class = settings.CONTENT_CLASS.format(user_id)
-    client = query_weaviate_client()
-    try:
-        # get all the chunks of the source object
-        chunk_ids = []
-        source_obj = (
-            client.query.get(
-                source_class,
-                ["uri", f"chunk_refs {{ ... on {content_class} {{ _additional {{ id }} }} }}"])
-                .with_where(
-                    {
-                        "path": ["id"],
-                        "operator": "Equal",
-                        "valueString": id
-                    }
-                )
-                .do()
-        )
-        uri = source_obj["data"]["Get"][source_class][0]["uri"]
-
-        chunk_refs = source_obj["data"]["Get"][source_class][0]["chunk_refs"]
-        if chunk_refs is not None:
-            for ref in chunk_refs:
-                chunk_ids.append(ref["_additional"]["id"])
-
-        # delete all the chunks
-        client.batch.delete_objects(
-            content_class,
-            where={
-                "path": ["id"],
-                "operator": "ContainsAny",
-                "valueTextArray": chunk_ids 
-            },
-            output="verbose",
-            # dry_run=True
-        )
-
-        logger.info(f"Deleted {len(chunk_ids)} chunks for {user_id}")
-        # delete the source object
-        client.data_object.delete(class_name=source_class, uuid=id)
+    if delete_sources(client, user_id, [id])[id] == FAILED:
+        raise get_delete_failed_exception()
+    return {"message": f"Bookmark with id:{id} deleted successfully"}
 
-        return {"message": f"Bookmark with id:{id} deleted successfully"}
 
-    except Exception as e:
-        logger.error(f"Error deleting data with id {id} for {user_id}: {e}")
-        raise get_delete_failed_exception()
+@app.post("/api/delete/batch")
+def delete_many(deleteRequest: DeleteManyRequest, current_user: TokenData = Depends(get_current_user), client = Depends(query_weaviate_client)):
+    if len(deleteRequest.ids) > settings.DELETE_MAX_IDS:
+        raise get_batch_too_large_exception()
+    user_id = convert_user_id(current_user.sub)
+    logger.info(f"deleting {len(deleteRequest.ids)} bookmarks for user {user_id}")
+    statuses = delete_sources(client, user_id, deleteRequest.ids)
+    return {
+        "results": [{"id": source_id, "status": status} for source_id, status in statuses.items()],
+        "deleted": sum(status == DELETED for status in statuses.values()),
+        "failed": sum(status == FAILED for status in statuses.values()),
+    }
 
 
 @app.post("/api/delete")
-async def delete_uri(deleteRequest: DeleteSchema):
+def delete_uri(deleteRequest: DeleteSchema, client = Depends(query_weaviate_client)):
     user_id = convert_user_id(deleteRequest.old_record.user_id)
     uri_id = deleteRequest.old_record.id
     uri = deleteRequest.old_record.url
     logger.info(f"[!] Deleting {uri} for {user_id}")
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
-    content_class = settings.CONTENT_CLASS.format(user_id)
-    client = query_weaviate_client()
-    try:
-    # get all the chunks of the source object
-        chunk_ids = []
-        source_obj = (
-            client.query.get(
-                source_class,
-                ["uri", f"chunk_refs {{ ... on {content_class} {{ _additional {{ id }} }} }}"])
-                .with_where(
-                    {
-                        "path": ["id"],
-                        "operator": "Equal",
-                        "valueString": uri_id
-                    }
-                )
-                .do()
-        )
-
-        chunk_refs = source_obj["data"]["Get"][source_class][0]["chunk_refs"]
-        if chunk_refs is not None:
-            for ref in chunk_refs:
-                chunk_ids.append(ref["_additional"]["id"])
-
-    #     # delete all the chunks
-        client.batch.delete_objects(
-            content_class,
-            where={
-                "path": ["id"],
-                "operator": "ContainsAny",
-                "valueTextArray": chunk_ids 
-            },
-            output="verbose",
-            # dry_run=True
-        )
-
-        logger.info(f"[!] Deleted {len(chunk_ids)} chunks for {user_id}")
-
-    except Exception as e:
-        logger.error(f"Error deleting data with id {id} for {user_id}: {e}")
+    if is_purging(user_id):
+        # the purge deletes these rows itself, after the user's Weaviate data is already gone
+        return {"message": f"Bookmark with id:{uri_id} deleted successfully"}
+    # the row is gone already; when the app deleted it, the source went first and this finds nothing to do
+    status = delete_sources(client, user_id, [uri_id], delete_rows=False)[uri_id]
+    if status == FAILED:
         raise get_delete_failed_exception()
+    if status == NOT_FOUND:
+        # the row may have been deleted directly, before the source ever made it into Weaviate
+        remove_saved(user_id, [canonical_url(uri)])
 
     logger.info(f"[!] Deleted {uri} for {user_id}")
     
     return {"message": f"Bookmark with id:{uri_id} deleted successfully"}
 
 
-@app.delete("/api/user/{id}")
-async def delete_user(id: str, current_user: TokenData = Depends(get_current_user)):
+@app.delete("/api/user/{id}", status_code=202)
+def delete_user(id: str, current_user: TokenData = Depends(get_current_user)):
     user_id = convert_user_id(current_user.sub)
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
-    content_class = settings.CONTENT_CLASS.format(user_id)
+    if enqueue_purge(user_id):
+        logger.info(f"Purge of {user_id} enqueued")
+    return {"message": f"User {user_id} is being deleted", **get_purge_status(user_id)}
 
-    client = query_weaviate_client()
-    client.schema.delete_class(source_class)
-    client.schema.delete_class(content_class)
 
-    return {"message": f"User {user_id} deleted successfully"}
+@app.get("/api/user/{id}/delete")
+def delete_user_status(id: str, current_user: TokenData = Depends(get_current_user)):
+    status = get_purge_status(convert_user_id(current_user.sub))
+    if not status:
+        raise HTTPException(status_code=404, detail="Deletion not found")
+    return status
 
 @app.post("/api/import")
-async def import_bookmarks(webhookData: Payload):
-    from redis import Redis
-    from rq import Queue, Retry
-
-    redis_conn = Redis(host=settings.JOBS_QUEUE, port=6379, db=0)
-    q = Queue('default', connection=redis_conn, default_timeout=1200)
-    job = q.enqueue('main.importer', webhookData.model_dump(), retry=Retry(max=3, interval=60))
-    logger.info(f"Job {job.id} enqueued")
\ No newline at end of file
+def import_bookmarks(webhookData: Payload, redis_conn = Depends(get_jobs_redis_connection)):
+    from rq import Retry
+
+    q = get_queue(settings.BULK_QUEUE, redis_conn)
+    job = q.enqueue('importer.importer', webhookData.model_dump(), retry=Retry(max=3, interval=60),
+                    job_timeout=settings.IMPORT_JOB_TIMEOUT)
+    logger.info(f"Job {job.id} enqueued")
+    return {"job_id": job.id, "status": "queued"}
+
+
+@app.get("/api/import/{record_id}")
+def import_status(record_id: str, redis_conn = Depends(get_jobs_redis_connection)):
+    progress = redis_conn.hgetall(IMPORT_PROGRESS_KEY.format(record_id))
+    if not progress:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return {key.decode(): value.decode() for key, value in progress.items()}
\ No newline at end of file
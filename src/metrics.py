@@ -0,0 +1,105 @@
+import os
+import time
+from contextlib import ContextDecorator
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# With PROMETHEUS_MULTIPROC_DIR set, API workers and RQ workers on the host
+# share histograms through files there, so /metrics on any API worker also
+# covers indexing done in the job workers.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "nous_stage_seconds", "Time spent in one stage of an operation", ["operation", "stage"], buckets=STAGE_BUCKETS
+)
+STAGE_ERRORS = Counter("nous_stage_errors_total", "Stages that raised", ["operation", "stage"])
+REQUEST_SECONDS = Histogram(
+    "nous_request_seconds", "HTTP request latency by route", ["method", "route", "status"], buckets=STAGE_BUCKETS
+)
+
+_stats_providers = {}
+
+
+class timed(ContextDecorator):
+    """Time a stage of an operation, as a context manager or a decorator.
+
+        with timed("search", "rerank"):
+            ...
+    """
+
+    def __init__(self, operation: str, stage: str):
+        self.operation = operation
+        self.stage = stage
+
+    def _recreate_cm(self):
+        # a fresh instance per decorated call, so concurrent calls don't share a start time
+        return timed(self.operation, self.stage)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.labels(self.operation, self.stage).observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            STAGE_ERRORS.labels(self.operation, self.stage).inc()
+        return False
+
+
+def observe_request(method: str, route: str, status: int, seconds: float):
+    REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+def register_stats(name: str, fn, label: str = "group"):
+    """Export a stats function's numbers as gauges, read at scrape time.
+
+    Top-level numbers become nous_<name>_<key>; nested dicts, like per-queue or
+    per-namespace stats, become nous_<name>_<key>{<label>="<outer key>"}.
+    """
+    _stats_providers[name] = (fn, label)
+
+
+class _StatsCollector:
+    def collect(self):
+        for name, (fn, label) in list(_stats_providers.items()):
+            try:
+                stats = fn()
+            except Exception as e:
+                logger.error(f"Error {e} collecting {name} stats")
+                continue
+            families = {}
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    for inner, number in value.items():
+                        if isinstance(number, (int, float)):
+                            family = families.get(inner)
+                            if family is None:
+                                family = families[inner] = GaugeMetricFamily(f"nous_{name}_{inner}", f"{name} {inner}", labels=[label])
+                            family.add_metric([key], number)
+                elif isinstance(value, (int, float)):
+                    families[key] = GaugeMetricFamily(f"nous_{name}_{key}", f"{name} {key}", value=value)
+            yield from families.values()
+
+
+_stats_collector = _StatsCollector()
+if not MULTIPROCESS:
+    REGISTRY.register(_stats_collector)
+
+
+def metrics_response():
+    """The exposition body and its content type."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        # stats are read from this worker only, they're mostly shared through Redis anyway
+        registry.register(_stats_collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
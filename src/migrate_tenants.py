@@ -0,0 +1,244 @@
+"""Copy per-user classes into tenants of the shared classes, vectors included.
+
+    python migrate_tenants.py migrate [--user USER_ID ...] [--force] [--drop-old]
+    python migrate_tenants.py status
+    python migrate_tenants.py offload
+
+Objects keep their ids, so saved_uris rows and client-side ids stay valid, and
+nothing is embedded again. Progress is checkpointed in Redis after every
+batch, so an interrupted run picks up where it stopped.
+
+To switch over: run migrate, then migrate --force right before setting
+WEAVIATE_MULTI_TENANCY, then migrate --force once more to copy anything saved
+in between. Until the switch, copying an object again overwrites it under the
+same id, and each run also deletes from the tenant whatever was deleted from
+the old classes since it was copied. After it the tenant is where saves and
+deletes go, so runs only copy objects created in the old classes since the
+last run before the switch, and only those the tenant doesn't have; nothing
+is overwritten or pruned. Deletes made after the switch aren't carried back
+to the old classes, which is why they mustn't be copied from wholesale again.
+"""
+import argparse
+import time
+
+from client import get_jobs_redis_connection, indexer_weaviate_client
+from config import settings
+from deletion import delete_where
+from logger import get_logger
+from tenancy import TENANT_ACTIVE_KEY, add_tenant, ensure_shared_classes, offload_idle_tenants
+from weaviate_batch import BatchErrors, beacon_id, configure_batch, object_properties, pages
+
+logger = get_logger(__name__)
+
+MIGRATION_DONE_KEY = "migration:tenants:done"
+MIGRATION_CURSOR_KEY = "migration:tenants:{}"
+# user -> when the last run before the switch started, in ms
+MIGRATION_SYNCED_KEY = "migration:tenants:synced"
+
+
+def legacy_users(client):
+    """Users that still have classes of their own."""
+    prefix = settings.KNOWLEDGE_SOURCE_CLASS.format("")
+    classes = client.schema.get().get("classes") or []
+    return sorted(c["class"][len(prefix):] for c in classes if c["class"].startswith(prefix))
+
+
+def _count(client, class_name: str, tenant: str = None):
+    query = client.query.aggregate(class_name).with_meta_count()
+    if tenant:
+        query = query.with_tenant(tenant)
+    response = query.do()
+    return response["data"]["Aggregate"][class_name][0]["meta"]["count"]
+
+
+def _copy_page(client, objects: list, user_id: str, sources: bool):
+    errors = BatchErrors()
+    configure_batch(client, errors)
+    source_props = {}
+    if settings.DENORMALIZED_CHUNKS and not sources:
+        # chunks carry their source's uri and title, looked up unless the old class has them already
+        source_ids = {beacon_id(ref["beacon"]) for obj in objects
+                      if not (obj.get("properties") or {}).get("source_id")
+                      for ref in (obj.get("properties") or {}).get("hasCategory") or []}
+        source_props = object_properties(client, settings.KNOWLEDGE_SOURCE_CLASS.format(user_id), None, source_ids)
+    with client.batch as batch:
+        for obj in objects:
+            properties = obj.get("properties") or {}
+            if sources:
+                batch.add_data_object(
+                    data_object={"uri": properties.get("uri"), "title": properties.get("title")},
+                    class_name=settings.SHARED_SOURCE_CLASS,
+                    uuid=obj["id"],
+                    tenant=user_id,
+                )
+                continue
+            data_object = {"source_content": properties.get("source_content")}
+            refs = properties.get("hasCategory") or []
+            if settings.DENORMALIZED_CHUNKS and (properties.get("source_id") or refs):
+                if properties.get("source_id"):
+                    source_id, source = properties["source_id"], properties
+                else:
+                    source_id = beacon_id(refs[0]["beacon"])
+                    source = source_props.get(source_id) or {}
+                data_object.update(source_id=source_id, uri=source.get("uri"), title=source.get("title"))
+            batch.add_data_object(
+                data_object=data_object,
+                class_name=settings.SHARED_CONTENT_CLASS,
+                uuid=obj["id"],
+                vector=obj.get("vector"),
+                tenant=user_id,
+            )
+            for ref in refs:
+                source_id = beacon_id(ref["beacon"])
+                batch.add_reference(
+                    from_object_uuid=obj["id"],
+                    from_property_name="hasCategory",
+                    to_object_uuid=source_id,
+                    from_object_class_name=settings.SHARED_CONTENT_CLASS,
+                    to_object_class_name=settings.SHARED_SOURCE_CLASS,
+                    tenant=user_id,
+                )
+                batch.add_reference(
+                    from_object_uuid=source_id,
+                    from_property_name="chunk_refs",
+                    to_object_uuid=obj["id"],
+                    from_object_class_name=settings.SHARED_SOURCE_CLASS,
+                    to_object_class_name=settings.SHARED_CONTENT_CLASS,
+                    tenant=user_id,
+                )
+    if errors.errors:
+        raise RuntimeError(f"{len(errors.errors)} objects failed to copy, first: {errors.errors[0]}")
+
+
+def _missing(client, objects: list, class_name: str, user_id: str, synced_at):
+    """The objects created since the last run before the switch that the tenant doesn't have."""
+    if synced_at is not None:
+        objects = [obj for obj in objects if int(obj.get("creationTimeUnix") or 0) >= synced_at]
+    if not objects:
+        return []
+    response = (
+        client.query.get(class_name)
+            .with_additional(["id"])
+            .with_tenant(user_id)
+            .with_where({"path": ["id"], "operator": "ContainsAny", "valueTextArray": [obj["id"] for obj in objects]})
+            .with_limit(len(objects))
+            .do()
+    )
+    present = {obj["_additional"]["id"] for obj in response["data"]["Get"][class_name]}
+    return [obj for obj in objects if obj["id"] not in present]
+
+
+def _prune(client, user_id: str, old_classes: dict):
+    """Delete from the tenant what's no longer in the old classes, chunks before their sources."""
+    pruned = 0
+    for phase, new_class in (("chunks", settings.SHARED_CONTENT_CLASS), ("sources", settings.SHARED_SOURCE_CLASS)):
+        old_ids = {obj["id"] for objects in pages(client, old_classes[phase], with_vector=False)
+                   for obj in objects}
+        extra = [obj["id"] for objects in pages(client, new_class, tenant=user_id, with_vector=False)
+                 for obj in objects if obj["id"] not in old_ids]
+        for start in range(0, len(extra), settings.DELETE_BATCH_SIZE):
+            ids = extra[start:start + settings.DELETE_BATCH_SIZE]
+            pruned += delete_where(client, new_class, {"path": ["id"], "operator": "ContainsAny", "valueTextArray": ids},
+                                   user_id)
+    return pruned
+
+
+def migrate_user(client, redis_conn, user_id: str, force: bool = False, drop_old: bool = False):
+    """Copy one user's classes into their tenant. Sources go first so chunk references resolve."""
+    cursor_key = MIGRATION_CURSOR_KEY.format(user_id)
+    if force:
+        redis_conn.delete(cursor_key)
+        redis_conn.srem(MIGRATION_DONE_KEY, user_id)
+    elif redis_conn.sismember(MIGRATION_DONE_KEY, user_id):
+        return False
+
+    add_tenant(client, user_id)
+    started_at = int(time.time() * 1000)
+    switched = settings.WEAVIATE_MULTI_TENANCY
+    synced_at = redis_conn.hget(MIGRATION_SYNCED_KEY, user_id)
+    synced_at = int(synced_at) if synced_at else None
+    old_classes = {"sources": settings.KNOWLEDGE_SOURCE_CLASS.format(user_id), "chunks": settings.CONTENT_CLASS.format(user_id)}
+    new_classes = {"sources": settings.SHARED_SOURCE_CLASS, "chunks": settings.SHARED_CONTENT_CLASS}
+    for phase, class_name in old_classes.items():
+        if redis_conn.hget(cursor_key, phase) == b"done":
+            continue
+        after = redis_conn.hget(cursor_key, phase)
+        for objects in pages(client, class_name, after.decode() if after else None, with_vector=phase == "chunks"):
+            # after the switch, copying what the tenant has would undo changes made there since
+            to_copy = _missing(client, objects, new_classes[phase], user_id, synced_at) if switched else objects
+            if to_copy:
+                _copy_page(client, to_copy, user_id, sources=phase == "sources")
+            redis_conn.hset(cursor_key, phase, objects[-1]["id"])
+        redis_conn.hset(cursor_key, phase, "done")
+    if not switched:
+        # copying only adds, deletes made since the last run have to be carried over
+        pruned = _prune(client, user_id, old_classes)
+        if pruned:
+            logger.info(f"Deleted {pruned} objects of {user_id} that are gone from the old classes")
+        redis_conn.hset(MIGRATION_SYNCED_KEY, user_id, started_at)
+
+    copied = {
+        "sources": (_count(client, old_classes["sources"]), _count(client, settings.SHARED_SOURCE_CLASS, user_id)),
+        "chunks": (_count(client, old_classes["chunks"]), _count(client, settings.SHARED_CONTENT_CLASS, user_id)),
+    }
+    logger.info(f"Migrated {user_id}: {copied}")
+    if drop_old:
+        if any(new < old for old, new in copied.values()):
+            logger.error(f"Not dropping classes of {user_id}, the tenant has fewer objects: {copied}")
+        else:
+            for class_name in old_classes.values():
+                client.schema.delete_class(class_name)
+    redis_conn.sadd(MIGRATION_DONE_KEY, user_id)
+    redis_conn.delete(cursor_key)
+    # counts as activity, so tenants of users who never come back get offloaded too
+    redis_conn.zadd(TENANT_ACTIVE_KEY, {user_id: time.time()}, nx=True)
+    return True
+
+
+def migrate(user_ids: list = None, force: bool = False, drop_old: bool = False):
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    ensure_shared_classes(client)
+    user_ids = user_ids or legacy_users(client)
+    migrated, failed = 0, []
+    for user_id in user_ids:
+        try:
+            if migrate_user(client, redis_conn, user_id, force=force, drop_old=drop_old):
+                migrated += 1
+        except Exception as e:
+            # the checkpoint stays, the next run resumes this user
+            logger.error(f"Error {e} migrating {user_id}")
+            failed.append(user_id)
+    logger.info(f"Migrated {migrated} of {len(user_ids)} users, {len(failed)} failed")
+    return {"migrated": migrated, "failed": failed}
+
+
+def status():
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    users = legacy_users(client)
+    done = {user.decode() for user in redis_conn.smembers(MIGRATION_DONE_KEY)}
+    return {"legacy_users": len(users), "migrated": len(done), "remaining": len([u for u in users if u not in done])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("migrate")
+    run.add_argument("--user", action="append", dest="users", help="only this user, repeatable")
+    run.add_argument("--force", action="store_true", help="copy again even if already migrated")
+    run.add_argument("--drop-old", action="store_true", help="delete the per-user classes once copied")
+    commands.add_parser("status")
+    commands.add_parser("offload")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print(migrate(args.users, force=args.force, drop_old=args.drop_old))
+    elif args.command == "status":
+        print(status())
+    else:
+        print({"offloaded": offload_idle_tenants()})
+
+
+if __name__ == "__main__":
+    main()
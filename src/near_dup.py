@@ -0,0 +1,109 @@
+import hashlib
+import re
+from collections import Counter
+
+from redis import RedisError
+
+from client import get_jobs_redis_connection
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# source id -> 64-bit SimHash of its text, per user
+FINGERPRINTS_KEY = "simhash:{}"
+SHINGLE_WORDS = 3
+
+_word = re.compile(r"\w+")
+
+
+def simhash(text: str):
+    """64-bit SimHash over word shingles, or None if the text is too short to judge."""
+    words = _word.findall(text.lower())
+    if len(words) < settings.NEAR_DUP_MIN_WORDS:
+        return None
+    shingles = Counter(" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+    weights = [0] * 64
+    for shingle, count in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming(a: int, b: int):
+    return bin(a ^ b).count("1")
+
+
+class Fingerprints:
+    """A user's source fingerprints, loaded once per indexing batch."""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.known = {}
+        try:
+            raw = get_jobs_redis_connection().hgetall(FINGERPRINTS_KEY.format(user_id))
+            self.known = {source_id.decode(): int(value) for source_id, value in raw.items()}
+        except RedisError as e:
+            # without fingerprints everything is indexed, as before
+            logger.error(f"Error {e} loading fingerprints for {user_id}")
+        self.added = {}
+
+    def find(self, fingerprint: int):
+        """The id of a source whose text is substantially the same, if any."""
+        if fingerprint is None:
+            return None
+        best, best_distance = None, settings.NEAR_DUP_MAX_DISTANCE + 1
+        for source_id, known in self.known.items():
+            distance = hamming(fingerprint, known)
+            if distance < best_distance:
+                best, best_distance = source_id, distance
+        return best
+
+    def add(self, source_id: str, fingerprint: int):
+        if fingerprint is None:
+            return
+        # later documents in the same batch are checked against this one too
+        self.known[source_id] = fingerprint
+        self.added[source_id] = fingerprint
+
+    def discard(self, source_id: str):
+        self.known.pop(source_id, None)
+        self.added.pop(source_id, None)
+
+    def save(self):
+        if not self.added:
+            return
+        try:
+            get_jobs_redis_connection().hset(FINGERPRINTS_KEY.format(self.user_id),
+                                             mapping={k: str(v) for k, v in self.added.items()})
+        except RedisError as e:
+            logger.error(f"Error {e} saving {len(self.added)} fingerprints for {self.user_id}")
+
+
+def set_fingerprint(user_id: str, source_id: str, text: str):
+    fingerprint = simhash(text)
+    try:
+        r = get_jobs_redis_connection()
+        if fingerprint is None:
+            r.hdel(FINGERPRINTS_KEY.format(user_id), source_id)
+        else:
+            r.hset(FINGERPRINTS_KEY.format(user_id), source_id, str(fingerprint))
+    except RedisError as e:
+        logger.error(f"Error {e} setting fingerprint of {source_id} for {user_id}")
+
+
+def remove_fingerprints(user_id: str, source_ids: list):
+    if not source_ids:
+        return
+    try:
+        get_jobs_redis_connection().hdel(FINGERPRINTS_KEY.format(user_id), *source_ids)
+    except RedisError as e:
+        logger.error(f"Error {e} removing {len(source_ids)} fingerprints for {user_id}")
+
+
+def drop_fingerprints(user_id: str):
+    try:
+        get_jobs_redis_connection().delete(FINGERPRINTS_KEY.format(user_id))
+    except RedisError as e:
+        logger.error(f"Error {e} dropping fingerprints for {user_id}")
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Request, HTTPException
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from typing import Optional, Dict
 import hmac
 import hashlib
@@ -40,7 +41,9 @@ async def subscription_created(request: Request):
     
     supabase = get_supabase_client()
     user_id = root.meta.custom_data.get('user_id')
-    supabase.table("user_profiles").update({"is_subscribed": True, "user_limit": 1000}).eq("id", user_id).execute()
+    await run_in_threadpool(
+        supabase.table("user_profiles").update({"is_subscribed": True, "user_limit": 1000}).eq("id", user_id).execute
+    )
 
     print(f"Subscription created for user {user_id}")
     return {"status": "ok"}
@@ -56,6 +59,8 @@ async def subscription_expired(request: Request):
     
     supabase = get_supabase_client()
     user_id = root.meta.custom_data.get('user_id')
-    supabase.table("user_profiles").update({"is_subscribed": False, "user_limit": 250}).eq("id", user_id).execute()
+    await run_in_threadpool(
+        supabase.table("user_profiles").update({"is_subscribed": False, "user_limit": 250}).eq("id", user_id).execute
+    )
     print(f"Subscription expired for user {user_id}")
     return {"status": "ok"}
\ No newline at end of file
@@ -0,0 +1,111 @@
+import time
+from contextlib import contextmanager
+
+from cache import invalidate_user_cache
+from client import get_jobs_redis_connection, get_supabase_client, indexer_weaviate_client
+from config import settings
+from logger import get_logger
+from near_dup import drop_fingerprints
+from saved_index import drop_saved_index
+from tenancy import delete_user_data
+from utils import convert_user_id
+
+logger = get_logger(__name__)
+
+# users whose data is being deleted, each purge's progress, and how many jobs are writing a user's data
+USER_PURGING_KEY = "purge:active"
+PURGE_STATUS_KEY = "purge:{}"
+USER_WRITERS_KEY = "purge:writers:{}"
+
+
+def is_purging(user_id: str, redis_conn=None):
+    return bool((redis_conn or get_jobs_redis_connection()).sismember(USER_PURGING_KEY, user_id))
+
+
+@contextmanager
+def writing(user_id: str, redis_conn=None):
+    """Hold off purging a user while writing their data. Yields False if a purge started, then write nothing.
+
+    Writers register before checking, and purges mark the user before waiting,
+    so either the purge waits for the write or the writer sees the purge.
+    """
+    redis_conn = redis_conn or get_jobs_redis_connection()
+    key = USER_WRITERS_KEY.format(user_id)
+    pipe = redis_conn.pipeline()
+    pipe.incr(key)
+    # a worker that dies mid-write doesn't hold purges off for good
+    pipe.expire(key, settings.INDEX_JOB_TIMEOUT)
+    pipe.execute()
+    try:
+        yield not is_purging(user_id, redis_conn)
+    finally:
+        redis_conn.decr(key)
+
+
+def _wait_for_writers(redis_conn, user_id: str):
+    deadline = time.monotonic() + settings.PURGE_WRITERS_WAIT
+    while int(redis_conn.get(USER_WRITERS_KEY.format(user_id)) or 0) > 0:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{user_id} still has data being written, purging later")
+        time.sleep(1)
+
+
+def set_purge_status(redis_conn, user_id: str, **fields):
+    key = PURGE_STATUS_KEY.format(user_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, mapping={k: v for k, v in fields.items() if v is not None})
+    pipe.hset(key, "updated_at", time.time())
+    pipe.expire(key, settings.PURGE_STATUS_TTL)
+    pipe.execute()
+
+
+def get_purge_status(user_id: str):
+    status = get_jobs_redis_connection().hgetall(PURGE_STATUS_KEY.format(user_id))
+    return {key.decode(): value.decode() for key, value in status.items()}
+
+
+def _delete_saved_rows(redis_conn, user_id: str):
+    """Delete the user's saved_uris rows PURGE_BATCH_SIZE at a time, so no single statement runs long."""
+    supabase = get_supabase_client()
+    deleted = 0
+    while True:
+        rows = (
+            supabase.table("saved_uris")
+                .select("id")
+                .eq("user_id", convert_user_id(user_id))
+                .limit(settings.PURGE_BATCH_SIZE)
+                .execute()
+                .data
+        )
+        if not rows:
+            return deleted
+        supabase.table("saved_uris").delete().in_("id", [row["id"] for row in rows]).execute()
+        deleted += len(rows)
+        redis_conn.hincrby(PURGE_STATUS_KEY.format(user_id), "rows_deleted", len(rows))
+
+
+def purge_user(user_id: str):
+    """RQ job: delete everything stored for a user.
+
+    Every step is a no-op once done, so a retry simply runs them all again.
+    """
+    redis_conn = get_jobs_redis_connection()
+    set_purge_status(redis_conn, user_id, status="running", step="writers", started_at=time.time(), error="")
+    try:
+        # saves and imports that got in before the user was marked finish first
+        _wait_for_writers(redis_conn, user_id)
+        set_purge_status(redis_conn, user_id, step="weaviate")
+        delete_user_data(indexer_weaviate_client(), user_id)
+        set_purge_status(redis_conn, user_id, step="saved_uris")
+        rows = _delete_saved_rows(redis_conn, user_id)
+        set_purge_status(redis_conn, user_id, step="caches")
+        invalidate_user_cache(user_id)
+        drop_saved_index(user_id)
+        drop_fingerprints(user_id)
+    except Exception as e:
+        logger.error(f"Error {e} purging {user_id}")
+        set_purge_status(redis_conn, user_id, status="failed", error=str(e)[:500])
+        raise
+    set_purge_status(redis_conn, user_id, status="done", step="done", finished_at=time.time())
+    redis_conn.srem(USER_PURGING_KEY, user_id)
+    logger.info(f"Purged {user_id}, {rows} saved rows deleted")
@@ -0,0 +1,127 @@
+"""Embed existing chunks again from their own text, so every vector is of the same kind.
+
+    python reembed_chunks.py run [--user USER_ID ...] [--force]
+    python reembed_chunks.py status
+
+Content classes created before vectorizeClassName was turned off were
+vectorized by Weaviate with the class name in front of each chunk. Chunks
+embedded by the indexer since, and queries, use the text alone, so until this
+has run a user's old and new chunks don't rank on equal terms. Chunks are
+written again under the same id with their properties and references, and
+texts already in the embedding cache aren't sent to OpenAI again. Progress is
+checkpointed in Redis after every page.
+"""
+import argparse
+
+from weaviate import TenantActivityStatus
+
+from backfill_chunks import backfill_users
+from client import get_jobs_redis_connection, indexer_weaviate_client
+from config import settings
+from embeddings import get_embeddings
+from logger import get_logger
+from tenancy import activate_tenant, user_classes, user_tenant
+from weaviate_batch import BatchErrors, configure_batch, pages, tenant_statuses
+
+logger = get_logger(__name__)
+
+REEMBED_DONE_KEY = "reembed:chunks:done"
+REEMBED_CURSOR_KEY = "reembed:chunks:{}"
+
+
+def _reembed_page(client, objects: list, content_class: str, tenant: str):
+    objects = [obj for obj in objects if (obj.get("properties") or {}).get("source_content")]
+    if not objects:
+        return 0
+    vectors = get_embeddings([obj["properties"]["source_content"] for obj in objects])
+    errors = BatchErrors()
+    configure_batch(client, errors)
+    with client.batch as batch:
+        for obj, vector in zip(objects, vectors):
+            properties = obj["properties"]
+            refs = properties.get("hasCategory")
+            if refs:
+                # the batch replaces the whole object, so the references go back in with it
+                properties = {**properties, "hasCategory": [{"beacon": ref["beacon"]} for ref in refs]}
+            batch.add_data_object(
+                data_object=properties,
+                class_name=content_class,
+                uuid=obj["id"],
+                vector=vector,
+                tenant=tenant,
+            )
+    if errors.errors:
+        raise RuntimeError(f"{len(errors.errors)} chunks failed to update, first: {errors.errors[0]}")
+    return len(objects)
+
+
+def reembed_user(client, redis_conn, user_id: str, force: bool = False, activate: bool = False):
+    cursor_key = REEMBED_CURSOR_KEY.format(user_id)
+    if force:
+        redis_conn.delete(cursor_key)
+        redis_conn.srem(REEMBED_DONE_KEY, user_id)
+    elif redis_conn.sismember(REEMBED_DONE_KEY, user_id):
+        return False
+
+    _, content_class = user_classes(user_id)
+    tenant = user_tenant(user_id)
+    if tenant is not None and activate:
+        activate_tenant(client, tenant)
+    after = redis_conn.get(cursor_key)
+    updated = 0
+    for objects in pages(client, content_class, after.decode() if after else None, tenant=tenant):
+        updated += _reembed_page(client, objects, content_class, tenant)
+        redis_conn.set(cursor_key, objects[-1]["id"])
+    logger.info(f"Re-embedded {updated} chunks of {user_id}")
+    redis_conn.sadd(REEMBED_DONE_KEY, user_id)
+    redis_conn.delete(cursor_key)
+    return True
+
+
+def reembed(user_ids: list = None, force: bool = False):
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    inactive = set()
+    if settings.WEAVIATE_MULTI_TENANCY:
+        tenants = tenant_statuses(client)
+        inactive = {name for name, activity in tenants.items() if activity != TenantActivityStatus.HOT}
+        user_ids = user_ids or sorted(tenants)
+    user_ids = user_ids or backfill_users(client)
+    done, failed = 0, []
+    for user_id in user_ids:
+        try:
+            if reembed_user(client, redis_conn, user_id, force=force, activate=user_id in inactive):
+                done += 1
+        except Exception as e:
+            # the checkpoint stays, the next run resumes this user
+            logger.error(f"Error {e} re-embedding chunks of {user_id}")
+            failed.append(user_id)
+    logger.info(f"Re-embedded {done} of {len(user_ids)} users, {len(failed)} failed")
+    return {"reembedded": done, "failed": failed}
+
+
+def status():
+    client = indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    users = backfill_users(client)
+    done = {user.decode() for user in redis_conn.smembers(REEMBED_DONE_KEY)}
+    return {"users": len(users), "reembedded": len(done), "remaining": len([u for u in users if u not in done])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run")
+    run.add_argument("--user", action="append", dest="users", help="only this user, repeatable")
+    run.add_argument("--force", action="store_true", help="go over users that were already re-embedded")
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print(reembed(args.users, force=args.force))
+    else:
+        print(status())
+
+
+if __name__ == "__main__":
+    main()
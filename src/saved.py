@@ -0,0 +1,70 @@
+import base64
+import json
+from typing import Optional
+
+from cache import get_cached_saved_page, set_cached_saved_page, user_generation
+from client import get_supabase_client
+from config import settings
+from utils import convert_user_id, get_bad_cursor_exception
+
+
+def encode_cursor(row: dict):
+    raw = json.dumps({"c": row["created_at"], "i": row["id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return raw["c"], raw["i"]
+    except Exception:
+        raise get_bad_cursor_exception()
+
+
+def _fetch_page(user_id: str, limit: int, cursor: Optional[str]):
+    supabase = get_supabase_client()
+    query = (
+        supabase.table("saved_uris")
+        .select("id, url, title, created_at")
+        .eq("user_id", convert_user_id(user_id))
+    )
+    if cursor:
+        # keyset on (created_at, id), newest first
+        created_at, last_id = decode_cursor(cursor)
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{last_id})')
+    rows = query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute().data
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    items = [{"id": row["id"], "uri": row["url"], "title": row["title"]} for row in rows[:limit]]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def list_saved(user_id: str, limit: int = None, cursor: Optional[str] = None):
+    """One page of the user's saved sources, newest first.
+
+    The first page is cached until the user saves or deletes something.
+    """
+    limit = min(limit or settings.ALL_SAVED_PAGE_SIZE, settings.ALL_SAVED_MAX_PAGE_SIZE)
+    if cursor:
+        return _fetch_page(user_id, limit, cursor)
+
+    generation = user_generation(user_id)
+    page = get_cached_saved_page(user_id, generation, limit)
+    if page is None:
+        page = _fetch_page(user_id, limit, None)
+        set_cached_saved_page(user_id, generation, limit, page)
+    return page
+
+
+def iter_saved_ndjson(user_id: str):
+    """Every saved source as NDJSON lines, fetched page by page."""
+    cursor = None
+    index = 0
+    while True:
+        page = _fetch_page(user_id, settings.ALL_SAVED_MAX_PAGE_SIZE, cursor)
+        for item in page["items"]:
+            yield json.dumps({"index": index, **item}) + "\n"
+            index += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
@@ -0,0 +1,214 @@
+import hashlib
+import math
+import threading
+
+from redis import RedisError
+
+from cache import LRUCache
+from client import get_jobs_redis_connection, get_supabase_client
+from config import settings
+from logger import get_logger
+from urls import canonical_url, url_variants
+from utils import convert_user_id
+
+logger = get_logger(__name__)
+
+# url digest -> source id for each user, in the jobs Redis so the API and the
+# job workers see the same index. The LOADED field marks an index that holds
+# everything in saved_uris; without it the index is rebuilt before use.
+# Versioned by the canonical form, so changing canonical_url rebuilds them.
+SAVED_INDEX_KEY = "saved:index:2:{}"
+LOADED = "__loaded__"
+SUPABASE_PAGE_SIZE = 1000
+
+_stats = {"hits": 0, "misses": 0, "stale": 0, "loads": 0, "fallbacks": 0, "bloom_skips": 0}
+_lock = threading.Lock()
+# each worker's Bloom filters only see what was in Redis when they were built
+# and what that worker added since, so they're rebuilt every few seconds
+_blooms = LRUCache(settings.SAVED_INDEX_BLOOM_MAX_USERS)
+
+
+def _count(name: str, amount: int = 1):
+    with _lock:
+        _stats[name] += amount
+
+
+def url_digest(url: str):
+    """Digest of a canonical url, callers canonicalize it first."""
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class BloomFilter:
+    """Add-only Bloom filter. "False" is certain, "True" only probable."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1000)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, digest: str):
+        # double hashing from one digest
+        h1, h2 = int(digest[:16], 16), int(digest[16:32], 16) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, digest: str):
+        for position in self._positions(digest):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, digest: str):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(digest))
+
+
+def _load(r, user_id: str):
+    """Rebuild a user's index from saved_uris."""
+    supabase = get_supabase_client()
+    mapping, start = {}, 0
+    while True:
+        rows = (
+            supabase.table("saved_uris")
+                .select("id, url")
+                .eq("user_id", convert_user_id(user_id))
+                .range(start, start + SUPABASE_PAGE_SIZE - 1)
+                .execute()
+                .data
+        )
+        # rows saved before canonical urls were stored under their raw url
+        mapping.update({url_digest(canonical_url(row["url"])): row["id"] for row in rows})
+        if len(rows) < SUPABASE_PAGE_SIZE:
+            break
+        start += SUPABASE_PAGE_SIZE
+
+    key = SAVED_INDEX_KEY.format(user_id)
+    pipe = r.pipeline()
+    # merged rather than replaced, so urls added while loading aren't lost
+    pipe.hset(key, mapping={LOADED: 1, **mapping})
+    pipe.expire(key, settings.SAVED_INDEX_TTL)
+    pipe.execute()
+    _count("loads")
+    return mapping
+
+
+def _bloom(r, user_id: str):
+    bloom = _blooms.get(user_id)
+    if bloom is not None:
+        return bloom
+    digests = [d.decode() for d in r.hkeys(SAVED_INDEX_KEY.format(user_id)) if d != LOADED.encode()]
+    bloom = BloomFilter(len(digests) * 2, settings.SAVED_INDEX_BLOOM_ERROR_RATE)
+    for digest in digests:
+        bloom.add(digest)
+    _blooms.set(user_id, bloom, settings.SAVED_INDEX_BLOOM_TTL)
+    return bloom
+
+
+def lookup(user_id: str, urls: list):
+    """The saved source id for each canonical url, or None if it isn't saved.
+
+    Returns None for the whole lookup if the index is unavailable, so the
+    caller falls back to asking Supabase.
+    """
+    digests = [url_digest(url) for url in urls]
+    try:
+        r = get_jobs_redis_connection()
+        key = SAVED_INDEX_KEY.format(user_id)
+        if not r.hexists(key, LOADED):
+            _load(r, user_id)
+        if settings.SAVED_INDEX_BLOOM:
+            bloom = _bloom(r, user_id)
+            maybe = [digest in bloom for digest in digests]
+            _count("bloom_skips", maybe.count(False))
+        else:
+            maybe = [True] * len(digests)
+        ids = {}
+        candidates = [digest for digest, hit in zip(digests, maybe) if hit]
+        if candidates:
+            ids = dict(zip(candidates, r.hmget(key, candidates)))
+    except Exception as e:
+        logger.error(f"Error {e} reading saved index for {user_id}")
+        _count("fallbacks")
+        return None
+
+    found = [ids[digest].decode() if ids.get(digest) else None for digest in digests]
+    hits = sum(1 for source_id in found if source_id)
+    _count("hits", hits)
+    _count("misses", len(found) - hits)
+    return found
+
+
+def find_saved(user_id: str, urls: list):
+    """Canonical url -> source id for each of the urls that's already saved.
+
+    The index narrows it down and saved_uris confirms, one query either way.
+    """
+    raw_urls, urls = urls, [canonical_url(url) for url in urls]
+    supabase = get_supabase_client()
+    found = lookup(user_id, urls)
+    if found is None:
+        # the index is unavailable, ask saved_uris under every form the urls may be stored as
+        variants = list(dict.fromkeys(variant for url in raw_urls for variant in url_variants(url)))
+        rows = supabase.table("saved_uris").select("id, url").eq("user_id", convert_user_id(user_id)).in_("url", variants).execute()
+        return {canonical_url(row["url"]): row["id"] for row in rows.data}
+
+    hits = {url: source_id for url, source_id in zip(urls, found) if source_id}
+    if not hits:
+        return {}
+    rows = supabase.table("saved_uris").select("id").eq("user_id", convert_user_id(user_id)).in_("id", list(set(hits.values()))).execute()
+    confirmed = {row["id"] for row in rows.data}
+    for url, source_id in hits.items():
+        if source_id not in confirmed:
+            mark_stale(user_id, url)
+    return {url: source_id for url, source_id in hits.items() if source_id in confirmed}
+
+
+def add_saved(user_id: str, saved: list):
+    """Record (canonical url, source id) pairs for a user."""
+    if not saved:
+        return
+    mapping = {url_digest(url): source_id for url, source_id in saved}
+    try:
+        pipe = get_jobs_redis_connection().pipeline()
+        pipe.hset(SAVED_INDEX_KEY.format(user_id), mapping=mapping)
+        pipe.expire(SAVED_INDEX_KEY.format(user_id), settings.SAVED_INDEX_TTL)
+        pipe.execute()
+    except RedisError as e:
+        # the index is rebuilt from saved_uris when it's found stale
+        logger.error(f"Error {e} adding {len(saved)} urls to saved index for {user_id}")
+        return
+    bloom = _blooms.get(user_id)
+    if bloom is not None:
+        for digest in mapping:
+            bloom.add(digest)
+
+
+def remove_saved(user_id: str, urls: list):
+    if not urls:
+        return
+    try:
+        get_jobs_redis_connection().hdel(SAVED_INDEX_KEY.format(user_id), *[url_digest(url) for url in urls])
+    except RedisError as e:
+        # drop the whole index rather than leave a deleted url marked as saved
+        logger.error(f"Error {e} removing {len(urls)} urls from saved index for {user_id}")
+        drop_saved_index(user_id)
+
+
+def mark_stale(user_id: str, url: str):
+    """A hit turned out not to be in saved_uris."""
+    _count("stale")
+    remove_saved(user_id, [url])
+
+
+def drop_saved_index(user_id: str):
+    _blooms.delete(user_id)
+    try:
+        get_jobs_redis_connection().delete(SAVED_INDEX_KEY.format(user_id))
+    except RedisError as e:
+        logger.error(f"Error {e} dropping saved index for {user_id}")
+
+
+def saved_index_stats():
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["bloom_users"] = len(_blooms)
+    return stats
@@ -85,6 +85,12 @@ class PageData(BaseModel):
 
 class SaveRequest(BaseModel):
     pageData: PageData
+    # re-index an already saved page, embedding only changed chunks
+    refresh: Optional[bool] = False
+
+class SaveBatchRequest(BaseModel):
+    # pages saved while offline, in the order they were saved
+    pages: List[PageData]
 
 
 '''
@@ -143,6 +149,10 @@ class DeleteSchema(BaseModel):
     schema: str
     old_record: OldRecord
 
+class DeleteManyRequest(BaseModel):
+    # ids of the sources to delete
+    ids: List[str]
+
 # ''' 
 # Schema for lemon squeezy webhook data
 # '''
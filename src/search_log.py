@@ -0,0 +1,139 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+_queue = None
+_writer = None
+_stats = {"written": 0, "dropped": 0, "rotations": 0}
+
+
+def compact_entry(user_id: str, query: str, raw_response, results: list, took_ms: float):
+    """A search log line: ids, scores and timing rather than the raw Weaviate response."""
+    hits = []
+    # raw_response is None when the results came from the cache
+    for objects in ((raw_response or {}).get("data") or {}).get("Get", {}).values():
+        for obj in objects or []:
+            additional = obj.get("_additional") or {}
+            if "group" in additional:
+                additional = (additional["group"]["hits"] or [{}])[0].get("_additional") or {}
+            rerank = additional.get("rerank") or [{}]
+            hits.append({"id": additional.get("id"), "score": rerank[0].get("score", additional.get("distance"))})
+    return {
+        "ts": round(time.time(), 3),
+        "user_id": user_id,
+        "query": query,
+        "took_ms": round(took_ms, 1),
+        "cached": raw_response is None,
+        "hits": hits,
+        "results": [result["id"] for result in results],
+    }
+
+
+def write_to_log(entry: dict):
+    """Queue a log entry without blocking. Drops it if the writer has fallen behind."""
+    if _queue is None:
+        return
+    try:
+        _queue.put_nowait(entry)
+    except asyncio.QueueFull:
+        _stats["dropped"] += 1
+
+
+class _LogFile:
+    """An append-only file for this worker, rotated by size and age and gzipped on rotation.
+
+    Every uvicorn worker writes its own file, so workers never interleave lines
+    or race each other's rotation.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f"search_logs.{os.getpid()}.json")
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def write(self, lines: list):
+        with self._lock:
+            self.file.write("".join(lines))
+            self.file.flush()
+            if (self.file.tell() >= settings.SEARCH_LOG_MAX_BYTES
+                    or time.time() - self.opened_at >= settings.SEARCH_LOG_ROTATE_SECONDS):
+                self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        if os.path.getsize(self.path):
+            stem = f"{self.path[:-len('.json')]}.{time.strftime('%Y%m%d-%H%M%S')}"
+            rotated, n = f"{stem}.json.gz", 1
+            while os.path.exists(rotated):
+                rotated, n = f"{stem}-{n}.json.gz", n + 1
+            with open(self.path, "rb") as src, gzip.open(rotated, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+            _stats["rotations"] += 1
+        self._open()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+async def _run(log_file: _LogFile):
+    while True:
+        entry = await _queue.get()
+        lines = [json.dumps(entry, separators=(",", ":")) + "\n"]
+        while len(lines) < settings.SEARCH_LOG_BATCH_SIZE and not _queue.empty():
+            lines.append(json.dumps(_queue.get_nowait(), separators=(",", ":")) + "\n")
+        try:
+            # disk writes happen off the event loop
+            await asyncio.to_thread(log_file.write, lines)
+            _stats["written"] += len(lines)
+        except OSError as e:
+            _stats["dropped"] += len(lines)
+            logger.error(f"Error {e} writing {len(lines)} search log entries")
+
+
+def start_search_log():
+    global _queue, _writer
+    _queue = asyncio.Queue(maxsize=settings.SEARCH_LOG_QUEUE_SIZE)
+    log_file = _LogFile(settings.SEARCH_LOG_DIR)
+    _writer = (asyncio.create_task(_run(log_file)), log_file)
+
+
+async def stop_search_log():
+    """Write out whatever is still queued and close the file."""
+    if _writer is None:
+        return
+    task, log_file = _writer
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    lines = []
+    while not _queue.empty():
+        lines.append(json.dumps(_queue.get_nowait(), separators=(",", ":")) + "\n")
+    if lines:
+        await asyncio.to_thread(log_file.write, lines)
+        _stats["written"] += len(lines)
+    log_file.close()
+
+
+def search_log_stats():
+    stats = dict(_stats)
+    stats["queue_depth"] = _queue.qsize() if _queue is not None else 0
+    return stats
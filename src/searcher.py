@@ -1,31 +1,189 @@
+import asyncio
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+
 from config import settings
 from logger import get_logger
 from utils import get_no_schema_failed_exception, get_failed_exception, get_bad_search_exception
 
+from cache import get_cached_search, normalize_query, set_cached_search, user_generation
 from client import query_weaviate_client
+from embeddings import embed_query
+from metrics import timed
+from singleflight import redis_single_flight
+from tenancy import touch_tenant, user_classes, with_tenant
 from weaviate.gql.get import HybridFusion
 
 
 logger = get_logger(__name__)
 
+# Searches run on their own bounded pool so a slow hybrid + rerank round trip
+# never blocks the event loop or starves the default threadpool.
+_search_executor = ThreadPoolExecutor(max_workers=settings.SEARCH_MAX_WORKERS, thread_name_prefix="searcher")
+_cohere_session = requests.Session()
+
+
+async def async_searcher(query: str, user_id: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_search_executor, partial(cached_searcher, query=query, user_id=user_id))
+
+
+async def async_grouped_searcher(query: str, user_id: str, limit: int, offset: int):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _search_executor,
+        partial(cached_searcher, query=query, user_id=user_id, grouped=True, limit=limit, offset=offset)
+    )
+
+
+def cached_searcher(query: str, user_id: str, grouped: bool = False, **params):
+    """A search behind the per-user result cache. The raw response is None on a hit."""
+    cache_params = {"grouped": True, **params} if grouped else None
+    with timed("search", "cache_lookup"):
+        # read once, so results computed across a save or delete are stored under the old generation
+        generation = user_generation(user_id)
+        results = get_cached_search(user_id, generation, query, cache_params)
+    if results is not None:
+        return None, results
+
+    def search():
+        if grouped:
+            response, results = grouped_searcher(query=query, user_id=user_id, **params)
+        else:
+            response, results = searcher(query=query, user_id=user_id)
+        set_cached_search(user_id, generation, query, results, cache_params)
+        return response, results
+
+    if not settings.SINGLE_FLIGHT_REDIS:
+        return search()
+    # identical searches running on other workers share this one
+    key = "search:" + hashlib.sha1(json.dumps([user_id, normalize_query(query), cache_params], sort_keys=True).encode()).hexdigest()
+    response, results = redis_single_flight(key, search)
+    return response, results
+
+
+def cohere_rerank(query: str, documents: list):
+    """Relevance score for each document, in input order."""
+    with timed("grouped_search", "rerank"):
+        response = _cohere_session.post(
+            settings.COHERE_RERANK_URL,
+            json={"model": settings.RERANK_MODEL, "query": query, "documents": documents},
+            headers={"Authorization": f"Bearer {settings.COHERE_API_KEY}"},
+            timeout=settings.RERANK_TIMEOUT,
+        )
+        response.raise_for_status()
+    scores = [0.0] * len(documents)
+    for result in response.json()["results"]:
+        scores[result["index"]] = result["relevance_score"]
+    return scores
+
+
+def _source_fields(source_class: str):
+    if settings.DENORMALIZED_CHUNKS:
+        return ["source_id", "uri", "title"]
+    return [f"hasCategory {{ ... on {source_class} {{ uri title _additional {{ id }}}}}}"]
+
+
+def _source_of(hit: dict):
+    """The id, uri and title of the source a chunk belongs to."""
+    if settings.DENORMALIZED_CHUNKS:
+        return hit["source_id"], hit["uri"], hit["title"]
+    source = hit["hasCategory"][0]
+    return source["_additional"]["id"], source["uri"], source["title"]
+
+
+def grouped_searcher(query: str, user_id: str, limit: int = 10, offset: int = 0):
+    """Search grouped by source on the database side, one best chunk per source.
+
+    Only the requested page of sources is reranked. Returns the raw response
+    and {"results": [...], "next_offset": ...}; each result carries its rerank
+    score and a snippet of the best matching chunk.
+    """
+    client = query_weaviate_client()
+    source_class, content_class = user_classes(user_id)
+    source_fields = " ".join(_source_fields(source_class))
+    group_by = ["source_id"] if settings.DENORMALIZED_CHUNKS else ["hasCategory"]
+
+    # grouping needs a near* search, so the vector is required here
+    with timed("grouped_search", "embed"):
+        vector = embed_query(query)
+    if vector is None:
+        raise get_failed_exception()
+
+    try:
+        touch_tenant(client, user_id)
+        with timed("grouped_search", "retrieve"):
+            response = (
+                with_tenant(client.query.get(content_class, ["source_content"]), user_id)
+                    .with_near_vector({"vector": vector})
+                    .with_group_by(group_by, groups=offset + limit + 1, objects_per_group=1)
+                    .with_additional([f"group {{ id count minDistance hits {{ source_content {source_fields} _additional {{ id distance }} }} }}"])
+                    .do()
+            )
+    except Exception as e:
+        logger.error(f"Error {e} in grouped search '{query}' for {user_id}: Couldn't execute query")
+        raise get_failed_exception()
+
+    if "errors" in response:
+        logger.info(f"{user_id} error in grouped querying: {response}")
+        raise get_no_schema_failed_exception()
+
+    try:
+        groups = [r["_additional"]["group"] for r in response["data"]["Get"][content_class]]
+        page = [group["hits"][0] for group in groups[offset:offset + limit] if group["hits"]]
+        scores = cohere_rerank(query, [hit["source_content"] for hit in page]) if page else []
+
+        results = []
+        with timed("grouped_search", "parse"):
+            for hit, score in sorted(zip(page, scores), key=lambda pair: pair[1], reverse=True):
+                if score < 0.15:
+                    continue
+                source_id, uri, title = _source_of(hit)
+                results.append({
+                    "index": len(results),
+                    "id": source_id,
+                    "uri": uri,
+                    "title": title,
+                    "score": score,
+                    "snippet": hit["source_content"][:settings.SEARCH_SNIPPET_CHARS],
+                })
+        next_offset = offset + limit if len(groups) > offset + limit else None
+        return response, {"results": results, "next_offset": next_offset}
+
+    except TypeError as te:
+        logger.error(f"Error {te} in grouped search '{query}' for {user_id}")
+        raise get_bad_search_exception()
+
+    except Exception as e:
+        logger.error(f"Error {e} in grouped search '{query}' for {user_id}: Couldn't parse response")
+        raise get_failed_exception()
+
+
 def searcher(query: str, user_id: str):
     client = query_weaviate_client()
-    source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
-    content_class = settings.CONTENT_CLASS.format(user_id)
+    source_class, content_class = user_classes(user_id)
     # TODO: better way to handle this
     # query = "query: " + query
+    # None lets Weaviate vectorize the query itself
+    with timed("search", "embed"):
+        vector = embed_query(query)
 
     try:
-        response = (
-            client.query.get(
-                content_class,
-                [f"hasCategory {{ ... on {source_class} {{ uri title _additional {{ id }}}}}}"])
-                .with_hybrid(query=query, alpha=0.75, fusion_type=HybridFusion.RELATIVE_SCORE)
-                # .with_additional("score")
-                .with_additional(['rerank(property: "source_content", query: "{}") {{ score }}'.format(query), 'id'])
-                .with_autocut(2)
-                .do()
-        )
+        touch_tenant(client, user_id)
+        # Weaviate reranks inside the same query, so retrieval and rerank are one stage here
+        with timed("search", "retrieve_rerank"):
+            response = (
+                with_tenant(client.query.get(content_class, _source_fields(source_class)), user_id)
+                    .with_hybrid(query=query, alpha=0.75, vector=vector, fusion_type=HybridFusion.RELATIVE_SCORE)
+                    # .with_additional("score")
+                    .with_additional(['rerank(property: "source_content", query: "{}") {{ score }}'.format(query), 'id'])
+                    .with_autocut(2)
+                    .do()
+            )
     except Exception as e:
         logger.error(f"Error {e} in searching '{query}' for {user_id}: Couldn't execute query")
         raise get_failed_exception()
@@ -37,21 +195,20 @@ def searcher(query: str, user_id: str):
     results = []
     unique_uris_titles = set()
     try:
-        for i, r in enumerate(response["data"]["Get"][content_class]):
-            uri = r["hasCategory"][0]["uri"]
-            title = r["hasCategory"][0]["title"]
-            score = r["_additional"]["rerank"][0]["score"]
-            source_id = r["hasCategory"][0]["_additional"]["id"]
-            if score < 0.15:
-                continue
-            if (uri, title) not in unique_uris_titles:
-                unique_uris_titles.add((uri, title))
-                results.append({
-                    "index": i,
-                    "id": source_id,
-                    "uri": uri,
-                    "title": title
-                })
+        with timed("search", "parse"):
+            for i, r in enumerate(response["data"]["Get"][content_class]):
+                source_id, uri, title = _source_of(r)
+                score = r["_additional"]["rerank"][0]["score"]
+                if score < 0.15:
+                    continue
+                if (uri, title) not in unique_uris_titles:
+                    unique_uris_titles.add((uri, title))
+                    results.append({
+                        "index": i,
+                        "id": source_id,
+                        "uri": uri,
+                        "title": title
+                    })
 
         return response, results
 
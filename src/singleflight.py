@@ -0,0 +1,139 @@
+import asyncio
+import json
+import threading
+import time
+
+from redis import RedisError
+
+from cache import cache_redis, mark_redis_down
+from config import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+FLIGHT_LOCK_KEY = "flight:lock:{}"
+FLIGHT_RESULT_KEY = "flight:result:{}"
+
+
+class AsyncSingleFlight:
+    """Concurrent calls with the same key on this event loop share one in-flight call."""
+
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        future = self._flights.get(key)
+        if future is not None:
+            self.shared += 1
+            # shield so one cancelled caller doesn't cancel everyone else's result
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.ensure_future(fn())
+        self._flights[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._flights.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self._flights.pop(key, None))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread-safe single flight for blocking calls."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._flights.get(key)
+            leader = call is None
+            if leader:
+                call = self._flights[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            call.done.set()
+
+
+def redis_single_flight(key: str, fn, ttl: float = None):
+    """Share one call of fn across workers through Redis. fn's result must be JSON serializable.
+
+    The first worker to take the lock runs fn and publishes the result for a
+    few seconds; the others poll for it. If the leader doesn't publish in time,
+    or Redis is unavailable, the caller runs fn itself.
+    """
+    ttl = ttl or settings.SINGLE_FLIGHT_TTL
+    r = cache_redis()
+    if r is None:
+        return fn()
+    lock_key, result_key = FLIGHT_LOCK_KEY.format(key), FLIGHT_RESULT_KEY.format(key)
+    try:
+        cached = r.get(result_key)
+        if cached is not None:
+            return json.loads(cached)
+        leader = r.set(lock_key, 1, nx=True, px=int(ttl * 1000))
+    except RedisError as e:
+        mark_redis_down(e)
+        return fn()
+
+    if leader:
+        try:
+            result = fn()
+        except Exception:
+            try:
+                r.delete(lock_key)
+            except RedisError as e:
+                mark_redis_down(e)
+            raise
+        try:
+            r.set(result_key, json.dumps(result), px=int(settings.SINGLE_FLIGHT_RESULT_TTL * 1000))
+            r.delete(lock_key)
+        except RedisError as e:
+            mark_redis_down(e)
+        return result
+
+    deadline = time.monotonic() + ttl
+    while time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        try:
+            cached = r.get(result_key)
+            if cached is not None:
+                return json.loads(cached)
+            if not r.exists(lock_key):
+                # the leader failed or gave up without a result
+                break
+        except RedisError as e:
+            mark_redis_down(e)
+            break
+    return fn()
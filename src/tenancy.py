@@ -0,0 +1,146 @@
+import threading
+import time
+
+from redis import RedisError
+from weaviate import Tenant, TenantActivityStatus
+from weaviate.exceptions import UnexpectedStatusCodeException
+
+from client import get_jobs_redis_connection, indexer_weaviate_client
+from config import settings
+from logger import get_logger
+from utils import get_shared_schemas
+
+logger = get_logger(__name__)
+
+# when each tenant was last used, and which ones are offloaded
+TENANT_ACTIVE_KEY = "tenant:active"
+TENANT_OFFLOADED_KEY = "tenant:offloaded"
+
+_known_tenants = set()
+_known_lock = threading.Lock()
+
+
+def user_classes(user_id: str):
+    """The source and content classes that hold a user's data."""
+    if settings.WEAVIATE_MULTI_TENANCY:
+        return settings.SHARED_SOURCE_CLASS, settings.SHARED_CONTENT_CLASS
+    return settings.KNOWLEDGE_SOURCE_CLASS.format(user_id), settings.CONTENT_CLASS.format(user_id)
+
+
+def user_tenant(user_id: str):
+    """The user's tenant, or None when every user has classes of their own."""
+    return user_id if settings.WEAVIATE_MULTI_TENANCY else None
+
+
+def with_tenant(query, user_id: str):
+    tenant = user_tenant(user_id)
+    return query.with_tenant(tenant) if tenant else query
+
+
+def ensure_shared_classes(client):
+    for schema in get_shared_schemas():
+        if not client.schema.exists(schema["class"]):
+            client.schema.create_class(schema)
+
+
+def add_tenant(client, tenant: str):
+    """Create a tenant in both shared classes if it doesn't exist yet."""
+    if tenant in _known_tenants:
+        return
+    for class_name in (settings.SHARED_SOURCE_CLASS, settings.SHARED_CONTENT_CLASS):
+        try:
+            client.schema.add_class_tenants(class_name, [Tenant(name=tenant)])
+        except UnexpectedStatusCodeException as e:
+            if "already exists" not in str(e):
+                raise
+    with _known_lock:
+        _known_tenants.add(tenant)
+
+
+def ensure_tenant(client, user_id: str):
+    tenant = user_tenant(user_id)
+    if tenant is not None:
+        add_tenant(client, tenant)
+
+
+def _set_activity(client, tenant: str, status):
+    for class_name in (settings.SHARED_SOURCE_CLASS, settings.SHARED_CONTENT_CLASS):
+        client.schema.update_class_tenants(class_name, [Tenant(name=tenant, activity_status=status)])
+
+
+def touch_tenant(client, user_id: str):
+    """Note that the user is active, bringing their tenant back if it was offloaded."""
+    tenant = user_tenant(user_id)
+    if tenant is None:
+        return
+    try:
+        pipe = get_jobs_redis_connection().pipeline()
+        pipe.zadd(TENANT_ACTIVE_KEY, {tenant: time.time()})
+        pipe.srem(TENANT_OFFLOADED_KEY, tenant)
+        _, was_offloaded = pipe.execute()
+    except RedisError as e:
+        logger.error(f"Error {e} recording activity of tenant {tenant}")
+        return
+    if was_offloaded:
+        logger.info(f"Reactivating tenant {tenant}")
+        _set_activity(client, tenant, TenantActivityStatus.HOT)
+
+
+def activate_tenant(client, tenant: str):
+    """Bring a tenant back however it was offloaded, and note it as active so it's offloaded again once idle."""
+    _set_activity(client, tenant, TenantActivityStatus.HOT)
+    pipe = get_jobs_redis_connection().pipeline()
+    pipe.zadd(TENANT_ACTIVE_KEY, {tenant: time.time()})
+    pipe.srem(TENANT_OFFLOADED_KEY, tenant)
+    pipe.execute()
+
+
+def offload_idle_tenants(client=None):
+    """RQ job: offload tenants nobody has used for TENANT_IDLE_SECONDS."""
+    if not settings.WEAVIATE_MULTI_TENANCY:
+        return 0
+    client = client or indexer_weaviate_client()
+    redis_conn = get_jobs_redis_connection()
+    status = getattr(TenantActivityStatus, settings.TENANT_OFFLOAD_STATUS)
+    cutoff = time.time() - settings.TENANT_IDLE_SECONDS
+    offloaded = 0
+    for raw in redis_conn.zrangebyscore(TENANT_ACTIVE_KEY, "-inf", cutoff):
+        tenant = raw.decode()
+        # skip tenants that came back since the scan started
+        score = redis_conn.zscore(TENANT_ACTIVE_KEY, tenant)
+        if score is None or score > cutoff:
+            continue
+        try:
+            _set_activity(client, tenant, status)
+        except Exception as e:
+            logger.error(f"Error {e} offloading tenant {tenant}")
+            continue
+        pipe = redis_conn.pipeline()
+        pipe.sadd(TENANT_OFFLOADED_KEY, tenant)
+        pipe.zrem(TENANT_ACTIVE_KEY, tenant)
+        pipe.execute()
+        offloaded += 1
+    logger.info(f"Offloaded {offloaded} idle tenants")
+    return offloaded
+
+
+def delete_user_data(client, user_id: str):
+    """Drop everything a user has in Weaviate. Does nothing for data that's already gone."""
+    tenant = user_tenant(user_id)
+    if tenant is None:
+        for class_name in user_classes(user_id):
+            if client.schema.exists(class_name):
+                client.schema.delete_class(class_name)
+        return
+    for class_name in (settings.SHARED_SOURCE_CLASS, settings.SHARED_CONTENT_CLASS):
+        if any(t.name == tenant for t in client.schema.get_class_tenants(class_name)):
+            client.schema.remove_class_tenants(class_name, [tenant])
+    with _known_lock:
+        _known_tenants.discard(tenant)
+    try:
+        pipe = get_jobs_redis_connection().pipeline()
+        pipe.zrem(TENANT_ACTIVE_KEY, tenant)
+        pipe.srem(TENANT_OFFLOADED_KEY, tenant)
+        pipe.execute()
+    except RedisError as e:
+        logger.error(f"Error {e} forgetting tenant {tenant}")
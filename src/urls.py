@@ -0,0 +1,49 @@
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+# query parameters known to only track where a click came from; anything else
+# may pick the page's content, so it stays
+TRACKING_PARAMS = {"fbclid", "gclid", "_ga", "_gl"}
+TRACKING_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _is_tracking(param: str):
+    param = param.lower()
+    return param in TRACKING_PARAMS or param.startswith(TRACKING_PREFIXES)
+
+
+def canonical_url(url: str):
+    """One form for every variant of a page's url.
+
+    Drops the fragment and tracking parameters, sorts the rest of the query,
+    folds http into https, strips the www host prefix, default ports and
+    trailing slashes. Mobile and AMP mirrors are left alone, they don't always
+    serve the same page.
+    """
+    parsed = urlparse(url.strip())
+    if parsed.scheme not in DEFAULT_PORTS or not parsed.hostname:
+        # not a web page, only drop the fragment
+        return parsed._replace(fragment="").geturl()
+
+    host = parsed.hostname.lower()
+    if host.startswith("www.") and host.count(".") > 1:
+        host = host[len("www."):]
+    if parsed.port and parsed.port not in DEFAULT_PORTS.values():
+        host = f"{host}:{parsed.port}"
+
+    path = parsed.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not _is_tracking(k))
+    return parsed._replace(scheme="https", netloc=host, path=path, params="", query=urlencode(query), fragment="").geturl()
+
+
+def strip_fragment(url: str):
+    """The url as the user saved it, minus the fragment. This is what's stored and shown."""
+    return urlparse(url.strip())._replace(fragment="").geturl()
+
+
+def url_variants(url: str):
+    """The canonical url plus the fragment-stripped form sources are stored under."""
+    return list(dict.fromkeys([canonical_url(url), strip_fragment(url)]))
@@ -1,4 +1,8 @@
+import hashlib
+import threading
+import time
 from functools import lru_cache
+from cache import LRUCache
 from config import settings
 from fastapi import HTTPException, status, Depends
 from jose import JWTError, jwt
@@ -23,7 +27,36 @@ def get_delete_failed_exception():
     return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Couldn't delete that!")
 
 @lru_cache
+def get_batch_too_large_exception():
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Too many items in one request.")
+
+@lru_cache
+def get_user_deleting_exception():
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail="This account is being deleted.")
+
+@lru_cache
+def get_bad_cursor_exception():
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+# verified tokens, each kept until its exp at the latest
+_token_cache = LRUCache(settings.AUTH_CACHE_MAX_ENTRIES)
+_token_stats = {"hits": 0, "misses": 0, "rejected": 0}
+_token_lock = threading.Lock()
+
+
+def _count_token(name: str):
+    with _token_lock:
+        _token_stats[name] += 1
+
+
 def get_current_user(token: str = Depends(OAuth2PasswordBearer(tokenUrl="token"))):
+    key = hashlib.sha256(token.encode()).digest()
+    user_data = _token_cache.get(key)
+    if user_data is not None:
+        _count_token("hits")
+        return user_data
+
+    _count_token("misses")
     credentials_exception = HTTPException(
         status_code=status.HTTP_403_FORBIDDEN, detail="Could not validate credentials"
     )
@@ -31,10 +64,25 @@ def get_current_user(token: str = Depends(OAuth2PasswordBearer(tokenUrl="token")
         payload = jwt.decode(token, settings.SUPABASE_SECRET, algorithms=["HS256"], audience="authenticated")
         user_data = TokenData(**payload)
     except JWTError:
+        # rejected tokens are never cached, so they always pay for a full check
+        _count_token("rejected")
         raise credentials_exception
+
+    ttl = min(user_data.exp - time.time(), settings.AUTH_CACHE_MAX_TTL)
+    if ttl > 0:
+        _token_cache.set(key, user_data, ttl)
     return user_data
 
 
+def auth_cache_stats():
+    with _token_lock:
+        stats = dict(_token_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["entries"] = len(_token_cache)
+    return stats
+
+
 @lru_cache
 def convert_user_id(user_id: str):
     if "-" in user_id:
@@ -49,7 +97,38 @@ def convert_user_id(user_id: str):
 def get_weaviate_schemas(user_id):
     source_class = settings.KNOWLEDGE_SOURCE_CLASS.format(user_id)
     content_class = settings.CONTENT_CLASS.format(user_id)
-    
+    return _class_schemas(source_class, content_class)
+
+
+def get_shared_schemas():
+    """The classes every user shares as a tenant, in multi-tenancy mode."""
+    knowledge_source, content = _class_schemas(settings.SHARED_SOURCE_CLASS, settings.SHARED_CONTENT_CLASS)
+    for schema in (knowledge_source, content):
+        schema["multiTenancyConfig"] = {"enabled": True}
+    return knowledge_source, content
+
+
+# a chunk's source, copied onto it so queries and deletes don't go through references.
+# Kept out of keyword search and of the vectorizer, so ranking is unchanged.
+DENORMALIZED_PROPERTIES = [
+    {
+        "name": name,
+        "description": description,
+        "dataType": ["text"],
+        "tokenization": "field",
+        "indexFilterable": True,
+        "indexSearchable": False,
+        "moduleConfig": {"text2vec-openai": {"skip": True, "vectorizePropertyName": False}},
+    }
+    for name, description in (
+        ("source_id", "The id of the source"),
+        ("uri", "The URI of the source"),
+        ("title", "The title of the source"),
+    )
+]
+
+
+def _class_schemas(source_class: str, content_class: str):
     knowledge_source = {
         "class": source_class,
         "description": "A source saved by the user",
@@ -84,7 +163,8 @@ def get_weaviate_schemas(user_id):
                 "name": "hasCategory",
                 "dataType": [source_class],
                 "description": "The source of the knowledge"
-            }
+            },
+            *(DENORMALIZED_PROPERTIES if settings.DENORMALIZED_CHUNKS else []),
         ],
         "vectorizer": "text2vec-openai",
         "moduleConfig": {
@@ -94,7 +174,9 @@ def get_weaviate_schemas(user_id):
             "text2vec-openai": {
                 "model": "ada",
                 "modelVersion": "002",
-                "type": "text"
+                "type": "text",
+                # chunks and queries are embedded from their text alone, see reembed_chunks.py
+                "vectorizeClassName": False
             }
         }
     }
@@ -0,0 +1,59 @@
+"""Batch writes and paged reads shared by the indexer and the maintenance scripts."""
+from config import settings
+
+
+class BatchErrors:
+    """Batch callback that collects the errors of every failed object or reference."""
+
+    def __init__(self):
+        self.errors = []
+
+    def __call__(self, results):
+        for result in results or []:
+            errors = (result.get("result") or {}).get("errors")
+            if errors:
+                self.errors.append(errors)
+
+
+def configure_batch(client, callback):
+    """Set up client.batch the way every writer uses it, reporting results to callback."""
+    client.batch.configure(
+        batch_size=settings.INDEX_BATCH_SIZE,
+        dynamic=settings.INDEX_DYNAMIC_BATCHING,
+        num_workers=settings.INDEX_NUM_WORKERS,
+        timeout_retries=3,
+        connection_error_retries=3,
+        callback=callback,
+    )
+
+
+def pages(client, class_name: str, after=None, tenant: str = None, with_vector: bool = True):
+    """Every object of a class, a page at a time in id order, starting after the given id."""
+    while True:
+        page = client.data_object.get(class_name=class_name, with_vector=with_vector, tenant=tenant,
+                                      limit=settings.MIGRATION_BATCH_SIZE, after=after)
+        objects = (page or {}).get("objects") or []
+        if not objects:
+            return
+        yield objects
+        after = objects[-1]["id"]
+
+
+def tenant_statuses(client):
+    """Activity status of every tenant of the shared classes, offloaded ones included."""
+    return {t.name: t.activity_status for t in client.schema.get_class_tenants(settings.SHARED_CONTENT_CLASS)}
+
+
+def beacon_id(beacon: str):
+    """The object id a reference beacon points at."""
+    return beacon.rstrip("/").split("/")[-1]
+
+
+def object_properties(client, class_name: str, tenant: str, ids: set):
+    """Properties of the objects with these ids, missing ones left out."""
+    properties = {}
+    for object_id in ids:
+        obj = client.data_object.get_by_id(object_id, class_name=class_name, tenant=tenant)
+        if obj:
+            properties[object_id] = obj["properties"]
+    return properties
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# the app imports its modules by name from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# settings the app requires, none of which the tests reach
+for name in ("WEAVIATE_URL", "WEAVIATE_API_KEY", "OPENAI_API_KEY", "SUPABASE_SECRET", "SUPABASE_URL",
+             "SUPABASE_SERVICE_KEY", "HUGGINGFACE_API_URL", "HUGGINGFACE_API_KEY", "COHERE_API_KEY",
+             "SENTRY_DSN", "LOOPS_API_KEY", "MIXPANEL_TOKEN", "JOBS_QUEUE", "LEMON_SQUEEZY_SECRET"):
+    os.environ.setdefault(name, "test")
@@ -0,0 +1,65 @@
+import pytest
+from redis import ConnectionError
+
+import cache
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+
+class DownRedis:
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError("down")
+        return fail
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(cache, "get_jobs_redis_connection", lambda: fake)
+    monkeypatch.setattr(cache, "cache_redis", lambda: fake)
+    monkeypatch.setattr(cache, "_generations_down_until", 0.0)
+    return fake
+
+
+def test_results_computed_across_a_change_are_not_served_after_it(redis):
+    generation = cache.user_generation("user")
+    assert cache.get_cached_search("user", generation, "query") is None
+    # a save lands while the search is still running
+    cache.invalidate_user_cache("user")
+    cache.set_cached_search("user", generation, "query", ["before the save"])
+
+    assert cache.get_cached_search("user", cache.user_generation("user"), "query") is None
+
+
+def test_results_are_served_until_the_next_change(redis):
+    generation = cache.user_generation("user")
+    cache.set_cached_saved_page("user", generation, 20, {"items": [1]})
+
+    assert cache.get_cached_saved_page("user", cache.user_generation("user"), 20) == {"items": [1]}
+    cache.invalidate_user_cache("user")
+    assert cache.get_cached_saved_page("user", cache.user_generation("user"), 20) is None
+
+
+def test_a_bump_that_cant_be_written_fails_the_change(monkeypatch):
+    monkeypatch.setattr(cache, "get_jobs_redis_connection", lambda: DownRedis())
+    monkeypatch.setattr(cache, "_generations_down_until", 0.0)
+
+    with pytest.raises(ConnectionError):
+        cache.invalidate_user_cache("user")
+    # and while the generation can't be read, nothing is cached or served
+    assert cache.user_generation("user") is None
+    assert cache.get_cached_search("user", None, "query") is None
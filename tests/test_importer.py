@@ -0,0 +1,130 @@
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import importer
+from config import settings
+
+PAGES = {
+    "/article": ("text/html; charset=utf-8", b"<html><title>Article</title><body><p>Some text</p></body></html>"),
+    "/notes.txt": ("text/plain", b"plain <notes>"),
+    "/report.pdf": ("application/pdf", b"%PDF-1.4 \x00\x01\x02"),
+}
+SLOW_SECONDS = 3
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(SLOW_SECONDS)
+            content_type, body = PAGES["/article"]
+        else:
+            content_type, body = PAGES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRedis:
+    """The hash, set and pipeline commands import progress uses."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.sets = {}
+        self._lock = threading.Lock()
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            values = self.hashes.setdefault(key, {})
+            if field is not None:
+                values[field] = str(value)
+            values.update({k: str(v) for k, v in (mapping or {}).items()})
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            values = self.hashes.setdefault(key, {})
+            values[field] = str(int(values.get(field, 0)) + amount)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self.sets.setdefault(key, set()).update(members)
+
+    def sismember(self, key, member):
+        return member in self.sets.get(key, set())
+
+    def expire(self, key, seconds):
+        pass
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def indexed(monkeypatch):
+    redis = FakeRedis()
+    documents = []
+
+    @contextlib.contextmanager
+    def writing(user_id, redis_conn):
+        yield True
+
+    def index_many(docs, user_id):
+        documents.extend(docs)
+        return [{"status": "indexed"} for _ in docs]
+
+    monkeypatch.setattr(importer, "get_jobs_redis_connection", lambda: redis)
+    monkeypatch.setattr(importer, "writing", writing)
+    monkeypatch.setattr(importer, "find_saved", lambda user_id, urls: {})
+    monkeypatch.setattr(importer, "index_many", index_many)
+    monkeypatch.setattr(settings, "IMPORT_FETCH_TIMEOUT", 1)
+    monkeypatch.setattr(settings, "IMPORT_PER_HOST_DELAY", 0)
+    return redis, documents
+
+
+def test_import_indexes_pages_and_records_why_others_failed(server, indexed):
+    redis, documents = indexed
+    bookmarks = [
+        {"name": "Folder", "links": [
+            {"id": "article", "url": f"{server}/article"},
+            {"id": "notes", "url": f"{server}/notes.txt", "name": "Notes"},
+        ]},
+        {"id": "slow", "url": f"{server}/slow"},
+        {"id": "pdf", "url": f"{server}/report.pdf"},
+    ]
+
+    importer.importer({"record": {"id": "record", "user_id": "user", "bookmarks": bookmarks}})
+
+    progress = redis.hashes[importer.IMPORT_PROGRESS_KEY.format("record")]
+    assert progress["status"] == "done"
+    assert (progress["seen"], progress["indexed"], progress["failed"]) == ("4", "2", "2")
+    assert redis.sets[importer.IMPORT_DONE_KEY.format("record")] == {"article", "notes", "slow", "pdf"}
+    failed = redis.hashes[importer.IMPORT_FAILED_KEY.format("record")]
+    assert set(failed) == {"slow", "pdf"}
+    assert "unsupported content type application/pdf" in failed["pdf"]
+
+    by_url = {doc["url"]: doc for doc in documents}
+    assert by_url[f"{server}/article"]["title"] == "Article"
+    assert by_url[f"{server}/article"]["content"] == "Some text"
+    # plain text is kept as it is, not parsed as markup
+    assert by_url[f"{server}/notes.txt"]["content"] == "plain <notes>"
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import searcher
+
+LATENCY = 0.2
+
+
+def _slow_search(query: str, user_id: str):
+    # a backend round trip that blocks its thread, like the Weaviate client does
+    time.sleep(LATENCY)
+    return {}, [{"query": query}]
+
+
+def _stub_backend(monkeypatch):
+    monkeypatch.setattr(searcher, "searcher", _slow_search)
+    monkeypatch.setattr(searcher, "user_generation", lambda user_id: None)
+    monkeypatch.setattr(searcher, "get_cached_search", lambda *args: None)
+    monkeypatch.setattr(searcher, "set_cached_search", lambda *args: None)
+    monkeypatch.setattr(searcher.settings, "SINGLE_FLIGHT_REDIS", False)
+
+
+async def _run(in_flight: int):
+    started = time.perf_counter()
+    results = await asyncio.gather(*(searcher.async_searcher(f"query {i}", "user") for i in range(in_flight)))
+    return time.perf_counter() - started, results
+
+
+def test_throughput_scales_with_in_flight_searches(monkeypatch):
+    _stub_backend(monkeypatch)
+    in_flight = min(8, searcher.settings.SEARCH_MAX_WORKERS)
+
+    elapsed, results = asyncio.run(_run(in_flight))
+
+    assert [r[0]["query"] for _, r in results] == [f"query {i}" for i in range(in_flight)]
+    # run one after another they'd take in_flight * LATENCY
+    assert elapsed < LATENCY * in_flight / 2
+
+
+def test_searches_dont_block_the_event_loop(monkeypatch):
+    _stub_backend(monkeypatch)
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await _run(4)
+        task.cancel()
+        return ticks
+
+    # a blocked loop would barely tick while the searches wait on the backend
+    assert asyncio.run(main()) >= LATENCY / 0.01 / 2
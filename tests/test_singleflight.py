@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+
+import singleflight
+from singleflight import AsyncSingleFlight, SingleFlight, redis_single_flight
+
+CALLERS = 10
+
+
+class _Backend:
+    """Counts calls and takes long enough for every caller to pile up."""
+
+    def __init__(self, latency: float = 0.1):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return {"results": [1, 2, 3]}
+
+
+class FakeRedis:
+    """The commands redis_single_flight uses, with expiry, safe to share between threads."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, nx=False, px=None):
+        with self._lock:
+            if nx and self._live(key):
+                return None
+            value = value if isinstance(value, bytes) else str(value).encode()
+            self._data[key] = (value, time.monotonic() + px / 1000 if px else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return 1 if self._data.pop(key, None) else 0
+
+    def exists(self, key):
+        with self._lock:
+            return 1 if self._live(key) else 0
+
+
+def _in_threads(fn):
+    barrier = threading.Barrier(CALLERS)
+    results = [None] * CALLERS
+
+    def caller(i):
+        barrier.wait()
+        results[i] = fn()
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_single_flight_calls_the_backend_once():
+    backend, flight = _Backend(), SingleFlight()
+
+    results = _in_threads(lambda: flight.do("key", backend))
+
+    assert backend.calls == 1
+    assert results == [{"results": [1, 2, 3]}] * CALLERS
+    assert (flight.calls, flight.shared) == (1, CALLERS - 1)
+
+
+def test_single_flight_shares_the_error():
+    flight, errors = SingleFlight(), []
+
+    def failing():
+        time.sleep(0.1)
+        raise RuntimeError("backend down")
+
+    def call():
+        try:
+            flight.do("key", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    _in_threads(call)
+
+    assert len(errors) == CALLERS
+    assert flight.calls == 1
+
+
+def test_async_single_flight_calls_the_backend_once():
+    backend, flight = _Backend(), AsyncSingleFlight()
+
+    async def fn():
+        await asyncio.sleep(backend.latency)
+        return backend()
+
+    async def main():
+        return await asyncio.gather(*(flight.do("key", fn) for _ in range(CALLERS)))
+
+    results = asyncio.run(main())
+
+    assert backend.calls == 1
+    assert results == [{"results": [1, 2, 3]}] * CALLERS
+    assert (flight.calls, flight.shared) == (1, CALLERS - 1)
+
+
+def test_redis_single_flight_calls_the_backend_once(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(singleflight, "cache_redis", lambda: fake)
+    monkeypatch.setattr(singleflight.settings, "SINGLE_FLIGHT_POLL_INTERVAL", 0.005)
+    backend = _Backend()
+
+    # each thread stands in for a worker process, they only share the fake Redis
+    results = _in_threads(lambda: redis_single_flight("search:key", backend, ttl=5))
+
+    assert backend.calls == 1
+    assert results == [{"results": [1, 2, 3]}] * CALLERS
+
+
+def test_redis_single_flight_runs_fn_itself_without_redis(monkeypatch):
+    monkeypatch.setattr(singleflight, "cache_redis", lambda: None)
+    backend = _Backend(latency=0)
+
+    assert redis_single_flight("search:key", backend) == {"results": [1, 2, 3]}
+    assert backend.calls == 1